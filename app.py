@@ -1,53 +1,114 @@
+import base64
+import binascii
 import json
-import queue
+import re
 import threading
 import time
 import uuid
-from typing import Dict, Any, List
+from collections import deque
+from pathlib import Path
+from typing import Dict, Any, List, Optional
 
 from flask import Flask, render_template, request, Response, jsonify
 from dotenv import load_dotenv
 
+import attachments
+import batch
+import catalog
+import config
 import db
-from graph import build_graph
+import metrics
+import preclassifier
+from graph import build_graph, new_state
+from lazy import Lazy
+from llm_cache import CachedLLM
+from llm_client import build_llm
+from llm_policy import find_policy
+from rate_limit import find_limiter
+from run_store import build_store, iter_events
+from workers import WorkerPool, PoolRejected
 
 load_dotenv()
 
 app = Flask(__name__)
-graph = build_graph()
+# Built on first use or by warmup(), so importing this module stays cheap.
+llm = Lazy("llm", build_llm)
+graph = Lazy("graph", lambda: build_graph(llm=llm.get()))
+LAZY: List[Lazy] = [llm, graph]
+RUNTIME: Dict[str, Any] = {"db": False, "warmup": None}
+pool = WorkerPool(config.WORKER_POOL_SIZE, config.WORKER_QUEUE_LIMIT, config.TENANT_MAX_INFLIGHT)
 
-RUN_EVENTS: Dict[str, "queue.Queue[Dict[str, Any]]"] = {}
+store = build_store()
+RUN_TIMINGS: "deque[Dict[str, Any]]" = deque(maxlen=500)
+BATCH_JOBS: Dict[str, Dict[str, Any]] = {}
+_BATCH_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,64}")
 
 
 def push_event(run_id: str, payload: Dict[str, Any]) -> None:
-    q = RUN_EVENTS.get(run_id)
-    if q:
-        q.put(payload)
+    store.append(run_id, payload)
 
 
 def worker_run_graph(run_id: str, email: Dict[str, Any], attachments_meta: List[Dict[str, Any]]) -> None:
+    started = time.perf_counter()
+    first_event_ms: Optional[float] = None
+    first_item_ms: Optional[float] = None
     try:
-        state = {
-            "run_id": run_id,
-            "email": email,
-            "attachments_meta": attachments_meta,
-            "status_events": [],
-            "classification": None,
-            "final": None,
-        }
+        state = new_state(run_id, email, attachments_meta)
 
         push_event(run_id, {"type": "status", "step": "start", "message": "Workflow started...", "progress": 1})
-        result = graph.invoke(state)
-
-        for ev in result.get("status_events", []):
-            push_event(run_id, {"type": "status", **ev})
-            time.sleep(0.03)
+        result: Dict[str, Any] = state
+        for mode, chunk in graph.get().stream(state, stream_mode=["custom", "values"]):
+            if mode == "custom":
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                if first_event_ms is None:
+                    first_event_ms = elapsed_ms
+                # Nodes publish progress as plain status chunks; streamed items carry their own event type.
+                event = chunk.pop("event", "status")
+                if event != "status" and first_item_ms is None:
+                    first_item_ms = elapsed_ms
+                    metrics.FIRST_ITEM_SECONDS.observe(elapsed_ms / 1000, kind=event)
+                push_event(run_id, {"type": event, **chunk})
+            else:
+                result = chunk
+
+        timings = {
+            "first_event_ms": round(first_event_ms, 2) if first_event_ms is not None else None,
+            "first_item_ms": round(first_item_ms, 2) if first_item_ms is not None else None,
+            "total_ms": round((time.perf_counter() - started) * 1000, 2),
+            "nodes": result.get("node_timings") or {},
+        }
+        RUN_TIMINGS.append(timings)
 
         final = result.get("final")
-        push_event(run_id, {"type": "final", "data": final})
+        metrics.finish_run(run_id, final, time.perf_counter() - started)
+        push_event(run_id, {"type": "final", "data": final, "timings": timings})
 
     except Exception as e:
-        push_event(run_id, {"type": "error", "message": str(e)})
+        metrics.finish_run(run_id, None, time.perf_counter() - started, error=type(e).__name__)
+        push_event(run_id, {"type": "error", "message": str(e), "code": getattr(e, "code", "internal_error")})
+    finally:
+        attachments.release(run_id)
+
+
+def format_sse(event: str, payload: Dict[str, Any], event_id: Optional[int] = None) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return head + f"event: {event}\ndata: " + json.dumps(payload) + "\n\n"
+
+
+def last_event_id(headers: Any, args: Any) -> int:
+    raw = headers.get("Last-Event-ID") or args.get("last_event_id") or "0"
+    try:
+        return max(0, int(raw))
+    except ValueError:
+        return 0
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return round(ordered[idx], 2)
 
 
 @app.get("/")
@@ -57,67 +118,108 @@ def index():
 
 @app.post("/api/start")
 def api_start():
-    run_id = uuid.uuid4().hex
-    RUN_EVENTS[run_id] = queue.Queue()
-
     subject = (request.form.get("subject") or "").strip()
     body = (request.form.get("body") or "").strip()
 
+    tenant = (request.headers.get("X-Tenant-ID") or request.form.get("tenant") or "default").strip()
+    # Admission comes first so a rejected request never spools its attachments.
+    try:
+        pool.reserve(tenant)
+    except PoolRejected as e:
+        resp = jsonify({"error": str(e), "retry_after": e.retry_after})
+        resp.status_code = 429
+        resp.headers["Retry-After"] = str(e.retry_after)
+        return resp
+
+    run_id = uuid.uuid4().hex
+    attachments.maybe_sweep()
     files = request.files.getlist("attachments")
     attachments_meta = []
-    for f in files:
-        if not f or not f.filename:
-            continue
-        content = f.read()
-        attachments_meta.append(
-            {
-                "filename": f.filename,
-                "content_type": f.content_type or "application/octet-stream",
-                "size_bytes": len(content),
-            }
-        )
+    budget = attachments.RequestBudget()
+    try:
+        for f in files:
+            if not f or not f.filename:
+                continue
+            attachments_meta.append(attachments.spool_stream(f.stream, f.filename, f.content_type, budget, run_id))
+        store.maybe_gc()
+        store.create(run_id)
+    except attachments.AttachmentRejected as e:
+        pool.cancel(tenant)
+        attachments.release(run_id)
+        return jsonify({"error": str(e)}), 413
+    except Exception:
+        pool.cancel(tenant)
+        attachments.release(run_id)
+        raise
 
     email = {"subject": subject, "body": body, "attachments": attachments_meta}
-
-    t = threading.Thread(target=worker_run_graph, args=(run_id, email, attachments_meta), daemon=True)
-    t.start()
-
+    pool.start(tenant, worker_run_graph, run_id, email, attachments_meta)
     return jsonify({"run_id": run_id})
 
 
 @app.get("/api/stream/<run_id>")
 def api_stream(run_id: str):
-    if run_id not in RUN_EVENTS:
+    if not store.exists(run_id):
         return jsonify({"error": "Unknown run_id"}), 404
+    after_seq = last_event_id(request.headers, request.args)
 
     def event_stream():
-        print("Comig here")
-        q = RUN_EVENTS[run_id]
-        yield "event: status\ndata: " + json.dumps(
-            {"step": "ui", "message": "Connected. Waiting for updates...", "progress": 0}
-        ) + "\n\n"
-
-        while True:
-            try:
-                payload = q.get(timeout=30)
-            except queue.Empty:
-                yield "event: status\ndata: " + json.dumps(
-                    {"step": "heartbeat", "message": "Still working...", "progress": None}
-                ) + "\n\n"
+        yield format_sse("status", {"step": "ui", "message": "Connected. Waiting for updates...", "progress": 0})
+
+        for event in iter_events(store, run_id, after_seq, heartbeat_s=30):
+            if event is None:
+                yield format_sse("status", {"step": "heartbeat", "message": "Still working...", "progress": None})
                 continue
+            seq, payload = event
+            yield format_sse(payload["type"], payload, seq)
 
-            if payload["type"] == "status":
-                yield "event: status\ndata: " + json.dumps(payload) + "\n\n"
-            elif payload["type"] == "final":
-                yield "event: final\ndata: " + json.dumps(payload) + "\n\n"
-                break
-            elif payload["type"] == "error":
-                yield "event: error\ndata: " + json.dumps(payload) + "\n\n"
-                break
+    return Response(event_stream(), mimetype="text/event-stream")
 
-        RUN_EVENTS.pop(run_id, None)
 
-    return Response(event_stream(), mimetype="text/event-stream")
+def _encode_cursor(row: Dict[str, Any]) -> str:
+    raw = json.dumps([row["created_at"], row["ticket_id"]]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple:
+    created_at, ticket_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    return str(created_at), str(ticket_id)
+
+
+@app.get("/api/tickets")
+def api_search_tickets():
+    args = request.args
+    try:
+        kind = args.get("kind") or None
+        if kind not in (None, "sales", "support"):
+            raise ValueError("kind must be sales or support")
+        filters = {
+            "kind": kind,
+            "intent": args.get("intent") or None,
+            "min_confidence": args.get("min_confidence", type=float),
+            "max_confidence": args.get("max_confidence", type=float),
+            "text": (args.get("q") or "").strip() or None,
+            "created_from": args.get("created_from") or None,
+            "created_to": args.get("created_to") or None,
+            "before": _decode_cursor(args["cursor"]) if args.get("cursor") else None,
+        }
+        limit = min(max(args.get("limit", config.TICKETS_PAGE_DEFAULT, type=int), 1), config.TICKETS_PAGE_MAX)
+    except (ValueError, TypeError, binascii.Error) as e:
+        return jsonify({"error": f"invalid query: {e}"}), 400
+
+    def generate():
+        # One row past the page says whether there is a next one; rows are written as read.
+        yield '{"items": ['
+        last = None
+        for i, row in enumerate(db.search_tickets(limit=limit + 1, **filters)):
+            if i == limit:
+                yield f'], "next_cursor": {json.dumps(_encode_cursor(last))}}}'
+                return
+            yield ("," if i else "") + json.dumps(row, ensure_ascii=False)
+            last = row
+        yield '], "next_cursor": null}'
+
+    return Response(generate(), mimetype="application/json")
 
 
 @app.get("/api/tickets/<ticket_id>")
@@ -141,9 +243,205 @@ def api_get_ticket(ticket_id: str):
     return jsonify({"found": True, "data": out})
 
 
+@app.get("/api/timings")
+def api_timings():
+    recent = list(RUN_TIMINGS)
+    out: Dict[str, Any] = {"runs": len(recent)}
+    for key in ("first_event_ms", "first_item_ms", "total_ms"):
+        values = [t[key] for t in recent if t.get(key) is not None]
+        out[key] = {"p50": _percentile(values, 50), "p95": _percentile(values, 95), "max": max(values) if values else None}
+    per_node: Dict[str, List[float]] = {}
+    for t in recent:
+        for node, ms in (t.get("nodes") or {}).items():
+            per_node.setdefault(node, []).append(ms)
+    out["nodes_ms"] = {n: {"p50": _percentile(v, 50), "p95": _percentile(v, 95)} for n, v in per_node.items()}
+    return jsonify(out)
+
+
+@app.get("/api/llm-cache")
+def api_llm_cache():
+    current = llm.peek()
+    stats = current.stats() if isinstance(current, CachedLLM) else {"enabled": False}
+    return jsonify({**stats, "initialized": llm.ready})
+
+
+@app.get("/api/llm-rate")
+def api_llm_rate():
+    limiter = find_limiter(llm.peek())
+    return jsonify(limiter.stats() if limiter else {"enabled": False, "initialized": llm.ready})
+
+
+@app.get("/api/llm-policy")
+def api_llm_policy():
+    policy = find_policy(llm.peek())
+    return jsonify(policy.stats() if policy else {"initialized": llm.ready})
+
+
+@app.get("/api/preclassifier")
+def api_preclassifier():
+    threshold = request.args.get("threshold", type=float)
+    return jsonify(preclassifier.shadow_report(threshold))
+
+
+@app.post("/api/preclassifier/reload")
+def api_preclassifier_reload():
+    clf = preclassifier.reload_classifier()
+    return jsonify({"model_samples": clf.category_model.samples if clf.category_model else 0})
+
+
+def _catalog_stats() -> Dict[str, Any]:
+    import product_index  # numpy; loaded with the first graph, not at import
+
+    return {**catalog.stats(), "product_index": product_index.stats()}
+
+
+@app.get("/api/catalog")
+def api_catalog():
+    return jsonify(_catalog_stats())
+
+
+@app.post("/api/catalog/reload")
+def api_catalog_reload():
+    catalog.reload_catalog()
+    return jsonify(_catalog_stats())
+
+
+@app.post("/api/batch")
+def api_batch_start():
+    f = request.files.get("file")
+    if not f or not f.filename:
+        return jsonify({"error": "Upload a JSONL or mbox file as 'file'"}), 400
+
+    # batch_id and format become a file name under BATCH_DIR, so both are validated strictly.
+    batch_id = (request.form.get("batch_id") or "").strip() or uuid.uuid4().hex[:16]
+    if not _BATCH_ID_RE.fullmatch(batch_id):
+        return jsonify({"error": "batch_id must be 1-64 letters, digits, '_' or '-'"}), 400
+    fmt = request.form.get("format") or ("mbox" if f.filename.lower().endswith((".mbox", ".mbx")) else "jsonl")
+    if fmt not in ("jsonl", "mbox"):
+        return jsonify({"error": "format must be jsonl or mbox"}), 400
+    try:
+        workers = max(1, int(request.form.get("workers") or config.BATCH_WORKERS))
+    except ValueError:
+        return jsonify({"error": "workers must be an integer"}), 400
+    if BATCH_JOBS.get(batch_id, {}).get("state") == "running":
+        return jsonify({"error": "Batch is already running", "batch_id": batch_id}), 409
+
+    batch_dir = Path(config.BATCH_DIR)
+    batch_dir.mkdir(parents=True, exist_ok=True)
+    input_path = batch_dir / f"{batch_id}.{fmt}"
+    f.save(input_path)
+    retry_errors = (request.form.get("retry_errors") or "").lower() in ("1", "true", "yes", "on")
+
+    job: Dict[str, Any] = {"state": "running", "batch_id": batch_id, "progress": {}}
+    BATCH_JOBS[batch_id] = job
+
+    def run() -> None:
+        try:
+            job["summary"] = batch.run_batch(
+                input_path, batch_dir / f"{batch_id}.results.jsonl", batch_id=batch_id, fmt=fmt, workers=workers,
+                retry_errors=retry_errors, llm=llm.get(), progress=lambda p: job.update(progress=p),
+            )
+            job["state"] = "done"
+        except Exception as e:
+            job.update(state="error", error=str(e))
+
+    # Batches run on their own thread pool so they don't take slots from interactive runs.
+    threading.Thread(target=run, name=f"batch-{batch_id}", daemon=True).start()
+    return jsonify({"batch_id": batch_id}), 202
+
+
+@app.get("/api/batch/<batch_id>")
+def api_batch_status(batch_id: str):
+    job = BATCH_JOBS.get(batch_id) or {"batch_id": batch_id, "state": "unknown"}
+    return jsonify({**job, "committed": db.batch_counts(batch_id)})
+
+
+@app.get("/api/batch/<batch_id>/results")
+def api_batch_results(batch_id: str):
+    def generate():
+        for row in db.iter_batch_results(batch_id):
+            yield json.dumps(row, ensure_ascii=False) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+@app.get("/api/attachments")
+def api_attachments():
+    return jsonify(attachments.stats())
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(pool.stats()), mimetype="text/plain; version=0.0.4")
+
+
+@app.get("/api/runs/<run_id>/spans")
+def api_run_spans(run_id: str):
+    return jsonify({"run_id": run_id, "spans": db.get_run_spans(run_id)})
+
+
+@app.get("/api/runs")
+def api_runs():
+    return jsonify(store.stats())
+
+
+@app.get("/api/pool")
+def api_pool():
+    return jsonify(pool.stats())
+
+
+@app.get("/healthz")
+def healthz():
+    return jsonify({"ok": True})
+
+
+@app.get("/readyz")
+def readyz():
+    components = {lz.name: lz.status() for lz in LAZY}
+    warm = all(c["ready"] for c in components.values()) or config.WARMUP == "lazy"
+    ready = RUNTIME["db"] and warm
+    body = {"ready": ready, "db": RUNTIME["db"], "warmup": RUNTIME["warmup"], "components": components}
+    return jsonify(body), 200 if ready else 503
+
+
+def warmup() -> None:
+    started = time.perf_counter()
+    RUNTIME["warmup"] = "running"
+    try:
+        for lz in LAZY:
+            lz.get()
+    except Exception:
+        # The error is kept on the component for /readyz; a later request retries the build.
+        RUNTIME["warmup"] = "failed"
+        return
+    RUNTIME["warmup"] = f"done in {round((time.perf_counter() - started) * 1000, 2)} ms"
+
+
+_runtime_lock = threading.Lock()
+
+
 def init_runtime():
-    db.init_db()
-    db.seed_dummy_products_if_empty()
+    # Once per process: from __main__, the ASGI lifespan, or the first request when a WSGI
+    # server (gunicorn, ...) imports `app:app` directly.
+    with _runtime_lock:
+        if RUNTIME["db"]:
+            return
+        db.init_db()
+        db.seed_dummy_products_if_empty()
+        catalog.reload_catalog()
+        store.recover()
+        RUNTIME["db"] = True
+    if config.WARMUP == "eager":
+        warmup()
+    elif config.WARMUP == "background":
+        threading.Thread(target=warmup, name="warmup", daemon=True).start()
+
+
+@app.before_request
+def ensure_runtime():
+    # Liveness stays cheap; any other request (a /readyz probe included) initializes the process.
+    if not RUNTIME["db"] and request.endpoint != "healthz":
+        init_runtime()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+import asyncio
+import contextlib
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Set
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+import attachments
+import config
+import metrics
+from app import app as flask_app, format_sse, init_runtime, last_event_id, llm, store, LAZY, RUN_TIMINGS
+from graph import build_graph, new_state
+from lazy import Lazy
+from run_store import aiter_events
+from workers import AsyncRunLimiter, PoolRejected
+
+# asyncio execution mode: graph nodes await llm.ainvoke and SSE streams are coroutines,
+# so open streams and in-flight runs don't pin a thread each. Everything else is served
+# by the Flask app mounted below. Run with: uvicorn asgi:app
+
+graph = Lazy("async_graph", lambda: build_graph(async_mode=True, llm=llm.get()))
+LAZY.append(graph)
+limiter = AsyncRunLimiter(config.ASYNC_MAX_INFLIGHT, config.TENANT_MAX_INFLIGHT)
+
+_TASKS: Set["asyncio.Task[None]"] = set()
+
+
+async def push_event(run_id: str, payload: Dict[str, Any]) -> None:
+    await asyncio.to_thread(store.append, run_id, payload)
+
+
+async def run_graph(
+    run_id: str, email: Dict[str, Any], attachments_meta: List[Dict[str, Any]], tenant: str, started: float
+) -> None:
+    first_event_ms: Optional[float] = None
+    first_item_ms: Optional[float] = None
+    try:
+        state = new_state(run_id, email, attachments_meta)
+
+        await push_event(run_id, {"type": "status", "step": "start", "message": "Workflow started...", "progress": 1})
+        result: Dict[str, Any] = state
+        compiled = graph.peek() or await asyncio.to_thread(graph.get)
+        async for mode, chunk in compiled.astream(state, stream_mode=["custom", "values"]):
+            if mode == "custom":
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                if first_event_ms is None:
+                    first_event_ms = elapsed_ms
+                # Nodes publish progress as plain status chunks; streamed items carry their own event type.
+                event = chunk.pop("event", "status")
+                if event != "status" and first_item_ms is None:
+                    first_item_ms = elapsed_ms
+                    metrics.FIRST_ITEM_SECONDS.observe(elapsed_ms / 1000, kind=event)
+                await push_event(run_id, {"type": event, **chunk})
+            else:
+                result = chunk
+
+        timings = {
+            "first_event_ms": round(first_event_ms, 2) if first_event_ms is not None else None,
+            "first_item_ms": round(first_item_ms, 2) if first_item_ms is not None else None,
+            "total_ms": round((time.perf_counter() - started) * 1000, 2),
+            "nodes": result.get("node_timings") or {},
+        }
+        RUN_TIMINGS.append(timings)
+        await asyncio.to_thread(metrics.finish_run, run_id, result.get("final"), time.perf_counter() - started)
+        await push_event(run_id, {"type": "final", "data": result.get("final"), "timings": timings})
+
+    except Exception as e:
+        await asyncio.to_thread(
+            metrics.finish_run, run_id, None, time.perf_counter() - started, type(e).__name__
+        )
+        await push_event(run_id, {"type": "error", "message": str(e), "code": getattr(e, "code", "internal_error")})
+    finally:
+        limiter.release(tenant, started)
+        await asyncio.to_thread(attachments.release, run_id)
+
+
+async def api_start(request: Request) -> JSONResponse:
+    form = await request.form()
+    subject = str(form.get("subject") or "").strip()
+    body = str(form.get("body") or "").strip()
+
+    tenant = (request.headers.get("X-Tenant-ID") or str(form.get("tenant") or "") or "default").strip()
+    # Admission comes first so a rejected request never spools its attachments.
+    try:
+        limiter.acquire(tenant)
+    except PoolRejected as e:
+        return JSONResponse(
+            {"error": str(e), "retry_after": e.retry_after},
+            status_code=429,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+    run_id = uuid.uuid4().hex
+    attachments_meta = []
+    budget = attachments.RequestBudget()
+    try:
+        await asyncio.to_thread(attachments.maybe_sweep)
+        for f in form.getlist("attachments"):
+            if isinstance(f, str) or not f.filename:
+                continue
+            attachments_meta.append(
+                await asyncio.to_thread(attachments.spool_stream, f.file, f.filename, f.content_type, budget, run_id)
+            )
+        await asyncio.to_thread(store.maybe_gc)
+        await asyncio.to_thread(store.create, run_id)
+    except attachments.AttachmentRejected as e:
+        limiter.cancel(tenant)
+        await asyncio.to_thread(attachments.release, run_id)
+        return JSONResponse({"error": str(e)}, status_code=413)
+    except BaseException:
+        limiter.cancel(tenant)
+        await asyncio.to_thread(attachments.release, run_id)
+        raise
+
+    email = {"subject": subject, "body": body, "attachments": attachments_meta}
+    # The run's clock starts once its input is spooled.
+    started = time.perf_counter()
+    task = asyncio.create_task(run_graph(run_id, email, attachments_meta, tenant, started))
+    _TASKS.add(task)
+    task.add_done_callback(_TASKS.discard)
+
+    return JSONResponse({"run_id": run_id})
+
+
+async def api_stream(request: Request):
+    run_id = request.path_params["run_id"]
+    if not await asyncio.to_thread(store.exists, run_id):
+        return JSONResponse({"error": "Unknown run_id"}, status_code=404)
+    after_seq = last_event_id(request.headers, request.query_params)
+
+    async def event_stream():
+        yield format_sse("status", {"step": "ui", "message": "Connected. Waiting for updates...", "progress": 0})
+
+        async for event in aiter_events(store, run_id, after_seq, heartbeat_s=30):
+            if event is None:
+                yield format_sse("status", {"step": "heartbeat", "message": "Still working...", "progress": None})
+                continue
+            seq, payload = event
+            yield format_sse(payload["type"], payload, seq)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+async def api_async_pool(request: Request) -> JSONResponse:
+    return JSONResponse(limiter.stats())
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    # Same registry as the Flask endpoint, but the admission gauges come from this limiter.
+    return Response(metrics.render(limiter.stats()), media_type="text/plain; version=0.0.4")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_app: Starlette):
+    init_runtime()
+    yield
+
+
+app = Starlette(
+    routes=[
+        Route("/api/start", api_start, methods=["POST"]),
+        Route("/api/stream/{run_id}", api_stream),
+        Route("/api/pool", api_async_pool),
+        Route("/metrics", metrics_endpoint),
+        Mount("/", WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan,
+)
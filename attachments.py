@@ -0,0 +1,128 @@
+import contextlib
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Optional
+
+import config
+import db
+
+# Content-addressed attachment spool. Uploads are copied to disk in fixed-size chunks
+# while size and sha256 are computed, so a request never holds a whole file in memory.
+# Blobs live at <spool>/<aa>/<bb>/<sha256>; identical files are stored once. A run holds
+# its blobs until it finishes; unheld blobs are evicted after ATTACHMENT_BLOB_TTL_S, or
+# least recently used first when the spool is full.
+
+_last_sweep = 0.0
+
+
+class AttachmentRejected(ValueError):
+    pass
+
+
+class RequestBudget:
+    def __init__(self, limit_bytes: Optional[int] = None):
+        self.limit = config.ATTACHMENT_MAX_REQUEST_BYTES if limit_bytes is None else limit_bytes
+        self.used = 0
+
+    def consume(self, n: int) -> None:
+        self.used += n
+        if self.used > self.limit:
+            raise AttachmentRejected(f"Attachments exceed the per-request limit of {self.limit} bytes.")
+
+
+def spool_dir() -> Path:
+    return Path(config.ATTACHMENT_SPOOL_DIR)
+
+
+def blob_path(sha256: str) -> Path:
+    return spool_dir() / sha256[:2] / sha256[2:4] / sha256
+
+
+def spool_stream(
+    stream: BinaryIO,
+    filename: str,
+    content_type: Optional[str] = None,
+    budget: Optional[RequestBudget] = None,
+    run_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    budget = budget if budget is not None else RequestBudget()
+    tmp_dir = spool_dir() / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_name = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = stream.read(config.ATTACHMENT_CHUNK_BYTES)
+                if not chunk:
+                    break
+                budget.consume(len(chunk))
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+
+        sha256 = digest.hexdigest()
+        target = blob_path(sha256)
+        if not db.attachment_blob_exists(sha256) and not _has_room(size):
+            raise AttachmentRejected("Attachment spool is full; try again later.")
+        # Reference first, then (re)place the file: a sweep either ran before the reference or
+        # can no longer pick this blob.
+        db.attachment_blob_ref(sha256, size, run_id)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_name, target)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_name)
+
+    return {
+        "filename": filename,
+        "content_type": content_type or "application/octet-stream",
+        "size_bytes": size,
+        "sha256": sha256,
+        "blob": target.relative_to(spool_dir()).as_posix(),
+    }
+
+
+def _has_room(size: int) -> bool:
+    if db.attachment_spool_stats()["bytes"] + size <= config.ATTACHMENT_SPOOL_MAX_BYTES:
+        return True
+    sweep(incoming_bytes=size)
+    return db.attachment_spool_stats()["bytes"] + size <= config.ATTACHMENT_SPOOL_MAX_BYTES
+
+
+def release(run_id: str) -> int:
+    return db.attachment_release_run(run_id)
+
+
+def _remove_blob(sha256: str) -> None:
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(blob_path(sha256))
+
+
+def sweep(incoming_bytes: int = 0) -> int:
+    now = time.time()
+    db.attachment_release_stale(now - config.RUN_STORE_ABANDONED_TTL_S)
+    evicted = db.attachment_blob_sweep(
+        now - config.ATTACHMENT_BLOB_TTL_S, config.ATTACHMENT_SPOOL_MAX_BYTES - incoming_bytes, _remove_blob
+    )
+    return len(evicted)
+
+
+def maybe_sweep() -> int:
+    global _last_sweep
+    now = time.time()
+    if now - _last_sweep < config.ATTACHMENT_SWEEP_INTERVAL_S:
+        return 0
+    _last_sweep = now
+    return sweep()
+
+
+def stats() -> Dict[str, Any]:
+    out: Dict[str, Any] = dict(db.attachment_spool_stats())
+    out["max_bytes"] = config.ATTACHMENT_SPOOL_MAX_BYTES
+    out["max_request_bytes"] = config.ATTACHMENT_MAX_REQUEST_BYTES
+    return out
@@ -0,0 +1,266 @@
+import argparse
+import hashlib
+import io
+import json
+import mailbox
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from email.message import Message
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import config
+import db
+import metrics
+from attachments import AttachmentRejected, RequestBudget, spool_stream
+from graph import build_graph, new_state
+
+# Bulk triage of mailbox exports. Emails run through the normal graph with a bounded
+# number in flight; ticket rows are buffered and written with executemany together
+# with a batch_items marker per email, which is what makes a batch resumable.
+
+
+def _item_key(record: Dict[str, Any]) -> str:
+    explicit = record.get("id") or record.get("message_id")
+    if explicit:
+        return str(explicit).strip()
+    raw = f"{record.get('subject', '')}\0{record.get('body', '')}"
+    return "sha256:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def iter_jsonl(path: Path) -> Iterator[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _message_text(msg: Message) -> Tuple[str, List[Tuple[str, str, bytes]]]:
+    texts: List[str] = []
+    parts: List[Tuple[str, str, bytes]] = []
+    for part in msg.walk() if msg.is_multipart() else [msg]:
+        if part.is_multipart():
+            continue
+        payload = part.get_payload(decode=True) or b""
+        filename = part.get_filename()
+        if filename:
+            parts.append((filename, part.get_content_type(), payload))
+        elif part.get_content_type() == "text/plain":
+            texts.append(payload.decode(part.get_content_charset() or "utf-8", errors="replace"))
+    return "\n".join(texts).strip(), parts
+
+
+def iter_mbox(path: Path) -> Iterator[Dict[str, Any]]:
+    for msg in mailbox.mbox(str(path), create=False):
+        body, parts = _message_text(msg)
+        yield {
+            "message_id": (msg.get("Message-ID") or "").strip() or None,
+            "subject": str(msg.get("Subject") or "").strip(),
+            "body": body,
+            "attachment_parts": parts,
+        }
+
+
+def _spool_parts(parts: List[Tuple[str, str, bytes]]) -> List[Dict[str, Any]]:
+    # Spooled in the worker, so emails skipped on resume never touch the spool.
+    out: List[Dict[str, Any]] = []
+    budget = RequestBudget()
+    for filename, content_type, payload in parts:
+        try:
+            out.append(spool_stream(io.BytesIO(payload), filename, content_type, budget))
+        except AttachmentRejected:
+            out.append({"filename": filename, "content_type": content_type, "size_bytes": len(payload)})
+    return out
+
+
+def iter_input(path: Path, fmt: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    fmt = fmt or ("mbox" if path.suffix.lower() in (".mbox", ".mbx") else "jsonl")
+    return iter_mbox(path) if fmt == "mbox" else iter_jsonl(path)
+
+
+class TicketBuffer:
+    # Stands in for db in build_graph(tickets=...): rows get their ticket_id immediately
+    # but are only written when the batch runner commits them.
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+
+    def create_sales_ticket(self, **kwargs: Any) -> str:
+        row = db.sales_ticket_row(**kwargs)
+        with self._lock:
+            self._pending[row["ticket_id"]] = ("sales", row)
+        return row["ticket_id"]
+
+    def create_support_ticket(self, **kwargs: Any) -> str:
+        row = db.support_ticket_row(**kwargs)
+        with self._lock:
+            self._pending[row["ticket_id"]] = ("support", row)
+        return row["ticket_id"]
+
+    def take(self, ticket_id: Optional[str]) -> Optional[Tuple[str, Dict[str, Any]]]:
+        if not ticket_id:
+            return None
+        with self._lock:
+            return self._pending.pop(ticket_id, None)
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return round(ordered[idx], 2)
+
+
+def _run_one(graph: Any, key: str, record: Dict[str, Any]) -> Dict[str, Any]:
+    started = time.perf_counter()
+    run_id = uuid.uuid4().hex
+    try:
+        attachments = record.get("attachments") or _spool_parts(record.get("attachment_parts") or [])
+        email = {"subject": record.get("subject") or "", "body": record.get("body") or "", "attachments": attachments}
+        result = graph.invoke(new_state(run_id, email, attachments, priority="bulk"))
+    except Exception as e:
+        metrics.finish_run(run_id, None, time.perf_counter() - started, error=type(e).__name__)
+        return {"key": key, "status": "error", "error": str(e), "run_id": run_id,
+                "latency_ms": round((time.perf_counter() - started) * 1000, 2)}
+    metrics.finish_run(run_id, result.get("final"), time.perf_counter() - started)
+    final = result.get("final") or {}
+    cls = result.get("classification") or {}
+    return {
+        "key": key,
+        "status": "ok",
+        "run_id": run_id,
+        "ticket_id": result.get("ticket_id"),
+        "category": final.get("category"),
+        "intent": cls.get("intent"),
+        "latency_ms": round((time.perf_counter() - started) * 1000, 2),
+        "final": final,
+    }
+
+
+def run_batch(
+    input_path: Path,
+    results_path: Path,
+    batch_id: Optional[str] = None,
+    fmt: Optional[str] = None,
+    workers: Optional[int] = None,
+    flush_items: Optional[int] = None,
+    retry_errors: bool = False,
+    llm: Any = None,
+    progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    workers = workers or config.BATCH_WORKERS
+    flush_items = flush_items or config.BATCH_FLUSH_ITEMS
+    batch_id = batch_id or hashlib.sha256(str(input_path.resolve()).encode("utf-8")).hexdigest()[:16]
+
+    tickets = TicketBuffer()
+    graph = build_graph(llm=llm, tickets=tickets)
+    statuses = db.get_batch_item_statuses(batch_id)
+    done: Set[str] = {k for k, st in statuses.items() if st != "error" or not retry_errors}
+
+    # Rewrite the results file from what is already committed, then append as we go, so
+    # the file always matches batch_items even after a crash between commit and write.
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    out = open(results_path, "w", encoding="utf-8")
+    for row in db.iter_batch_results(batch_id, include_errors=not retry_errors):
+        out.write(json.dumps(row, ensure_ascii=False) + "\n")
+    out.flush()
+
+    counts = {"processed": 0, "ok": 0, "error": 0, "skipped": 0, "duplicates": 0}
+    latencies: List[float] = []
+    pending: List[Dict[str, Any]] = []
+
+    def flush() -> None:
+        if not pending:
+            return
+        sales_rows: List[Dict[str, Any]] = []
+        support_rows: List[Dict[str, Any]] = []
+        for item in pending:
+            taken = tickets.take(item.get("ticket_id"))
+            if taken is not None:
+                (sales_rows if taken[0] == "sales" else support_rows).append(taken[1])
+        db.commit_batch(batch_id, sales_rows, support_rows, pending)
+        for item in pending:
+            out.write(json.dumps(item, ensure_ascii=False) + "\n")
+        out.flush()
+        pending.clear()
+        if progress:
+            progress({"batch_id": batch_id, **counts})
+
+    def collect(fut: "Future[Dict[str, Any]]") -> None:
+        item = fut.result()
+        counts["processed"] += 1
+        counts[item["status"]] += 1
+        latencies.append(item["latency_ms"])
+        pending.append(item)
+        if len(pending) >= flush_items:
+            flush()
+
+    started = time.perf_counter()
+    in_flight: Set["Future[Dict[str, Any]]"] = set()
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as executor:
+            for record in iter_input(input_path, fmt):
+                key = _item_key(record)
+                if key in done:
+                    counts["skipped" if key in statuses else "duplicates"] += 1
+                    continue
+                done.add(key)
+                in_flight.add(executor.submit(_run_one, graph, key, record))
+                if len(in_flight) >= workers * 2:
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for fut in finished:
+                        collect(fut)
+            for fut in in_flight:
+                collect(fut)
+        flush()
+    finally:
+        out.close()
+
+    elapsed = time.perf_counter() - started
+    return {
+        "batch_id": batch_id,
+        "results_path": str(results_path),
+        **counts,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_per_s": round(counts["processed"] / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": {
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "p99": _percentile(latencies, 99),
+        },
+        "committed": db.batch_counts(batch_id),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Triage a JSONL or mbox export through the agent graph.")
+    parser.add_argument("input", type=Path)
+    parser.add_argument("--format", choices=["jsonl", "mbox"], default=None, help="Defaults to the file extension.")
+    parser.add_argument("--results", type=Path, default=None, help="Results JSONL (default: <input>.results.jsonl).")
+    parser.add_argument("--batch-id", default=None, help="Reuse to resume; defaults to a hash of the input path.")
+    parser.add_argument("--workers", type=int, default=config.BATCH_WORKERS)
+    parser.add_argument("--flush-items", type=int, default=config.BATCH_FLUSH_ITEMS)
+    parser.add_argument("--retry-errors", action="store_true", help="Re-run items that failed in a previous run.")
+    args = parser.parse_args()
+
+    db.init_db()
+    db.seed_dummy_products_if_empty()
+    results = args.results or args.input.with_name(args.input.name + ".results.jsonl")
+
+    def report(p: Dict[str, Any]) -> None:
+        print(json.dumps(p), file=sys.stderr)
+
+    summary = run_batch(
+        args.input, results, batch_id=args.batch_id, fmt=args.format, workers=args.workers,
+        flush_items=args.flush_items, retry_errors=args.retry_errors, progress=report,
+    )
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
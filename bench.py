@@ -0,0 +1,1525 @@
+import argparse
+import itertools
+import json
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+SAMPLE_EMAILS: List[Dict[str, str]] = [
+    {"subject": "Pricing for NimbusCRM Pro", "body": "Hi, is NimbusCRM Pro still available? Please send a quote for 25 seats."},
+    {"subject": "Need a CRM recommendation", "body": "We are a 10 person sales team and need a solution for pipelines and email tracking. What do you recommend?"},
+    {"subject": "Bundle discount", "body": "Can you offer a bundle with CRM and dashboards at the best price? Our budget is about $300/month."},
+    {"subject": "Login broken", "body": "Since this morning our users are unable to log in, the app shows error 500 in prod. This is urgent."},
+    {"subject": "Dashboard export failing", "body": "The KPI dashboard export failed twice with a timeout. Not sure if it is on our side."},
+    {"subject": "Question", "body": "Hello, I would like to know more about what you offer for our team."},
+]
+
+
+# Where each sample should end up with the fake backend's canned answers (None: no expectation).
+SAMPLE_ROUTES: Tuple[Optional[str], ...] = ("recommend", "recommend", "bundle", "support", "support", None)
+
+
+def _route(final: Dict[str, Any]) -> str:
+    sales = final.get("sales") or {}
+    if final.get("category") == "sales" and sales.get("recommendations"):
+        return "recommend"
+    if final.get("category") == "sales" and sales.get("bundles"):
+        return "bundle"
+    return final.get("category") or "unknown"
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return round(ordered[idx], 2)
+
+
+class LLMUsageCounter(BaseCallbackHandler):
+    def __init__(self) -> None:
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def on_chat_model_start(self, serialized: Any, messages: Any, **kwargs: Any) -> None:
+        self.calls += 1
+
+    def on_llm_end(self, response: Any, **kwargs: Any) -> None:
+        for gens in response.generations:
+            for gen in gens:
+                usage = getattr(getattr(gen, "message", None), "usage_metadata", None) or {}
+                self.prompt_tokens += int(usage.get("input_tokens", 0))
+                self.completion_tokens += int(usage.get("output_tokens", 0))
+
+
+def bench_fused(args: argparse.Namespace) -> Dict[str, Any]:
+    import config
+    from graph import build_graph, new_state
+
+    # The same sample emails repeat, so the near-duplicate check and the LLM cache would
+    # short-circuit most runs (and count no calls or tokens).
+    config.DEDUP_ENABLED = False
+    config.LLM_CACHE_ENABLED = False
+    emails = SAMPLE_EMAILS * args.repeat
+    report: Dict[str, Any] = {}
+    checks: Dict[str, bool] = {}
+    for mode, fused in (("two_call", False), ("fused", True)):
+        graph = build_graph(fused=fused)
+        calls: List[int] = []
+        tokens: List[int] = []
+        latencies: List[float] = []
+        routes: List[str] = []
+        errors = 0
+        for email in emails:
+            counter = LLMUsageCounter()
+            started = time.perf_counter()
+            try:
+                result = graph.invoke(new_state(uuid.uuid4().hex, dict(email), []), config={"callbacks": [counter]})
+            except Exception:
+                errors += 1
+                routes.append("error")
+                continue
+            routes.append(_route(result.get("final") or {}))
+            latencies.append((time.perf_counter() - started) * 1000)
+            calls.append(counter.calls)
+            tokens.append(counter.prompt_tokens + counter.completion_tokens)
+        report[mode] = {
+            "tickets": len(latencies),
+            "errors": errors,
+            "llm_calls_per_ticket": round(statistics.mean(calls), 2) if calls else None,
+            "tokens_per_ticket": round(statistics.mean(tokens), 1) if tokens else None,
+            "latency_ms": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95)},
+            "routes": routes[:len(SAMPLE_EMAILS)],
+        }
+        expected = SAMPLE_ROUTES * args.repeat
+        checks[f"{mode}_sales_samples_reach_recommend"] = all(
+            r == "recommend" for r, want in zip(routes, expected) if want == "recommend"
+        )
+        checks[f"{mode}_samples_routed_as_expected"] = all(
+            r == want for r, want in zip(routes, expected) if want is not None
+        )
+    report["checks"] = checks
+    report["ok"] = all(checks.values())
+    return report
+
+
+_WORDS = (
+    "crm pipeline leads email tracking analytics dashboards kpi reporting support ticketing sla helpdesk "
+    "automation rbac enterprise starter pro billing invoicing inventory warehouse hr payroll security "
+    "backup storage monitoring alerting chat voice marketing campaigns forms survey scheduling"
+).split()
+
+
+def _synthetic_products(n: int, seed: int = 7) -> List[Dict[str, Any]]:
+    # Keywords mix a few common domain words with a long tail, like a real catalog.
+    rnd = random.Random(seed)
+    tail = [f"{w}{i}" for i in range(max(50, n // 20)) for w in ("feat", "mod")]
+    out = []
+    for i in range(n):
+        words = rnd.sample(_WORDS, 3)
+        extra = rnd.sample(tail, 3)
+        out.append({
+            "sku": f"PROD-{words[0][:3].upper()}-{i:06d}",
+            "name": f"{words[0].title()}{words[1].title()} {extra[0].title()} {rnd.choice(['Starter', 'Pro', 'Enterprise'])}",
+            "category": words[0].title(),
+            "purpose": " ".join(words + extra[:1]),
+            "price_usd": round(rnd.uniform(9, 999), 2),
+            "is_active": 1 if rnd.random() > 0.1 else 0,
+            "keywords": " ".join(words + extra),
+        })
+    return out
+
+
+def _use_temp_db(name: str) -> Path:
+    import db
+
+    path = Path(tempfile.mkdtemp(prefix="bench-")) / name
+    db.DB_PATH = path
+    db.init_db()
+    return path
+
+
+def _insert_products(products: List[Dict[str, Any]]) -> None:
+    import db
+
+    conn = db.get_conn()
+    conn.executemany(
+        """
+        INSERT INTO products (sku, name, category, purpose, price_usd, is_active, keywords)
+        VALUES (:sku, :name, :category, :purpose, :price_usd, :is_active, :keywords)
+        """,
+        products,
+    )
+    conn.commit()
+
+
+def _like_mentions(mentions: List[str]) -> List[Dict[str, Any]]:
+    import db
+
+    conn = db.get_conn()
+    results: List[Dict[str, Any]] = []
+    for m in mentions:
+        like = f"%{m.strip()}%"
+        rows = conn.execute("SELECT * FROM products WHERE (sku LIKE ? OR name LIKE ?) LIMIT 10", (like, like)).fetchall()
+        results.extend(dict(r) for r in rows)
+    return list({r["sku"]: r for r in results}.values())
+
+
+def _like_keywords(keywords: List[str], limit: int = 10) -> List[Dict[str, Any]]:
+    import db
+
+    conn = db.get_conn()
+    where = " OR ".join(["keywords LIKE ?"] * len(keywords))
+    params = [f"%{k.strip()}%" for k in keywords]
+    return [dict(r) for r in conn.execute(f"SELECT * FROM products WHERE ({where}) LIMIT ?", (*params, limit)).fetchall()]
+
+
+def _time_ms(fn: Any, *args: Any, repeat: int = 20) -> float:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(samples), 3)
+
+
+def bench_products(args: argparse.Namespace) -> Dict[str, Any]:
+    import db
+
+    report: Dict[str, Any] = {}
+    mentions = ["Feat17 Pro", "PROD-ANA-000042", "zzz-missing"]
+    keywords = ["feat3", "mod11", "zzz-missing"]
+    # LIKE with LIMIT stops at the first 10 unranked hits; a miss forces a full scan.
+    missing = ["zzz-missing", "qqq"]
+    for n in args.sizes:
+        _use_temp_db(f"products-{n}.db")
+        _insert_products(_synthetic_products(n))
+        report[str(n)] = {
+            "mentions_like_ms": _time_ms(_like_mentions, mentions),
+            "mentions_fts_ms": _time_ms(db.search_products_by_exact_mention, mentions),
+            "keywords_like_ms": _time_ms(_like_keywords, keywords),
+            "keywords_fts_ms": _time_ms(db.search_products_by_need_keywords, keywords),
+            "keywords_miss_like_ms": _time_ms(_like_keywords, missing),
+            "keywords_miss_fts_ms": _time_ms(db.search_products_by_need_keywords, missing),
+        }
+    return report
+
+
+def _per_call_catalog() -> int:
+    import db
+
+    return len(json.dumps(db.get_active_products(), ensure_ascii=False))
+
+
+def _snapshot_catalog() -> int:
+    import catalog
+
+    return len(catalog.get_catalog().active_json)
+
+
+def bench_catalog(args: argparse.Namespace) -> Dict[str, Any]:
+    import catalog
+
+    report: Dict[str, Any] = {}
+    for n in args.sizes:
+        _use_temp_db(f"catalog-{n}.db")
+        _insert_products(_synthetic_products(n))
+        started = time.perf_counter()
+        catalog.reload_catalog()
+        report[str(n)] = {
+            "snapshot_build_ms": round((time.perf_counter() - started) * 1000, 3),
+            "per_call_query_and_dumps_ms": _time_ms(_per_call_catalog),
+            "snapshot_ms": _time_ms(_snapshot_catalog),
+        }
+    return report
+
+
+def _legacy_conn() -> sqlite3.Connection:
+    import db
+
+    # Pre-pooling behaviour: a fresh rollback-journal connection on every call.
+    conn = sqlite3.connect(db.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _db_worker(n_ops: int, ticket_ids: List[str], errors: List[str], latencies: List[float], write: bool) -> None:
+    import db
+
+    rnd = random.Random()
+    for i in range(n_ops):
+        started = time.perf_counter()
+        try:
+            if write:
+                db.create_sales_ticket(
+                    email_subject=f"Bench {i}",
+                    email_body="Please send a quote for 10 seats.",
+                    attachments=[],
+                    classification={"category": "sales", "intent": "product_inquiry", "confidence": 0.9},
+                )
+            else:
+                db.get_ticket(rnd.choice(ticket_ids))
+        except sqlite3.OperationalError as e:
+            errors.append(str(e))
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+    db.close_conn()
+
+
+def _db_round(workers: int, n_ops: int, ticket_ids: List[str], write: bool) -> Dict[str, Any]:
+    errors: List[str] = []
+    latencies: List[float] = []
+    threads = [
+        threading.Thread(target=_db_worker, args=(n_ops, ticket_ids, errors, latencies, write))
+        for _ in range(workers)
+    ]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return {
+        "ops_per_s": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p95_ms": percentile(latencies, 95),
+        "locked_errors": sum(1 for e in errors if "locked" in e),
+        "errors": len(errors),
+    }
+
+
+def bench_db(args: argparse.Namespace) -> Dict[str, Any]:
+    import db
+
+    pooled_get_conn = db.get_conn
+    report: Dict[str, Any] = {}
+    for mode in ("legacy", "pooled"):
+        db.get_conn = _legacy_conn if mode == "legacy" else pooled_get_conn
+        _use_temp_db(f"tickets-{mode}.db")
+        seed = [
+            db.create_sales_ticket(f"Seed {i}", "seed", [], {"category": "sales", "intent": "other"})
+            for i in range(200)
+        ]
+        db.close_conn()
+        report[mode] = {
+            str(w): {
+                "insert": _db_round(w, args.ops, seed, write=True),
+                "lookup": _db_round(w, args.ops, seed, write=False),
+            }
+            for w in args.workers
+        }
+    db.get_conn = pooled_get_conn
+    return report
+
+
+def _rss_mb() -> Optional[float]:
+    try:
+        with open("/proc/self/statm") as f:
+            import os
+
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024, 1)
+    except (OSError, ValueError):
+        return None
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class _ThreadSampler:
+    # Polls the live thread count while a load level runs.
+    def __init__(self, interval_s: float = 0.05) -> None:
+        self.interval_s = interval_s
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self) -> "_ThreadSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def _load_level(concurrency: int, runs: int, one: Any) -> Dict[str, Any]:
+    from concurrent.futures import ThreadPoolExecutor
+
+    latencies: List[float] = []
+    outcomes: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    def task(i: int) -> None:
+        started = time.perf_counter()
+        try:
+            outcome = one(i)
+        except Exception as e:
+            outcome = type(e).__name__
+        with lock:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if outcome == "ok":
+                latencies.append((time.perf_counter() - started) * 1000)
+
+    rss_before = _rss_mb()
+    started = time.perf_counter()
+    with _ThreadSampler() as sampler, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(task, range(runs)))
+    elapsed = time.perf_counter() - started
+    return {
+        "runs": runs,
+        "outcomes": outcomes,
+        "throughput_per_s": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency_ms": {p: percentile(latencies, n) for p, n in (("p50", 50), ("p95", 95), ("p99", 99))},
+        "rss_mb": {"before": rss_before, "after": _rss_mb(), "peak": _peak_rss_mb()},
+        "threads_peak": sampler.peak,
+    }
+
+
+def _graph_runner(graph: Any) -> Any:
+    from graph import new_state
+
+    def one(i: int) -> str:
+        email = dict(SAMPLE_EMAILS[i % len(SAMPLE_EMAILS)])
+        graph.invoke(new_state(uuid.uuid4().hex, email, []))
+        return "ok"
+
+    return one
+
+
+def _http_runner(client_factory: Any) -> Any:
+    local = threading.local()
+
+    def one(i: int) -> str:
+        if not hasattr(local, "client"):
+            local.client = client_factory()
+        email = SAMPLE_EMAILS[i % len(SAMPLE_EMAILS)]
+        # One tenant per request so the per-tenant cap does not mask the pool limits.
+        resp = local.client.post("/api/start", data={**email, "tenant": f"bench-{i}"})
+        if resp.status_code != 200:
+            return f"http_{resp.status_code}"
+        stream = local.client.get(f"/api/stream/{resp.get_json()['run_id']}")
+        body = stream.get_data(as_text=True)
+        return "ok" if "event: final" in body else "stream_error"
+
+    return one
+
+
+def bench_load(args: argparse.Namespace) -> Dict[str, Any]:
+    import config
+
+    # Everything runs against the fake backend; the cache is off so every run pays LLM latency.
+    config.LLM_PROVIDER = "fake"
+    config.LLM_CACHE_ENABLED = args.cache
+    config.FAKE_LLM_LATENCY_MS = args.latency_ms
+    config.FAKE_LLM_LATENCY_SIGMA = args.latency_sigma
+    config.FAKE_LLM_ERROR_RATE = args.error_rate
+    # Runs replay a handful of sample emails; with dedup on most would stop at the duplicate check.
+    config.DEDUP_ENABLED = False
+    if not args.rate_limit:
+        config.LLM_RATE_RPM = config.LLM_RATE_TPM = 0
+    _use_temp_db("load.db")
+    import db
+
+    db.seed_dummy_products_if_empty()
+
+    report: Dict[str, Any] = {"fake_llm": {
+        "latency_ms_median": args.latency_ms, "latency_sigma": args.latency_sigma, "error_rate": args.error_rate,
+    }}
+    if "graph" in args.targets:
+        from graph import build_graph
+        from llm_client import build_llm
+
+        one = _graph_runner(build_graph(llm=build_llm()))
+        report["graph"] = {str(c): _load_level(c, max(args.runs, c), one) for c in args.concurrency}
+    if "http" in args.targets:
+        import app as web
+
+        web.init_runtime()
+        one = _http_runner(web.app.test_client)
+        report["http"] = {
+            "worker_pool_size": config.WORKER_POOL_SIZE,
+            "queue_limit": config.WORKER_QUEUE_LIMIT,
+            **{str(c): _load_level(c, max(args.runs, c), one) for c in args.concurrency},
+        }
+    return report
+
+
+def _policy_calls(policy: Any, n: int, concurrency: int) -> Dict[str, Any]:
+    from concurrent.futures import ThreadPoolExecutor
+
+    from langchain_core.messages import HumanMessage
+
+    from llm_client import LLMRequest
+
+    latencies: List[float] = []
+    outcomes: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    def one(i: int) -> None:
+        request = LLMRequest(name="classify", messages=[HumanMessage(content=f"email {i}")])
+        started = time.perf_counter()
+        try:
+            policy.invoke(request)
+            outcome = "ok"
+        except Exception as e:
+            outcome = getattr(e, "code", type(e).__name__)
+        with lock:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if outcome == "ok":
+                latencies.append((time.perf_counter() - started) * 1000)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(n)))
+    return {
+        "outcomes": outcomes,
+        "latency_ms": {p: percentile(latencies, q) for p, q in (("p50", 50), ("p95", 95), ("p99", 99))},
+        "calls": policy.stats()["calls"].get("classify", {}),
+    }
+
+
+class _BadRequestLLM:
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def invoke(self, request: Any, **kwargs: Any) -> Any:
+        self.calls += 1
+        raise ValueError("400: invalid request")
+
+
+def bench_policy(args: argparse.Namespace) -> Dict[str, Any]:
+    import asyncio
+
+    import config
+    from fake_llm import FakeLLM
+    from langchain_core.messages import HumanMessage
+    from llm_client import LLMRequest
+    from llm_policy import CircuitBreaker, LLMCallFailed, ResilientLLM
+
+    _use_temp_db("policy.db")
+    config.LLM_BACKOFF_BASE_S = 0.01
+    config.LLM_BACKOFF_MAX_S = 0.05
+    off = CircuitBreaker("bench-off", threshold=0)
+    report: Dict[str, Any] = {}
+    checks: Dict[str, bool] = {}
+
+    # Transient failures: retries with backoff turn a 30% error rate into near-full success.
+    flaky = FakeLLM(latency_ms=5, latency_sigma=0.2, error_rate=0.3, seed=1)
+    report["retries"] = {
+        f"max_retries={r}": _policy_calls(ResilientLLM(flaky, breaker=off, max_retries=r, hedge=False), args.calls, 8)
+        for r in (0, 3)
+    }
+    ok_with_retries = report["retries"]["max_retries=3"]["outcomes"].get("ok", 0)
+    checks["retries_recover_transient_errors"] = ok_with_retries >= 0.97 * args.calls
+
+    # Non-retryable errors give up after one attempt, wrapped like any other failed call.
+    bad = _BadRequestLLM()
+    code = None
+    try:
+        ResilientLLM(bad, breaker=off, max_retries=3).invoke(LLMRequest(name="classify", messages=[HumanMessage(content="x")]))
+    except LLMCallFailed as e:
+        code = e.code
+    checks["client_errors_not_retried"] = bad.calls == 1 and code == "llm_failed"
+
+    # A hung backend is cut off at the per-call timeout on every attempt.
+    slow = FakeLLM(latency_ms=3000, latency_sigma=0.0, seed=2)
+    started = time.perf_counter()
+    code = None
+    try:
+        ResilientLLM(slow, breaker=off, timeout_s=0.2, max_retries=1).invoke(
+            LLMRequest(name="classify", messages=[HumanMessage(content="x")])
+        )
+    except LLMCallFailed as e:
+        code = e.code
+    elapsed = time.perf_counter() - started
+    report["timeout"] = {"code": code, "elapsed_s": round(elapsed, 3)}
+    checks["timeout_bounded"] = code == "llm_timeout" and elapsed < 1.0
+
+    # Heavy-tailed latency: a duplicate request after the observed p95 trims p99.
+    config.LLM_HEDGE_MIN_SAMPLES = 20
+    config.LLM_HEDGE_MIN_DELAY_S = 0.01
+    report["hedging"] = {}
+    for hedge in (False, True):
+        tail = FakeLLM(latency_ms=args.latency_ms, latency_sigma=1.0, seed=3)
+        policy = ResilientLLM(tail, breaker=off, max_retries=0, hedge=hedge)
+        report["hedging"]["on" if hedge else "off"] = _policy_calls(policy, args.calls, 8)
+    p99_off = report["hedging"]["off"]["latency_ms"]["p99"] or 0
+    p99_on = report["hedging"]["on"]["latency_ms"]["p99"] or 0
+    checks["hedging_cuts_p99"] = p99_on < p99_off
+    checks["hedge_wins_reported"] = report["hedging"]["on"]["calls"].get("hedge_wins", 0) > 0
+
+    async def async_hedged() -> Dict[str, int]:
+        policy = ResilientLLM(FakeLLM(latency_ms=20, latency_sigma=1.0, seed=4), breaker=off, max_retries=0, hedge=True)
+        await asyncio.gather(*[
+            policy.ainvoke(LLMRequest(name="classify", messages=[HumanMessage(content=f"a{i}")])) for i in range(100)
+        ])
+        return policy.stats()["calls"]["classify"]
+
+    report["async_hedging"] = asyncio.run(async_hedged())
+    checks["async_path"] = report["async_hedging"]["calls"] == 100
+
+    # Circuit breaker: consecutive failures open it for every worker sharing the database,
+    # calls fail fast while open, and one probe after the cooldown closes it again.
+    down = FakeLLM(latency_ms=1, latency_sigma=0.0, error_rate=1.0, seed=5)
+    breaker = CircuitBreaker("bench", threshold=5, cooldown_s=0.5)
+    policy = ResilientLLM(down, breaker=breaker, max_retries=0)
+    report["breaker"] = {"while_down": _policy_calls(policy, 20, 1)}
+    other_worker = CircuitBreaker("bench", threshold=5, cooldown_s=0.5)
+    try:
+        other_worker.before_call("classify")
+        shared = False
+    except LLMCallFailed as e:
+        shared = e.code == "llm_circuit_open"
+    time.sleep(0.6)
+    down.error_rate = 0.0
+    report["breaker"]["after_cooldown"] = _policy_calls(policy, 5, 1)
+    report["breaker"]["state"] = breaker.stats()
+    outcomes = report["breaker"]["while_down"]["outcomes"]
+    checks["breaker_opens_after_threshold"] = outcomes.get("llm_unavailable") == 5 and outcomes.get("llm_circuit_open") == 15
+    checks["breaker_shared_across_workers"] = shared
+    checks["breaker_recovers"] = report["breaker"]["state"]["state"] == "closed"
+
+    report["checks"] = checks
+    report["ok"] = all(checks.values())
+    return report
+
+
+def bench_policycheck(args: argparse.Namespace) -> Dict[str, Any]:
+    # Exact outcomes rather than rates: every fake backend here fails or stalls on every call.
+    import asyncio
+
+    import config
+    from fake_llm import FakeLLM
+    from langchain_core.messages import HumanMessage
+    from llm_client import LLMRequest
+    from llm_policy import CircuitBreaker, LLMCallFailed, ResilientLLM, _DeltaGate
+
+    _use_temp_db("policycheck.db")
+    config.LLM_BACKOFF_BASE_S = 0.001
+    config.LLM_BACKOFF_MAX_S = 0.001
+    off = CircuitBreaker("check-off", threshold=0)
+    report: Dict[str, Any] = {}
+    checks: Dict[str, bool] = {}
+
+    def request(on_delta: Any = None) -> LLMRequest:
+        return LLMRequest(name="classify", messages=[HumanMessage(content="x")], on_delta=on_delta)
+
+    def failure(fn: Any) -> Optional[LLMCallFailed]:
+        try:
+            fn()
+        except LLMCallFailed as e:
+            return e
+        return None
+
+    # Retries: a backend that always fails is called exactly max_retries + 1 times.
+    for retries in (0, 2):
+        down = FakeLLM(latency_ms=0, error_rate=1.0, seed=1)
+        policy = ResilientLLM(down, breaker=off, max_retries=retries, hedge=False)
+        e = failure(lambda: policy.invoke(request()))
+        report[f"retries_{retries}"] = {"backend_calls": down.calls, "code": e and e.code, "retries": e and e.retries}
+        checks[f"max_retries={retries}_calls_backend_{retries + 1}x"] = (
+            down.calls == retries + 1 and e is not None and e.code == "llm_unavailable" and e.retries == retries
+        )
+    up = FakeLLM(latency_ms=0, error_rate=0.0, seed=1)
+    msg = ResilientLLM(up, breaker=off, max_retries=2, hedge=False).invoke(request())
+    checks["success_not_retried"] = up.calls == 1 and msg.response_metadata["retries"] == 0
+    bad = _BadRequestLLM()
+    e = failure(lambda: ResilientLLM(bad, breaker=off, max_retries=2, hedge=False).invoke(request()))
+    report["client_error"] = {"backend_calls": bad.calls, "code": e and e.code}
+    checks["client_error_wrapped_not_retried"] = bad.calls == 1 and e is not None and e.code == "llm_failed"
+
+    # Deadline: a stalled attempt is abandoned at timeout_s, not when the backend answers.
+    for mode in ("sync", "async"):
+        slow = FakeLLM(latency_ms=2000, latency_sigma=0.0, seed=2)
+        policy = ResilientLLM(slow, breaker=off, timeout_s=0.1, max_retries=1, hedge=False)
+        started = time.perf_counter()
+        if mode == "sync":
+            e = failure(lambda: policy.invoke(request()))
+        else:
+            e = failure(lambda: asyncio.run(policy.ainvoke(request())))
+        elapsed = time.perf_counter() - started
+        report[f"deadline_{mode}"] = {"code": e and e.code, "elapsed_s": round(elapsed, 3), "backend_calls": slow.calls}
+        checks[f"deadline_abandons_{mode}"] = (
+            e is not None and e.code == "llm_timeout" and slow.calls == 2 and elapsed < 0.5
+        )
+
+    # Hedge: with seed 74 the first attempt draws ~675 ms and the duplicate ~24 ms, so the
+    # duplicate sent after the fixed 50 ms hedge delay answers first.
+    config.LLM_HEDGE_DELAY_S = 0.05
+    config.LLM_HEDGE_MIN_SAMPLES = 1000
+    for mode in ("sync", "async"):
+        tail = FakeLLM(latency_ms=100, latency_sigma=1.5, error_rate=0.0, seed=74)
+        policy = ResilientLLM(tail, breaker=off, timeout_s=2.0, max_retries=0, hedge=True)
+        started = time.perf_counter()
+        if mode == "sync":
+            msg = policy.invoke(request())
+        else:
+            msg = asyncio.run(policy.ainvoke(request()))
+        elapsed = time.perf_counter() - started
+        meta = msg.response_metadata
+        report[f"hedge_{mode}"] = {"elapsed_s": round(elapsed, 3), "backend_calls": tail.calls,
+                                   "hedged": meta["hedged"], "hedge_won": meta["hedge_won"]}
+        checks[f"hedge_wins_{mode}"] = (
+            tail.calls == 2 and meta["hedged"] and meta["hedge_won"] and elapsed < 0.4
+            and policy.stats()["calls"]["classify"]["hedge_wins"] == 1
+        )
+
+    # Delta gate: only the current attempt reaches the caller, and nothing does once the call is over.
+    seen: List[Any] = []
+    gate = _DeltaGate(seen.append)
+    first, second = gate.bind(request(), 0), gate.bind(request(), 1)
+    first.on_delta("stale")
+    second.on_delta("fresh")
+    gate.close()
+    second.on_delta("late")
+    checks["delta_gate_current_attempt_only"] = seen == ["fresh"]
+    # Both attempts stall past the deadline before their first chunk, then keep streaming in
+    # their abandoned threads: the caller sees each attempt's start marker and no text.
+    deltas: List[Any] = []
+    streaming = FakeLLM(latency_ms=600, latency_sigma=0.0, seed=3)
+    policy = ResilientLLM(streaming, breaker=off, timeout_s=0.1, max_retries=1, hedge=False)
+    e = failure(lambda: policy.invoke(request(deltas.append)))
+    time.sleep(0.8)
+    report["delta_gate"] = {"code": e and e.code, "deltas": deltas}
+    checks["abandoned_streams_suppressed"] = e is not None and e.code == "llm_timeout" and deltas == [None, None]
+
+    # Breaker: closed -> open at the threshold -> fail fast -> one half-open probe after the
+    # cooldown -> reopened by a failed probe -> closed by a successful one.
+    down = FakeLLM(latency_ms=0, error_rate=1.0, seed=4)
+    breaker = CircuitBreaker("check", threshold=3, cooldown_s=0.2)
+    policy = ResilientLLM(down, breaker=breaker, max_retries=0, hedge=False)
+    states: List[Tuple[str, str, int]] = []
+
+    def step(label: str) -> None:
+        e = failure(lambda: policy.invoke(request()))
+        states.append((label, e.code if e else "ok", down.calls))
+
+    for i in range(3):
+        step(f"failure_{i + 1}")
+    opened = breaker.stats()["state"]
+    step("while_open")
+    time.sleep(0.25)
+    step("failed_probe")
+    reopened = breaker.stats()["state"]
+    time.sleep(0.25)
+    probe_allowed = failure(lambda: breaker.before_call("classify")) is None
+    half_open = breaker.stats()["state"]
+    second_caller = failure(lambda: breaker.before_call("classify"))
+    down.error_rate = 0.0
+    time.sleep(0.25)
+    step("good_probe")
+    closed = breaker.stats()["state"]
+    report["breaker"] = {"steps": states, "states": [opened, reopened, half_open, closed]}
+    checks["breaker_opens_at_threshold"] = [s[1] for s in states[:3]] == ["llm_unavailable"] * 3 and opened == "open"
+    checks["breaker_fails_fast_while_open"] = states[3][1:] == ("llm_circuit_open", 3)
+    checks["breaker_failed_probe_reopens"] = states[4][1:] == ("llm_unavailable", 4) and reopened == "open"
+    checks["breaker_single_half_open_probe"] = (
+        probe_allowed and half_open == "half_open" and second_caller is not None
+        and second_caller.code == "llm_circuit_open"
+    )
+    checks["breaker_good_probe_closes"] = states[5][1:] == ("ok", 5) and closed == "closed"
+
+    report["checks"] = checks
+    report["ok"] = all(checks.values())
+    return report
+
+
+_RATE_CHILD = """
+import json, time
+from langchain_core.messages import HumanMessage
+from fake_llm import FakeLLM
+from llm_client import LLMRequest
+from rate_limit import RateLimitedLLM
+llm = RateLimitedLLM(FakeLLM(latency_ms=1, latency_sigma=0.0), rpm={rpm}, tpm=0)
+started = time.time()
+for i in range({calls}):
+    llm.invoke(LLMRequest(name="classify", messages=[HumanMessage(content=str(i))]))
+print(json.dumps({{"started": started, "finished": time.time()}}))
+"""
+
+
+def bench_ratelimit(args: argparse.Namespace) -> Dict[str, Any]:
+    import os
+    import subprocess
+    import sys
+
+    from langchain_core.messages import HumanMessage
+
+    import db
+    from fake_llm import FakeLLM
+    from llm_client import LLMRequest
+    from rate_limit import PRIORITY_BULK, PRIORITY_URGENT, RateLimitedLLM
+
+    db_path = _use_temp_db("runtime.db")
+    report: Dict[str, Any] = {"rpm": args.rpm}
+    checks: Dict[str, bool] = {}
+
+    # Bulk threads keep the bucket drained; urgent calls arriving meanwhile should jump the queue.
+    llm = RateLimitedLLM(FakeLLM(latency_ms=1, latency_sigma=0.0), rpm=args.rpm, tpm=0)
+    waits: Dict[int, List[float]] = {PRIORITY_URGENT: [], PRIORITY_BULK: []}
+    stop = threading.Event()
+    lock = threading.Lock()
+
+    polls = [0]
+    try_acquire = db.rate_try_acquire
+
+    def counted_try(*a: Any, **kw: Any) -> Any:
+        with lock:
+            polls[0] += 1
+        return try_acquire(*a, **kw)
+
+    db.rate_try_acquire = counted_try
+
+    def call(priority: int, i: int) -> None:
+        msg = llm.invoke(LLMRequest(name="classify", messages=[HumanMessage(content=f"{priority}-{i}")], priority=priority))
+        with lock:
+            waits[priority].append(msg.response_metadata["queue_wait_ms"])
+
+    def bulk() -> None:
+        i = 0
+        while not stop.is_set():
+            call(PRIORITY_BULK, i)
+            i += 1
+
+    bulk_threads = [threading.Thread(target=bulk, daemon=True) for _ in range(args.bulk_threads)]
+    for t in bulk_threads:
+        t.start()
+    # Let the bulk traffic use up the initial burst before measuring.
+    while len(waits[PRIORITY_BULK]) < args.rpm:
+        time.sleep(0.05)
+    with lock:
+        waits[PRIORITY_BULK].clear()
+        polls[0] = 0
+    for i in range(args.urgent_calls):
+        call(PRIORITY_URGENT, i)
+        time.sleep(0.1)
+    stop.set()
+    for t in bulk_threads:
+        t.join()
+    db.rate_try_acquire = try_acquire
+    report["queue_wait_ms"] = {
+        name: {"calls": len(waits[p]), "p50": percentile(waits[p], 50), "p95": percentile(waits[p], 95)}
+        for name, p in (("urgent", PRIORITY_URGENT), ("bulk", PRIORITY_BULK))
+    }
+    checks["urgent_jumps_bulk_queue"] = (
+        (percentile(waits[PRIORITY_URGENT], 95) or 0) < (percentile(waits[PRIORITY_BULK], 50) or 0)
+    )
+    # Queued waiters sleep until their estimated turn instead of re-taking the write lock
+    # every LLM_RATE_POLL_S: a handful of transactions per admitted call, not one per poll.
+    admitted = len(waits[PRIORITY_URGENT]) + len(waits[PRIORITY_BULK])
+    report["bucket_transactions_per_call"] = round(polls[0] / max(1, admitted), 2)
+    checks["queued_waiters_back_off"] = polls[0] <= 6 * admitted
+
+    # Several processes on one database share the bucket: after the burst, their combined
+    # rate stays at the configured limit.
+    db.close_conn()
+    os.remove(db_path)
+    db.init_db()
+    env = {**os.environ, "PYTHONPATH": str(Path(__file__).resolve().parent)}
+    per_child = args.rpm // 2 + args.cross_process_extra
+    script = _RATE_CHILD.format(rpm=args.rpm, calls=per_child)
+    procs = [
+        subprocess.Popen([sys.executable, "-c", script], cwd=db_path.parent, env=env, stdout=subprocess.PIPE, text=True)
+        for _ in range(2)
+    ]
+    spans = [json.loads(p.communicate()[0].strip().splitlines()[-1]) for p in procs]
+    elapsed = max(s["finished"] for s in spans) - min(s["started"] for s in spans)
+    beyond_burst = 2 * per_child - args.rpm
+    expected = beyond_burst / (args.rpm / 60.0)
+    report["cross_process"] = {
+        "processes": 2, "calls": 2 * per_child, "elapsed_s": round(elapsed, 2), "expected_min_s": round(expected, 2),
+    }
+    checks["shared_across_processes"] = elapsed >= expected * 0.9
+    report["checks"] = checks
+    report["ok"] = all(checks.values())
+    return report
+
+
+_STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+out = {{"import_ms": (time.perf_counter() - started) * 1000}}
+if {warm}:
+    import app
+    started = time.perf_counter()
+    app.warmup()
+    out["warmup_ms"] = (time.perf_counter() - started) * 1000
+    out["components"] = {{lz.name: lz.build_ms for lz in app.LAZY}}
+print(json.dumps(out))
+"""
+
+
+def _parse_importtime(stderr: str, top: int) -> List[Dict[str, Any]]:
+    # Lines look like "import time:  self [us] | cumulative | <indent>package".
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        # Only modules near the top of the tree; deeper ones are already inside their parent's total.
+        if depth <= 2:
+            rows.append({"module": name.strip(), "depth": depth, "cumulative_ms": round(int(cumulative) / 1000, 1),
+                         "self_ms": round(int(self_us) / 1000, 1)})
+    return sorted(rows, key=lambda r: -r["cumulative_ms"])[:top]
+
+
+def bench_startup(args: argparse.Namespace) -> Dict[str, Any]:
+    import os
+    import subprocess
+    import sys
+
+    root = str(Path(__file__).resolve().parent)
+    env = {**os.environ, "PYTHONPATH": root, "LLM_PROVIDER": "fake", "WARMUP": "lazy"}
+    report: Dict[str, Any] = {}
+    with tempfile.TemporaryDirectory(prefix="bench-startup-") as cwd:
+        for module in args.modules:
+            samples: List[Dict[str, Any]] = []
+            for i in range(args.repeat):
+                cmd = [sys.executable, "-c", _STARTUP_PROBE.format(module=module, warm=module == "app" and i > 0)]
+                if i == 0:
+                    cmd.insert(1, "-Ximporttime")
+                proc = subprocess.run(cmd, cwd=cwd, env=env, capture_output=True, text=True, check=True)
+                samples.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+                if i == 0:
+                    importtime = proc.stderr
+            # The -X importtime run is excluded from the timings; it only feeds the breakdown.
+            timed = samples[1:] or samples
+            entry: Dict[str, Any] = {
+                "import_ms_p50": round(statistics.median(s["import_ms"] for s in timed), 1),
+                "slowest_imports": _parse_importtime(importtime, args.top),
+            }
+            if "warmup_ms" in timed[0]:
+                entry["warmup_ms_p50"] = round(statistics.median(s["warmup_ms"] for s in timed), 1)
+                entry["components_ms"] = timed[-1]["components"]
+            report[module] = entry
+    return report
+
+
+def bench_retrieval(args: argparse.Namespace) -> Dict[str, Any]:
+    import catalog
+    import config
+    import product_index
+
+    report: Dict[str, Any] = {}
+    for n in args.sizes:
+        _use_temp_db(f"retrieval-{n}.db")
+        config.PRODUCT_INDEX_DIR = tempfile.mkdtemp(prefix="bench-index-")
+        _insert_products(_synthetic_products(n))
+        snapshot = catalog.reload_catalog()
+        started = time.perf_counter()
+        index = product_index.build_index(snapshot)
+        build_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        product_index.build_index(snapshot)
+        reopen_ms = (time.perf_counter() - started) * 1000
+
+        # Queries read like a customer naming two of a product's specific features and one general need.
+        rnd = random.Random(n)
+        hits = 0
+        latencies: List[float] = []
+        prompt_bytes: List[int] = []
+        for p in rnd.sample(list(snapshot.active), min(args.queries, len(snapshot.active))):
+            words = p["keywords"].split()
+            features = rnd.sample(words[3:], 2) + rnd.sample(words[:3], 1)
+            query = f"Hi, we are looking for something with {' and '.join(features)} for our team."
+            t0 = time.perf_counter()
+            top = index.search(query, args.k)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            hits += p["sku"] in {sku for sku, _ in top}
+            prompt_bytes.append(len(json.dumps([snapshot.by_sku[sku] for sku, _ in top], ensure_ascii=False)))
+        report[str(n)] = {
+            "active": len(snapshot.active),
+            "build_ms": round(build_ms, 1),
+            "reopen_mmap_ms": round(reopen_ms, 1),
+            "index_mb": round(sum(f.stat().st_size for f in Path(config.PRODUCT_INDEX_DIR).rglob("*.npy")) / 1e6, 1),
+            "query_ms": {"p50": percentile(latencies, 50), "p99": percentile(latencies, 99)},
+            f"hit_at_{args.k}": round(hits / len(latencies), 3),
+            "full_catalog_prompt_bytes": len(snapshot.active_json),
+            "top_k_prompt_bytes": int(statistics.mean(prompt_bytes)),
+        }
+    small, large = report[str(min(args.sizes))], report[str(max(args.sizes))]
+    report["checks"] = {
+        "prompt_size_constant": large["top_k_prompt_bytes"] <= 1.5 * small["top_k_prompt_bytes"],
+        "query_p99_under_50ms": large["query_ms"]["p99"] < 50,
+        "hit_rate_at_least_80pct": all(r[f"hit_at_{args.k}"] >= 0.8 for r in report.values()),
+    }
+    report["ok"] = all(report["checks"].values())
+    return report
+
+
+def _synthetic_email(rnd: random.Random, vocab: List[str]) -> Dict[str, str]:
+    words = [rnd.choice(vocab) for _ in range(rnd.randint(30, 120))]
+    return {"subject": " ".join(rnd.choice(vocab) for _ in range(4)), "body": " ".join(words)}
+
+
+def _resent(rnd: random.Random, email: Dict[str, str], edits: int, vocab: List[str]) -> Dict[str, str]:
+    # What a re-sent copy looks like: forwarded subject, a word or two changed, a quoted line appended.
+    words = email["body"].split()
+    for _ in range(edits):
+        words[rnd.randrange(len(words))] = rnd.choice(vocab)
+    return {"subject": f"Fwd: {email['subject']}", "body": " ".join(words) + "\n> On Monday someone wrote: thanks"}
+
+
+def _fill_fingerprints(rows: int, created_at: float, seed: int) -> None:
+    import dedup
+    import db
+
+    # Unrelated mail has effectively random signatures, so filler rows skip the shingling.
+    rnd = random.Random(seed)
+    size = len(dedup.signature("bench", " ".join(f"w{i}" for i in range(20))) or b"")
+    conn = db.get_conn()
+    for start in range(0, rows, 50000):
+        chunk = [(i + 1, f"FILL-{i}", rnd.randbytes(size)) for i in range(start, min(rows, start + 50000))]
+        conn.executemany(
+            "INSERT INTO email_fingerprints (id, ticket_id, signature, created_at) VALUES (?, ?, ?, ?)",
+            [(fid, tid, sig, created_at) for fid, tid, sig in chunk],
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO email_fingerprint_bands (band_key, fingerprint_id) VALUES (?, ?)",
+            sorted((key, fid) for fid, _, sig in chunk for key in dedup.band_keys(sig)),
+        )
+        conn.commit()
+
+
+def bench_dedup(args: argparse.Namespace) -> Dict[str, Any]:
+    import dedup
+    import db
+
+    rnd = random.Random(11)
+    vocab = [f"w{i}" for i in range(3000)]
+    base = [_synthetic_email(rnd, vocab) for _ in range(args.queries)]
+    report: Dict[str, Any] = {}
+    for n in args.sizes:
+        _use_temp_db(f"dedup-{n}.db")
+        now = time.time()
+        started = time.perf_counter()
+        _fill_fingerprints(max(0, n - len(base)), now, seed=n)
+        for email in base:
+            ticket_id = db.create_support_ticket(
+                email["subject"], email["body"], [], "other", 0.9,
+                {"category": "support", "intent": "other", "confidence": 0.9, "reasoning": "Synthetic benchmark mail."},
+            )
+            dedup.remember(ticket_id, dedup.signature(email["subject"], email["body"]), now)
+        fill_s = time.perf_counter() - started
+
+        sign_ms: List[float] = []
+        lookup_ms: List[float] = []
+        hits = 0
+        for email in base:
+            copy = _resent(rnd, email, args.edits, vocab)
+            t0 = time.perf_counter()
+            sig = dedup.signature(copy["subject"], copy["body"])
+            t1 = time.perf_counter()
+            hits += dedup.find_duplicate(sig, now) is not None
+            lookup_ms.append((time.perf_counter() - t1) * 1000)
+            sign_ms.append((t1 - t0) * 1000)
+        false_hits = 0
+        miss_ms: List[float] = []
+        for _ in range(args.queries):
+            fresh = _synthetic_email(rnd, vocab)
+            sig = dedup.signature(fresh["subject"], fresh["body"])
+            t1 = time.perf_counter()
+            false_hits += dedup.find_duplicate(sig, now) is not None
+            miss_ms.append((time.perf_counter() - t1) * 1000)
+        report[str(n)] = {
+            "fill_s": round(fill_s, 1),
+            "db_mb": round(db.DB_PATH.stat().st_size / 1e6, 1),
+            "signature_ms_p50": percentile(sign_ms, 50),
+            "lookup_hit_ms": {"p50": percentile(lookup_ms, 50), "p99": percentile(lookup_ms, 99)},
+            "lookup_miss_ms": {"p50": percentile(miss_ms, 50), "p99": percentile(miss_ms, 99)},
+            "recall": round(hits / len(base), 4),
+            "false_positives": false_hits,
+        }
+    largest = report[str(max(args.sizes))]
+    report["checks"] = {
+        "miss_lookup_sub_ms": largest["lookup_miss_ms"]["p99"] < 1.0,
+        "hit_lookup_sub_ms": largest["lookup_hit_ms"]["p50"] < 1.0,
+        "recall_at_least_95pct": largest["recall"] >= 0.95,
+        "no_false_positives": largest["false_positives"] == 0,
+    }
+    report["ok"] = all(report["checks"].values())
+    return report
+
+
+def _exhaustive_best(products: List[Dict[str, Any]], relevance: List[float], targets: Any,
+                     budget: Optional[float], max_items: int) -> float:
+    import bundler
+
+    best = 0.0
+    for size in range(1, max_items + 1):
+        for combo in itertools.combinations(range(len(products)), size):
+            total = sum(products[i]["price_usd"] for i in combo)
+            if budget is not None and total > budget:
+                continue
+            categories = [products[i]["category"] for i in combo]
+            state = bundler._State(combo, total, sum(relevance[i] for i in combo), frozenset(categories),
+                                   len(categories) - len(set(categories)))
+            best = max(best, state.value(targets))
+    return best
+
+
+def bench_bundles(args: argparse.Namespace) -> Dict[str, Any]:
+    import bundler
+    import catalog
+    import config
+
+    report: Dict[str, Any] = {}
+    for n in args.sizes:
+        _use_temp_db(f"bundles-{n}.db")
+        config.PRODUCT_INDEX_DIR = tempfile.mkdtemp(prefix="bench-index-")
+        _insert_products(_synthetic_products(n))
+        snapshot = catalog.reload_catalog()
+        bundler.build_bundles(snapshot, "warm up the index")
+
+        rnd = random.Random(n)
+        latencies: List[float] = []
+        bad_prices = bad_skus = over_budget = empty = 0
+        for p in rnd.sample(list(snapshot.active), min(args.queries, len(snapshot.active))):
+            words = p["keywords"].split()
+            budget = rnd.choice([None, 300.0, 1000.0, 2500.0])
+            query = f"We need {' and '.join(rnd.sample(words, 3))} for our team."
+            t0 = time.perf_counter()
+            bundles = bundler.build_bundles(snapshot, query, budget=budget)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            empty += not bundles
+            for b in bundles:
+                items = [snapshot.by_sku.get(sku) for sku in b["items"]]
+                if any(i is None or i["is_active"] != 1 for i in items):
+                    bad_skus += 1
+                    continue
+                bad_prices += abs(b["total_price_usd"] - round(sum(i["price_usd"] for i in items), 2)) > 1e-9
+                over_budget += budget is not None and b["total_price_usd"] > budget
+        report[str(n)] = {
+            "active": len(snapshot.active),
+            "optimizer_ms": {"p50": percentile(latencies, 50), "p99": percentile(latencies, 99)},
+            "empty_results": empty,
+            "unknown_or_inactive_skus": bad_skus,
+            "wrong_totals": bad_prices,
+            "over_budget": over_budget,
+        }
+
+    # Beam vs exhaustive search on candidate sets small enough to enumerate.
+    import product_index
+
+    snapshot = catalog.get_catalog()
+    index = product_index.get_index(snapshot)
+    rnd = random.Random(0)
+    ratios = []
+    for p in rnd.sample(list(snapshot.active), args.quality_queries):
+        query = " ".join(rnd.sample(p["keywords"].split(), 3))
+        ranked = [(snapshot.by_sku[sku], max(score, 0.0)) for sku, score in index.search(query, args.quality_candidates)]
+        products = [q for q, _ in ranked]
+        relevance = [score for _, score in ranked]
+        targets = bundler._target_categories(ranked, [])
+        budget = rnd.choice([None, 500.0, 1500.0])
+        optimum = _exhaustive_best(products, relevance, targets, budget, config.BUNDLE_MAX_ITEMS)
+        states = bundler.beam_search(products, relevance, targets, budget, config.BUNDLE_MAX_ITEMS,
+                                     config.BUNDLE_BEAM_WIDTH)
+        found = max([s.value(targets) for s in states] + [0.0])
+        ratios.append(found / optimum if optimum > 0 else 1.0)
+    report["beam_vs_exhaustive"] = {
+        "candidates": args.quality_candidates,
+        "mean_ratio": round(statistics.mean(ratios), 4),
+        "min_ratio": round(min(ratios), 4),
+    }
+
+    largest = report[str(max(args.sizes))]
+    report["checks"] = {
+        "exact_catalog_prices": all(report[str(n)]["wrong_totals"] == 0 for n in args.sizes),
+        "only_active_catalog_skus": all(report[str(n)]["unknown_or_inactive_skus"] == 0 for n in args.sizes),
+        "budgets_respected": all(report[str(n)]["over_budget"] == 0 for n in args.sizes),
+        "optimizer_p99_under_100ms": largest["optimizer_ms"]["p99"] < 100,
+        "beam_within_5pct_of_optimum": report["beam_vs_exhaustive"]["min_ratio"] >= 0.95,
+    }
+    report["ok"] = all(report["checks"].values())
+    return report
+
+
+def _fill_tickets(n: int, seed: int) -> None:
+    import db
+
+    rnd = random.Random(seed)
+    intents = ["specific_product_query", "requirement_to_product_suggestion", "best_price_offer_or_bundling",
+               "login_issue", "billing", "bug_report", "other"]
+    start = time.time() - n * 30
+    for chunk in range(0, n, 20000):
+        sales, support = [], []
+        for i in range(chunk, min(n, chunk + 20000)):
+            created_at = datetime.utcfromtimestamp(start + i * 30 + rnd.random()).isoformat()
+            # A few domain words plus a long tail, so a term matches a realistic share of mail.
+            words = " ".join([rnd.choice(_WORDS) for _ in range(5)] +
+                             [f"w{int(rnd.paretovariate(1.0) * 50) % 20000}" for _ in range(rnd.randint(20, 60))])
+            intent, confidence = rnd.choice(intents), round(rnd.random(), 3)
+            if rnd.random() < 0.5:
+                row = db.sales_ticket_row(f"Question {i}", words, [], {"category": "sales", "intent": intent,
+                                                                        "confidence": confidence})
+                sales.append(row)
+            else:
+                row = db.support_ticket_row(f"Issue {i}", words, [], intent, confidence, {})
+                support.append(row)
+            row["created_at"] = created_at
+        db.commit_batch("bench-tickets", sales, support, [])
+
+
+def _ticket_queries(deep: Tuple[str, str]) -> Dict[str, Dict[str, Any]]:
+    return {
+        "latest_page": {},
+        "intent_page": {"intent": "billing"},
+        "sales_intent_page": {"kind": "sales", "intent": "best_price_offer_or_bundling"},
+        "high_confidence_page": {"min_confidence": 0.95},
+        "text_search": {"text": "billing w500"},
+        "deep_keyset_page": {"before": deep},
+    }
+
+
+def _time_tickets(queries: Dict[str, Dict[str, Any]], limit: int, repeat: int) -> Dict[str, float]:
+    import db
+
+    return {name: _time_ms(lambda kw: list(db.search_tickets(limit=limit, **kw)), kw, repeat=repeat)
+            for name, kw in queries.items()}
+
+
+def bench_tickets(args: argparse.Namespace) -> Dict[str, Any]:
+    import db
+
+    report: Dict[str, Any] = {}
+    for n in args.sizes:
+        _use_temp_db(f"tickets-{n}.db")
+        _fill_tickets(n, seed=n)
+        conn = db.get_conn()
+        conn.execute("ANALYZE")
+        # The row ~90% of the way down the list: a deep page for keyset vs OFFSET.
+        offset = int(n * 0.9)
+        deep_row = conn.execute(
+            "SELECT created_at, ticket_id FROM tickets ORDER BY created_at DESC, ticket_id DESC LIMIT 1 OFFSET ?",
+            (offset - 1,),
+        ).fetchone()
+        queries = _ticket_queries((deep_row["created_at"], deep_row["ticket_id"]))
+        indexed = _time_tickets(queries, args.limit, args.repeat)
+        offset_ms = _time_ms(lambda: conn.execute(
+            "SELECT ticket_id, created_at FROM tickets ORDER BY created_at DESC, ticket_id DESC LIMIT ? OFFSET ?",
+            (args.limit, offset)).fetchall(), repeat=args.repeat)
+        first_row_ms = _time_ms(lambda: next(db.search_tickets(limit=args.max_page)), repeat=args.repeat)
+
+        # What the same queries cost on the old schema: no listing indexes, no FTS (text falls back to LIKE).
+        for suffix in ("created_at", "intent_created_at", "confidence"):
+            conn.execute(f"DROP INDEX idx_tickets_{suffix}")
+        conn.commit()
+        queries.pop("text_search")
+        unindexed = _time_tickets(queries, args.limit, max(1, args.repeat // 4))
+        unindexed["text_search"] = _time_ms(lambda: conn.execute(
+            "SELECT ticket_id, created_at FROM tickets WHERE email_body LIKE '%billing%' AND email_body LIKE '%w500 %' ORDER BY created_at DESC LIMIT ?",
+            (args.limit,)).fetchall(), repeat=max(1, args.repeat // 4))
+        report[str(n)] = {
+            "tickets": n,
+            "indexed_ms": indexed,
+            "unindexed_ms": unindexed,
+            "deep_offset_page_ms": offset_ms,
+            f"first_row_of_{args.max_page}_page_ms": first_row_ms,
+        }
+
+    largest = report[str(max(args.sizes))]
+    filtered = ("latest_page", "intent_page", "sales_intent_page", "deep_keyset_page")
+    report["checks"] = {
+        "filtered_pages_under_10ms": all(largest["indexed_ms"][q] < 10 for q in filtered),
+        "text_search_under_100ms": largest["indexed_ms"]["text_search"] < 100,
+        "keyset_10x_faster_than_offset": largest["indexed_ms"]["deep_keyset_page"] * 10 < largest["deep_offset_page_ms"],
+        "indexes_10x_faster_on_intent": largest["indexed_ms"]["intent_page"] * 10 < largest["unindexed_ms"]["intent_page"],
+    }
+    report["ok"] = all(report["checks"].values())
+    return report
+
+
+# The two per-kind ticket tables as they were before the unified `tickets` table, with
+# their listing indexes and FTS insert triggers, for before/after comparisons.
+_LEGACY_TICKET_SCHEMA = """
+CREATE TABLE sales_requests (
+    ticket_id TEXT PRIMARY KEY, created_at TEXT NOT NULL, customer_hint TEXT, email_subject TEXT,
+    email_body TEXT NOT NULL, attachments_json TEXT NOT NULL, classification_json TEXT NOT NULL
+);
+CREATE TABLE support_requests (
+    ticket_id TEXT PRIMARY KEY, created_at TEXT NOT NULL, customer_hint TEXT, email_subject TEXT,
+    email_body TEXT NOT NULL, attachments_json TEXT NOT NULL, intent TEXT NOT NULL, confidence REAL NOT NULL,
+    classification_json TEXT NOT NULL
+);
+CREATE INDEX idx_sales_requests_created_at ON sales_requests (created_at, ticket_id);
+CREATE INDEX idx_sales_requests_intent_created_at
+    ON sales_requests (json_extract(classification_json, '$.intent'), created_at, ticket_id);
+CREATE INDEX idx_sales_requests_confidence ON sales_requests (json_extract(classification_json, '$.confidence'));
+CREATE INDEX idx_support_requests_created_at ON support_requests (created_at, ticket_id);
+CREATE INDEX idx_support_requests_intent_created_at ON support_requests (intent, created_at, ticket_id);
+CREATE INDEX idx_support_requests_confidence ON support_requests (confidence);
+CREATE VIRTUAL TABLE sales_requests_fts USING fts5(
+    email_subject, email_body, content='sales_requests', content_rowid='rowid');
+CREATE VIRTUAL TABLE support_requests_fts USING fts5(
+    email_subject, email_body, content='support_requests', content_rowid='rowid');
+CREATE TRIGGER sales_requests_fts_ai AFTER INSERT ON sales_requests BEGIN
+    INSERT INTO sales_requests_fts (rowid, email_subject, email_body) VALUES (new.rowid, new.email_subject, new.email_body);
+END;
+CREATE TRIGGER support_requests_fts_ai AFTER INSERT ON support_requests BEGIN
+    INSERT INTO support_requests_fts (rowid, email_subject, email_body) VALUES (new.rowid, new.email_subject, new.email_body);
+END;
+"""
+_LEGACY_INSERT = {
+    "sales": "INSERT INTO sales_requests (ticket_id, created_at, customer_hint, email_subject, email_body, "
+             "attachments_json, classification_json) VALUES (:ticket_id, :created_at, :customer_hint, "
+             ":email_subject, :email_body, :attachments_json, :classification_json)",
+    "support": "INSERT INTO support_requests (ticket_id, created_at, customer_hint, email_subject, email_body, "
+               "attachments_json, intent, confidence, classification_json) VALUES (:ticket_id, :created_at, "
+               ":customer_hint, :email_subject, :email_body, :attachments_json, :intent, :confidence, "
+               ":classification_json)",
+}
+
+
+def _legacy_get_ticket(conn: sqlite3.Connection, ticket_id: str) -> Optional[Dict[str, Any]]:
+    # The old lookup: pick the table by prefix, otherwise try both in turn.
+    tables = {"SR-": ["sales_requests"], "SUP-": ["support_requests"]}.get(
+        ticket_id[:3] if ticket_id.startswith("SR-") else ticket_id[:4], ["sales_requests", "support_requests"])
+    for table in tables:
+        row = conn.execute(f"SELECT * FROM {table} WHERE ticket_id=?", (ticket_id,)).fetchone()
+        if row:
+            return dict(row)
+    return None
+
+
+def _ticket_rows(n: int, seed: int) -> List[Tuple[str, Dict[str, Any]]]:
+    import db
+
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n):
+        body = " ".join(rnd.choice(_WORDS) for _ in range(rnd.randint(20, 60)))
+        intent = rnd.choice(["login_issue", "billing", "bug_report", "best_price_offer_or_bundling", "other"])
+        if i % 2:
+            out.append(("sales", db.sales_ticket_row(f"Question {i}", body, [], {
+                "category": "sales", "intent": intent, "confidence": round(rnd.random(), 3)})))
+        else:
+            out.append(("support", db.support_ticket_row(f"Issue {i}", body, [], intent, round(rnd.random(), 3), {})))
+    return out
+
+
+def _insert_rate(insert: Any, rows: List[Tuple[str, Dict[str, Any]]]) -> float:
+    started = time.perf_counter()
+    for kind, row in rows:
+        insert(kind, row)
+    return round(len(rows) / (time.perf_counter() - started), 1)
+
+
+def bench_ticketdb(args: argparse.Namespace) -> Dict[str, Any]:
+    import db
+
+    report: Dict[str, Any] = {}
+    for n in args.sizes:
+        rows = _ticket_rows(n + args.inserts, seed=n)
+        base, extra = rows[:n], rows[n:]
+        path = _use_temp_db(f"ticketdb-{n}.db")
+        conn = db.get_conn()
+        conn.execute("DROP VIEW sales_requests")
+        conn.execute("DROP VIEW support_requests")
+        conn.executescript(_LEGACY_TICKET_SCHEMA)
+        for kind in ("sales", "support"):
+            conn.executemany(_LEGACY_INSERT[kind], [r for k, r in base if k == kind])
+        conn.commit()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+        rnd = random.Random(1)
+        known = [r["ticket_id"] for _, r in rnd.sample(base, min(1000, n))]
+        # IDs whose prefix says nothing: lower-cased input (a miss either way) and unknown IDs.
+        unprefixed = [t.lower() for t in known[:500]] + [f"TKT-{i:010d}" for i in range(500)]
+
+        def lookups(fn: Any, ids: List[str]) -> Dict[str, Optional[float]]:
+            samples = []
+            for ticket_id in ids:
+                t0 = time.perf_counter()
+                fn(ticket_id)
+                samples.append((time.perf_counter() - t0) * 1e6)
+            return {"p50": percentile(samples, 50), "p99": percentile(samples, 99)}
+
+        def legacy_insert(kind: str, row: Dict[str, Any]) -> None:
+            with conn:
+                conn.execute(_LEGACY_INSERT[kind], row)
+
+        by_intent_legacy = (
+            "SELECT intent, COUNT(*) FROM (SELECT json_extract(classification_json, '$.intent') AS intent "
+            "FROM sales_requests UNION ALL SELECT intent FROM support_requests) GROUP BY intent"
+        )
+        before = {
+            "lookup_prefixed_us": lookups(lambda t: _legacy_get_ticket(conn, t), known),
+            "lookup_unprefixed_us": lookups(lambda t: _legacy_get_ticket(conn, t), unprefixed),
+            "count_by_intent_ms": _time_ms(lambda: conn.execute(by_intent_legacy).fetchall(), repeat=5),
+            "single_insert_per_s": _insert_rate(legacy_insert, [(k, dict(r)) for k, r in extra[: args.inserts // 2]]),
+        }
+        def sample() -> Dict[str, Dict[str, Any]]:
+            return {r["ticket_id"]: dict(r) for table in ("sales_requests", "support_requests")
+                    for r in conn.execute(f"SELECT * FROM {table} ORDER BY ticket_id LIMIT 200")}
+
+        sample_before = sample()
+        totals_before = conn.execute(
+            "SELECT (SELECT COUNT(*) FROM sales_requests), (SELECT COUNT(*) FROM support_requests)").fetchone()
+
+        started = time.perf_counter()
+        db.init_db()
+        migrate_ms = (time.perf_counter() - started) * 1000
+        totals_after = conn.execute(
+            "SELECT (SELECT COUNT(*) FROM sales_requests), (SELECT COUNT(*) FROM support_requests)").fetchone()
+        sample_after = sample()
+
+        # Steady state after: a unified database built from the same rows, not one still
+        # carrying the migration's write-ahead log.
+        _use_temp_db(f"ticketdb-unified-{n}.db")
+        conn = db.get_conn()
+        conn.executemany(db.TICKET_INSERT, [r for _, r in base])
+        conn.commit()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+        def unified_insert(kind: str, row: Dict[str, Any]) -> None:
+            with conn:
+                conn.execute(db.TICKET_INSERT, row)
+
+        after = {
+            "lookup_prefixed_us": lookups(db.get_ticket, known),
+            "lookup_unprefixed_us": lookups(db.get_ticket, unprefixed),
+            "count_by_intent_ms": _time_ms(
+                lambda: conn.execute("SELECT intent, COUNT(*) FROM tickets GROUP BY intent").fetchall(), repeat=5),
+            "single_insert_per_s": _insert_rate(unified_insert, extra[args.inserts // 2:]),
+        }
+        report[str(n)] = {
+            "tickets": n,
+            "before": before,
+            "after": after,
+            "migrate_ms": round(migrate_ms, 1),
+            "migrated_counts_match": tuple(totals_before) == tuple(totals_after),
+            "migrated_rows_match": sample_before == sample_after,
+            "db_mb": round(path.stat().st_size / 1e6, 1),
+        }
+
+    largest = report[str(max(args.sizes))]
+    report["checks"] = {
+        "migration_lossless": all(report[str(n)]["migrated_counts_match"] and report[str(n)]["migrated_rows_match"]
+                                  for n in args.sizes),
+        "unprefixed_lookup_not_slower": largest["after"]["lookup_unprefixed_us"]["p50"]
+        <= largest["before"]["lookup_unprefixed_us"]["p50"],
+        "insert_within_25pct": largest["after"]["single_insert_per_s"] >= 0.75 * largest["before"]["single_insert_per_s"],
+    }
+    report["ok"] = all(report["checks"].values())
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks for the sales/support agent.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("fused", help="Compare two-call vs fused classification (calls, tokens, latency per ticket).")
+    p.add_argument("--repeat", type=int, default=1)
+    p.set_defaults(func=bench_fused)
+
+    p = sub.add_parser("products", help="LIKE scans vs the FTS5 product index at several catalog sizes.")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    p.set_defaults(func=bench_products)
+
+    p = sub.add_parser("catalog", help="Active-product prompt JSON per call vs the in-memory catalog snapshot.")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    p.set_defaults(func=bench_catalog)
+
+    p = sub.add_parser("db", help="Concurrent ticket insert/lookup throughput, per-call connections vs pooled WAL.")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 8, 32])
+    p.add_argument("--ops", type=int, default=200, help="Operations per worker thread.")
+    p.set_defaults(func=bench_db)
+
+    p = sub.add_parser("load", help="Throughput, latency, memory and threads at rising concurrency on the fake LLM.")
+    p.add_argument("--targets", nargs="+", choices=["graph", "http"], default=["graph", "http"])
+    p.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    p.add_argument("--runs", type=int, default=32, help="Runs per level (at least the concurrency).")
+    p.add_argument("--latency-ms", type=float, default=100.0, help="Median fake LLM latency.")
+    p.add_argument("--latency-sigma", type=float, default=0.5, help="Log-normal sigma; larger means a longer tail.")
+    p.add_argument("--error-rate", type=float, default=0.0)
+    p.add_argument("--cache", action="store_true", help="Keep the LLM cache on.")
+    p.add_argument("--rate-limit", action="store_true", help="Keep the client-side RPM/TPM limiter on.")
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("policy", help="Retry/timeout/hedging/circuit-breaker scenarios against the fake LLM, with checks.")
+    p.add_argument("--calls", type=int, default=300)
+    p.add_argument("--latency-ms", type=float, default=20.0, help="Median fake latency for the hedging scenario.")
+    p.set_defaults(func=bench_policy)
+
+    p = sub.add_parser("policycheck", help="Deterministic llm_policy checks: retry counts, deadlines, delta gate, breaker states.")
+    p.set_defaults(func=bench_policycheck)
+
+    p = sub.add_parser("ratelimit", help="Shared RPM bucket: urgent vs bulk queue waits and cross-process limits.")
+    p.add_argument("--rpm", type=int, default=600)
+    p.add_argument("--bulk-threads", type=int, default=8)
+    p.add_argument("--urgent-calls", type=int, default=20)
+    p.add_argument("--cross-process-extra", type=int, default=20, help="Calls per process beyond half the burst.")
+    p.set_defaults(func=bench_ratelimit)
+
+    p = sub.add_parser("startup", help="Import time (with a -X importtime breakdown) and warmup cost per entry point.")
+    p.add_argument("--modules", nargs="+", default=["app", "asgi", "batch", "graph"])
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--top", type=int, default=12)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("retrieval", help="Top-k product index vs full-catalog prompts: size, latency and hit rate.")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--k", type=int, default=10)
+    p.set_defaults(func=bench_retrieval)
+
+    p = sub.add_parser("dedup", help="Near-duplicate index: lookup latency, recall and false positives by index size.")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    p.add_argument("--queries", type=int, default=500, help="Re-sent copies (and fresh emails) looked up per size.")
+    p.add_argument("--edits", type=int, default=1, help="Words changed in each re-sent copy.")
+    p.set_defaults(func=bench_dedup)
+
+    p = sub.add_parser("bundles", help="Bundle optimizer: latency, exact prices, budgets and beam vs exhaustive search.")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--quality-queries", type=int, default=30)
+    p.add_argument("--quality-candidates", type=int, default=16, help="Candidate set size for the exhaustive search.")
+    p.set_defaults(func=bench_bundles)
+
+    p = sub.add_parser("tickets", help="Ticket listing/search: indexed keyset pages vs the unindexed tables and OFFSET.")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100000, 500000])
+    p.add_argument("--limit", type=int, default=50, help="Page size.")
+    p.add_argument("--max-page", type=int, default=1000, help="Page size for the time-to-first-row measurement.")
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_tickets)
+
+    p = sub.add_parser("ticketdb", help="Per-kind ticket tables vs the unified table: lookups, inserts, migration.")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10000, 200000])
+    p.add_argument("--inserts", type=int, default=2000, help="Single-row committed inserts, split before/after.")
+    p.set_defaults(func=bench_ticketdb)
+
+    args = parser.parse_args()
+    import db
+
+    db.init_db()
+    db.seed_dummy_products_if_empty()
+    report = args.func(args)
+    print(json.dumps(report, indent=2))
+    # Benches with checks double as gates: a failed check fails the command.
+    if report.get("ok") is False:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
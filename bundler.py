@@ -0,0 +1,185 @@
+import json
+import re
+from typing import Any, Dict, FrozenSet, List, Optional, Sequence, Tuple
+
+import catalog
+import config
+
+# Deterministic bundle builder: picks SKU combinations from the catalog with a beam
+# search over the products most relevant to the email, under the customer's budget
+# and rewarding coverage of the categories they need. Prices are the exact catalog
+# sums; the LLM (if used at all) only writes the one-line reasoning per bundle.
+
+_AMOUNT = r"\$?\s*(\d[\d,]*(?:\.\d+)?)\s*(k\b)?"
+_BUDGET_RES = (
+    re.compile(r"budget[^$\d.]{0,30}" + _AMOUNT, re.IGNORECASE),
+    # Without "budget" nearby, only dollar amounts count ("max 5 users" is not a budget).
+    re.compile(r"(?:under|below|max(?:imum)?|at most|up to|less than|no more than)\s*\$" + _AMOUNT, re.IGNORECASE),
+    re.compile(r"\$\s*(\d[\d,]*(?:\.\d+)?)\s*(k\b)?\s*(?:/|per)\s*(?:month|mo)\b", re.IGNORECASE),
+)
+
+# Weights of the bundle objective: relevance of each item, a bonus per needed category
+# covered, and a penalty per item that repeats a category already in the bundle.
+_COVER_WEIGHT = 0.5
+_REPEAT_PENALTY = 0.3
+
+
+def parse_budget(text: str) -> Optional[float]:
+    for pattern in _BUDGET_RES:
+        m = pattern.search(text or "")
+        if m:
+            value = float(m.group(1).replace(",", "")) * (1000 if m.group(2) else 1)
+            if value > 0:
+                return value
+    return None
+
+
+def _candidates(snapshot: catalog.CatalogSnapshot, query: str, limit: int) -> List[Tuple[Dict[str, Any], float]]:
+    if config.PRODUCT_INDEX_ENABLED:
+        import product_index
+
+        hits = product_index.get_index(snapshot).search(query, limit)
+        return [(snapshot.by_sku[sku], max(score, 0.0)) for sku, score in hits]
+    # Without the index there is no relevance signal; the cheapest products keep bundles affordable.
+    return [(p, 0.0) for p in snapshot.active[:limit]]
+
+
+def _target_categories(
+    ranked: Sequence[Tuple[Dict[str, Any], float]], mentioned: Sequence[Dict[str, Any]]
+) -> FrozenSet[str]:
+    # Categories of mentioned products, then those of the most relevant products.
+    targets = {p["category"] for p in mentioned}
+    for p, score in ranked:
+        if score <= 0 or len(targets) >= config.BUNDLE_MAX_CATEGORIES:
+            break
+        targets.add(p["category"])
+    return frozenset(targets)
+
+
+class _State:
+    __slots__ = ("items", "total", "relevance", "categories", "repeats")
+
+    def __init__(self, items: Tuple[int, ...], total: float, relevance: float, categories: FrozenSet[str], repeats: int):
+        self.items = items
+        self.total = total
+        self.relevance = relevance
+        self.categories = categories
+        self.repeats = repeats
+
+    def value(self, targets: FrozenSet[str]) -> float:
+        return self.relevance + _COVER_WEIGHT * len(self.categories & targets) - _REPEAT_PENALTY * self.repeats
+
+
+def beam_search(
+    products: Sequence[Dict[str, Any]],
+    relevance: Sequence[float],
+    targets: FrozenSet[str],
+    budget: Optional[float],
+    max_items: int,
+    beam_width: int,
+) -> List[_State]:
+    # Every state on the beam is a distinct SKU set within budget; each round extends
+    # the best `beam_width` of them by one product. All states seen are returned.
+    limit = float("inf") if budget is None else budget
+    beam = [
+        _State((i,), p["price_usd"], relevance[i], frozenset([p["category"]]), 0)
+        for i, p in enumerate(products) if p["price_usd"] <= limit
+    ]
+    beam.sort(key=lambda s: -s.value(targets))
+    beam = beam[:beam_width]
+    seen = {s.items for s in beam}
+    finished = list(beam)
+    for _ in range(max_items - 1):
+        grown: List[_State] = []
+        for state in beam:
+            for i, p in enumerate(products):
+                if i in state.items or state.total + p["price_usd"] > limit:
+                    continue
+                items = tuple(sorted(state.items + (i,)))
+                if items in seen:
+                    continue
+                seen.add(items)
+                repeat = p["category"] in state.categories
+                grown.append(_State(
+                    items, state.total + p["price_usd"], state.relevance + relevance[i],
+                    state.categories | {p["category"]}, state.repeats + repeat,
+                ))
+        if not grown:
+            break
+        grown.sort(key=lambda s: -s.value(targets))
+        beam = grown[:beam_width]
+        finished.extend(beam)
+    return finished
+
+
+def _pick(states: List[_State], targets: FrozenSet[str], count: int) -> List[_State]:
+    # Best first, skipping bundles that mostly repeat one already picked; multi-item bundles before singles.
+    ordered = sorted(states, key=lambda s: (len(s.items) == 1, -s.value(targets), s.total))
+    picked: List[_State] = []
+    for state in ordered:
+        items = set(state.items)
+        if all(len(items & set(p.items)) / len(items | set(p.items)) <= 0.5 for p in picked):
+            picked.append(state)
+            if len(picked) == count:
+                break
+    return picked
+
+
+def _template_reason(items: int, covered: Sequence[str], total: float, budget: Optional[float]) -> str:
+    reason = f"Covers {', '.join(covered)} with {items} product(s) at ${total:,.2f} from current catalog prices"
+    if budget is not None:
+        reason += f", within the ${budget:,.2f} budget"
+    return reason + "."
+
+
+def build_bundles(
+    snapshot: catalog.CatalogSnapshot,
+    query: str,
+    mentioned_skus: Sequence[str] = (),
+    budget: Optional[float] = None,
+    count: int = 5,
+) -> List[Dict[str, Any]]:
+    ranked = _candidates(snapshot, query, config.BUNDLE_CANDIDATES)
+    mentioned = [snapshot.by_sku[s] for s in mentioned_skus if s in snapshot.by_sku and snapshot.by_sku[s]["is_active"] == 1]
+    known = {p["sku"] for p, _ in ranked}
+    # Mentioned products are always candidates, ahead of anything the index ranked.
+    ranked = [(p, 1.0) for p in mentioned if p["sku"] not in known] + ranked
+    if not ranked:
+        return []
+    products = [p for p, _ in ranked]
+    relevance = [score for _, score in ranked]
+    targets = _target_categories(ranked, mentioned)
+    states = beam_search(products, relevance, targets, budget, config.BUNDLE_MAX_ITEMS, config.BUNDLE_BEAM_WIDTH)
+    picked = _pick(states, targets, count)
+    if not picked:
+        return []
+    best = max([s.value(targets) for s in picked] + [1e-9])
+    out = []
+    for state in picked:
+        items = [products[i] for i in state.items]
+        covered = sorted({p["category"] for p in items}, key=lambda c: (c not in targets, c))
+        total = round(sum(p["price_usd"] for p in items), 2)
+        out.append({
+            "name": f"{' + '.join(covered)} bundle",
+            "items": [p["sku"] for p in items],
+            "total_price_usd": total,
+            "score": round(min(1.0, max(0.0, state.value(targets) / best)), 2),
+            "reasoning": _template_reason(len(items), covered, total, budget),
+        })
+    out.sort(key=lambda b: b["total_price_usd"])
+    return out
+
+
+def apply_reasons(bundles: List[Dict[str, Any]], content: str) -> List[Dict[str, Any]]:
+    # The model only supplies text; anything missing or malformed keeps the template reason.
+    try:
+        reasons = json.loads(content).get("reasons") or []
+    except (ValueError, AttributeError):
+        return bundles
+    out = []
+    for i, b in enumerate(bundles):
+        reason = reasons[i] if i < len(reasons) else None
+        if isinstance(reason, str) and 10 <= len(reason.strip()) <= 800:
+            b = dict(b, reasoning=reason.strip())
+        out.append(b)
+    return out
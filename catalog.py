@@ -0,0 +1,76 @@
+import json
+import threading
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+import db
+
+# Process-wide, read-only view of the products table. Snapshots are rebuilt only when
+# catalog_meta.revision (bumped by triggers on products) moves past the cached one.
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    revision: int
+    products: Tuple[Dict[str, Any], ...]
+    by_sku: Mapping[str, Dict[str, Any]]
+    by_category: Mapping[str, Tuple[Dict[str, Any], ...]]
+    active: Tuple[Dict[str, Any], ...]
+    active_json: str
+
+    @property
+    def cache_key(self) -> str:
+        return f"catalog:{self.revision}"
+
+
+def build_snapshot(revision: int, rows: List[Dict[str, Any]]) -> CatalogSnapshot:
+    products = tuple(rows)
+    by_category: Dict[str, List[Dict[str, Any]]] = {}
+    for p in products:
+        by_category.setdefault(p["category"], []).append(p)
+    active = tuple(p for p in products if p["is_active"] == 1)
+    return CatalogSnapshot(
+        revision=revision,
+        products=products,
+        by_sku=MappingProxyType({p["sku"]: p for p in products}),
+        by_category=MappingProxyType({k: tuple(v) for k, v in by_category.items()}),
+        active=active,
+        active_json=json.dumps(list(active), ensure_ascii=False),
+    )
+
+
+_lock = threading.Lock()
+_snapshot: Optional[CatalogSnapshot] = None
+
+
+def get_catalog() -> CatalogSnapshot:
+    global _snapshot
+    current = _snapshot
+    if current is not None and current.revision == db.get_catalog_revision():
+        return current
+    with _lock:
+        if _snapshot is None or _snapshot.revision != db.get_catalog_revision():
+            _snapshot = build_snapshot(*db.get_products_snapshot())
+        return _snapshot
+
+
+def reload_catalog() -> CatalogSnapshot:
+    global _snapshot
+    with _lock:
+        _snapshot = build_snapshot(*db.get_products_snapshot())
+        return _snapshot
+
+
+def stats() -> Dict[str, Any]:
+    snap = _snapshot
+    if snap is None:
+        return {"loaded": False}
+    return {
+        "loaded": True,
+        "revision": snap.revision,
+        "products": len(snap.products),
+        "active": len(snap.active),
+        "categories": len(snap.by_category),
+        "active_json_bytes": len(snap.active_json.encode("utf-8")),
+    }
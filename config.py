@@ -0,0 +1,117 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def env_str(name: str, default: str) -> str:
+    v = os.getenv(name)
+    return v.strip() if v and v.strip() else default
+
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(env_str(name, str(default)))
+    except ValueError:
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(env_str(name, str(default)))
+    except ValueError:
+        return default
+
+
+def env_bool(name: str, default: bool) -> bool:
+    v = env_str(name, "1" if default else "0").lower()
+    return v in ("1", "true", "yes", "on")
+
+
+WORKER_POOL_SIZE = env_int("WORKER_POOL_SIZE", 8)
+WORKER_QUEUE_LIMIT = env_int("WORKER_QUEUE_LIMIT", 64)
+TENANT_MAX_INFLIGHT = env_int("TENANT_MAX_INFLIGHT", 16)
+ASYNC_MAX_INFLIGHT = env_int("ASYNC_MAX_INFLIGHT", 1000)
+FUSED_CLASSIFY = env_bool("FUSED_CLASSIFY", False)
+LLM_CACHE_ENABLED = env_bool("LLM_CACHE_ENABLED", True)
+LLM_CACHE_TTL_S = env_int("LLM_CACHE_TTL_S", 24 * 3600)
+LLM_CACHE_MEMORY_ITEMS = env_int("LLM_CACHE_MEMORY_ITEMS", 1024)
+LLM_CACHE_MAX_ROWS = env_int("LLM_CACHE_MAX_ROWS", 50000)
+PRECLASSIFIER_MODE = env_str("PRECLASSIFIER_MODE", "shadow").lower()
+PRECLASSIFIER_THRESHOLD = env_float("PRECLASSIFIER_THRESHOLD", 0.9)
+PRECLASSIFIER_USE_MODEL = env_bool("PRECLASSIFIER_USE_MODEL", True)
+PRECLASSIFIER_MIN_SAMPLES = env_int("PRECLASSIFIER_MIN_SAMPLES", 200)
+PRECLASSIFIER_SHADOW_RETENTION_S = env_int("PRECLASSIFIER_SHADOW_RETENTION_S", 30 * 24 * 3600)
+SQLITE_BUSY_TIMEOUT_MS = env_int("SQLITE_BUSY_TIMEOUT_MS", 5000)
+BATCH_WORKERS = env_int("BATCH_WORKERS", 8)
+BATCH_FLUSH_ITEMS = env_int("BATCH_FLUSH_ITEMS", 100)
+BATCH_DIR = env_str("BATCH_DIR", "batches")
+RUN_STORE_BACKEND = env_str("RUN_STORE_BACKEND", "sqlite").lower()
+RUN_STORE_POLL_S = env_float("RUN_STORE_POLL_S", 0.1)
+RUN_STORE_FINISHED_TTL_S = env_int("RUN_STORE_FINISHED_TTL_S", 15 * 60)
+RUN_STORE_ABANDONED_TTL_S = env_int("RUN_STORE_ABANDONED_TTL_S", 2 * 3600)
+RUN_STORE_GC_INTERVAL_S = env_int("RUN_STORE_GC_INTERVAL_S", 60)
+ATTACHMENT_SPOOL_DIR = env_str("ATTACHMENT_SPOOL_DIR", "spool")
+ATTACHMENT_CHUNK_BYTES = env_int("ATTACHMENT_CHUNK_BYTES", 1024 * 1024)
+ATTACHMENT_MAX_REQUEST_BYTES = env_int("ATTACHMENT_MAX_REQUEST_BYTES", 100 * 1024 * 1024)
+ATTACHMENT_SPOOL_MAX_BYTES = env_int("ATTACHMENT_SPOOL_MAX_BYTES", 10 * 1024 * 1024 * 1024)
+ATTACHMENT_BLOB_TTL_S = env_int("ATTACHMENT_BLOB_TTL_S", 24 * 3600)
+ATTACHMENT_SWEEP_INTERVAL_S = env_int("ATTACHMENT_SWEEP_INTERVAL_S", 300)
+EXTRACT_ENABLED = env_bool("EXTRACT_ENABLED", True)
+EXTRACT_WORKERS = env_int("EXTRACT_WORKERS", 2)
+EXTRACT_TIMEOUT_S = env_float("EXTRACT_TIMEOUT_S", 10.0)
+EXTRACT_MAX_MEMORY_MB = env_int("EXTRACT_MAX_MEMORY_MB", 512)
+EXTRACT_MAX_CHARS = env_int("EXTRACT_MAX_CHARS", 200000)
+EXTRACT_TOKEN_BUDGET = env_int("EXTRACT_TOKEN_BUDGET", 1500)
+LLM_PRICE_PROMPT_PER_1K = env_float("LLM_PRICE_PROMPT_PER_1K", 0.0025)
+LLM_PRICE_COMPLETION_PER_1K = env_float("LLM_PRICE_COMPLETION_PER_1K", 0.01)
+METRICS_SPAN_RETENTION_S = env_int("METRICS_SPAN_RETENTION_S", 7 * 24 * 3600)
+LLM_PROVIDER = env_str("LLM_PROVIDER", "openai").lower()
+LLM_RECORD_PATH = env_str("LLM_RECORD_PATH", "")
+FAKE_LLM_RECORDINGS = env_str("FAKE_LLM_RECORDINGS", "")
+FAKE_LLM_LATENCY_MS = env_float("FAKE_LLM_LATENCY_MS", 300.0)
+FAKE_LLM_LATENCY_SIGMA = env_float("FAKE_LLM_LATENCY_SIGMA", 0.5)
+FAKE_LLM_ERROR_RATE = env_float("FAKE_LLM_ERROR_RATE", 0.0)
+FAKE_LLM_SEED = env_int("FAKE_LLM_SEED", 7)
+# lazy: build the LLM client and graphs on first use; background/eager: build them from init_runtime.
+WARMUP = env_str("WARMUP", "background").lower()
+LLM_TIMEOUT_S = env_float("LLM_TIMEOUT_S", 60.0)
+LLM_MAX_RETRIES = env_int("LLM_MAX_RETRIES", 3)
+LLM_BACKOFF_BASE_S = env_float("LLM_BACKOFF_BASE_S", 0.5)
+LLM_BACKOFF_MAX_S = env_float("LLM_BACKOFF_MAX_S", 20.0)
+LLM_CALL_THREADS = env_int("LLM_CALL_THREADS", 64)
+LLM_HEDGE_ENABLED = env_bool("LLM_HEDGE_ENABLED", False)
+LLM_HEDGE_DELAY_S = env_float("LLM_HEDGE_DELAY_S", 5.0)
+LLM_HEDGE_MIN_DELAY_S = env_float("LLM_HEDGE_MIN_DELAY_S", 0.2)
+LLM_HEDGE_MIN_SAMPLES = env_int("LLM_HEDGE_MIN_SAMPLES", 20)
+LLM_BREAKER_FAILURES = env_int("LLM_BREAKER_FAILURES", 5)
+LLM_BREAKER_COOLDOWN_S = env_float("LLM_BREAKER_COOLDOWN_S", 30.0)
+LLM_BREAKER_REFRESH_S = env_float("LLM_BREAKER_REFRESH_S", 1.0)
+# Client-side quota shared by all workers (0 disables a limit); defaults are gpt-4o tier-1 limits.
+LLM_RATE_RPM = env_int("LLM_RATE_RPM", 500)
+LLM_RATE_TPM = env_int("LLM_RATE_TPM", 30000)
+LLM_RATE_COMPLETION_TOKENS = env_int("LLM_RATE_COMPLETION_TOKENS", 400)
+LLM_RATE_MAX_WAIT_S = env_float("LLM_RATE_MAX_WAIT_S", 120.0)
+LLM_RATE_POLL_S = env_float("LLM_RATE_POLL_S", 0.05)
+DEDUP_ENABLED = env_bool("DEDUP_ENABLED", True)
+# Estimated Jaccard similarity of word 3-shingles needed to treat two emails as the same.
+DEDUP_MIN_SIMILARITY = env_float("DEDUP_MIN_SIMILARITY", 0.7)
+DEDUP_WINDOW_S = env_int("DEDUP_WINDOW_S", 14 * 24 * 3600)
+DEDUP_MIN_TOKENS = env_int("DEDUP_MIN_TOKENS", 8)
+PRODUCT_INDEX_ENABLED = env_bool("PRODUCT_INDEX_ENABLED", True)
+# sentence-transformers model name for CPU embeddings; empty (or the package missing) means hashed TF-IDF.
+PRODUCT_INDEX_MODEL = env_str("PRODUCT_INDEX_MODEL", "")
+PRODUCT_INDEX_DIR = env_str("PRODUCT_INDEX_DIR", "product_index")
+PRODUCT_INDEX_TOP_K = env_int("PRODUCT_INDEX_TOP_K", 10)
+# llm: the model writes one line of reasoning per optimized bundle; template: no LLM call at all.
+BUNDLE_REASONING = env_str("BUNDLE_REASONING", "llm").lower()
+BUNDLE_CANDIDATES = env_int("BUNDLE_CANDIDATES", 40)
+# Hard cap on SKUs per bundle in the BundleOption schema; BUNDLE_MAX_ITEMS is clamped to it so the
+# search never builds a bundle that fails validation.
+BUNDLE_ITEMS_LIMIT = 6
+BUNDLE_MAX_ITEMS = min(max(1, env_int("BUNDLE_MAX_ITEMS", 4)), BUNDLE_ITEMS_LIMIT)
+BUNDLE_BEAM_WIDTH = env_int("BUNDLE_BEAM_WIDTH", 64)
+BUNDLE_MAX_CATEGORIES = env_int("BUNDLE_MAX_CATEGORIES", 3)
+TICKETS_PAGE_DEFAULT = env_int("TICKETS_PAGE_DEFAULT", 50)
+TICKETS_PAGE_MAX = env_int("TICKETS_PAGE_MAX", 1000)
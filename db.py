@@ -1,19 +1,50 @@
 import sqlite3
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Callable, Iterator, Optional, Tuple
 import json
+import re
+import threading
+import time
 import uuid
 from datetime import datetime
 
+import config
+
 DB_PATH = Path("runtime.db")
 
 
-def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
+_local = threading.local()
+
+
+def _connect(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=config.SQLITE_BUSY_TIMEOUT_MS / 1000.0, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA busy_timeout={int(config.SQLITE_BUSY_TIMEOUT_MS)}")
+    conn.execute("PRAGMA synchronous=NORMAL")
     return conn
 
 
+def get_conn() -> sqlite3.Connection:
+    # One long-lived connection per thread and database file: pragmas are applied once
+    # and sqlite3's per-connection statement cache is reused across calls.
+    conns: Dict[str, sqlite3.Connection] = getattr(_local, "conns", None) or {}
+    _local.conns = conns
+    key = str(DB_PATH)
+    conn = conns.get(key)
+    if conn is None:
+        conn = conns[key] = _connect(DB_PATH)
+    elif conn.in_transaction:
+        conn.rollback()
+    return conn
+
+
+def close_conn() -> None:
+    for conn in (getattr(_local, "conns", None) or {}).values():
+        conn.close()
+    _local.conns = {}
+
+
 def init_db() -> None:
     conn = get_conn()
     cur = conn.cursor()
@@ -32,38 +63,383 @@ def init_db() -> None:
         """
     )
 
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name='products_fts'")
+    fts_exists = cur.fetchone() is not None
     cur.execute(
         """
-        CREATE TABLE IF NOT EXISTS sales_requests (
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            sku, name, purpose, keywords,
+            content='products', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3 4'
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+            INSERT INTO products_fts (rowid, sku, name, purpose, keywords)
+            VALUES (new.rowid, new.sku, new.name, new.purpose, new.keywords);
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, sku, name, purpose, keywords)
+            VALUES ('delete', old.rowid, old.sku, old.name, old.purpose, old.keywords);
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE ON products BEGIN
+            INSERT INTO products_fts (products_fts, rowid, sku, name, purpose, keywords)
+            VALUES ('delete', old.rowid, old.sku, old.name, old.purpose, old.keywords);
+            INSERT INTO products_fts (rowid, sku, name, purpose, keywords)
+            VALUES (new.rowid, new.sku, new.name, new.purpose, new.keywords);
+        END
+        """
+    )
+    if not fts_exists:
+        cur.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+    # One table for both ticket kinds: a lookup is one primary-key probe whatever the ID.
+    # intent/confidence are columns for sales tickets too (taken from their classification).
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tickets (
             ticket_id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL CHECK (kind IN ('sales', 'support')),
             created_at TEXT NOT NULL,
             customer_hint TEXT,
             email_subject TEXT,
             email_body TEXT NOT NULL,
             attachments_json TEXT NOT NULL,
+            intent TEXT,
+            confidence REAL,
             classification_json TEXT NOT NULL
         )
         """
     )
+    _migrate_ticket_tables(conn)
 
+    # Listing indexes end in ticket_id, the keyset tie-break, so a page is one ordered index range.
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_created_at ON tickets (created_at, ticket_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_intent_created_at ON tickets (intent, created_at, ticket_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tickets_confidence ON tickets (confidence)")
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name='tickets_fts'")
+    fts_exists = cur.fetchone() is not None
     cur.execute(
         """
-        CREATE TABLE IF NOT EXISTS support_requests (
-            ticket_id TEXT PRIMARY KEY,
+        CREATE VIRTUAL TABLE IF NOT EXISTS tickets_fts USING fts5(
+            email_subject, email_body,
+            content='tickets', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS tickets_fts_ai AFTER INSERT ON tickets BEGIN
+            INSERT INTO tickets_fts (rowid, email_subject, email_body)
+            VALUES (new.rowid, new.email_subject, new.email_body);
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS tickets_fts_ad AFTER DELETE ON tickets BEGIN
+            INSERT INTO tickets_fts (tickets_fts, rowid, email_subject, email_body)
+            VALUES ('delete', old.rowid, old.email_subject, old.email_body);
+        END
+        """
+    )
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS tickets_fts_au AFTER UPDATE ON tickets BEGIN
+            INSERT INTO tickets_fts (tickets_fts, rowid, email_subject, email_body)
+            VALUES ('delete', old.rowid, old.email_subject, old.email_body);
+            INSERT INTO tickets_fts (rowid, email_subject, email_body)
+            VALUES (new.rowid, new.email_subject, new.email_body);
+        END
+        """
+    )
+    if not fts_exists:
+        cur.execute("INSERT INTO tickets_fts (tickets_fts) VALUES ('rebuild')")
+
+    # The old per-kind tables live on as read-only views with their original columns.
+    cur.execute(
+        """
+        CREATE VIEW IF NOT EXISTS sales_requests AS
+        SELECT ticket_id, created_at, customer_hint, email_subject, email_body, attachments_json, classification_json
+        FROM tickets WHERE kind = 'sales'
+        """
+    )
+    cur.execute(
+        """
+        CREATE VIEW IF NOT EXISTS support_requests AS
+        SELECT ticket_id, created_at, customer_hint, email_subject, email_body, attachments_json,
+               intent, confidence, classification_json
+        FROM tickets WHERE kind = 'support'
+        """
+    )
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS catalog_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            revision INTEGER NOT NULL
+        )
+        """
+    )
+    cur.execute("INSERT OR IGNORE INTO catalog_meta (id, revision) VALUES (1, 0)")
+    for op in ("INSERT", "UPDATE", "DELETE"):
+        cur.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS products_revision_{op.lower()} AFTER {op} ON products
+            BEGIN
+                UPDATE catalog_meta SET revision = revision + 1 WHERE id = 1;
+            END
+            """
+        )
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            cache_key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used_at)")
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS preclassifier_shadow (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id TEXT NOT NULL,
             created_at TEXT NOT NULL,
-            customer_hint TEXT,
-            email_subject TEXT,
-            email_body TEXT NOT NULL,
-            attachments_json TEXT NOT NULL,
-            intent TEXT NOT NULL,
-            confidence REAL NOT NULL,
-            classification_json TEXT NOT NULL
+            pre_category TEXT,
+            pre_intent TEXT,
+            pre_confidence REAL NOT NULL,
+            llm_category TEXT NOT NULL,
+            llm_intent TEXT NOT NULL
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_preclassifier_shadow_created_at ON preclassifier_shadow (created_at)")
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            finished_at REAL
         )
         """
     )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_runs_finished_at ON runs (finished_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_runs_updated_at ON runs (updated_at)")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS run_events (
+            run_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            payload_json TEXT NOT NULL,
+            PRIMARY KEY (run_id, seq)
+        ) WITHOUT ROWID
+        """
+    )
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS run_spans (
+            run_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            duration_ms REAL NOT NULL,
+            attrs_json TEXT NOT NULL,
+            PRIMARY KEY (run_id, seq)
+        ) WITHOUT ROWID
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_run_spans_started_at ON run_spans (started_at)")
 
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS attachment_blobs (
+            sha256 TEXT PRIMARY KEY,
+            size_bytes INTEGER NOT NULL,
+            refs INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_attachment_blobs_last_used_at ON attachment_blobs (last_used_at)")
+    # One row per run holding a blob; attachment_blobs.refs is the number of holders.
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS attachment_holds (
+            run_id TEXT NOT NULL,
+            sha256 TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (run_id, sha256)
+        ) WITHOUT ROWID
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_attachment_holds_created_at ON attachment_holds (created_at)")
+    # Older trees only ever incremented refs; holds are the source of truth.
+    cur.execute(
+        """
+        UPDATE attachment_blobs
+        SET refs = (SELECT COUNT(*) FROM attachment_holds h WHERE h.sha256 = attachment_blobs.sha256)
+        WHERE refs != (SELECT COUNT(*) FROM attachment_holds h WHERE h.sha256 = attachment_blobs.sha256)
+        """
+    )
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS attachment_text (
+            sha256 TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            text TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (sha256, version)
+        )
+        """
+    )
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS batch_items (
+            batch_id TEXT NOT NULL,
+            item_key TEXT NOT NULL,
+            status TEXT NOT NULL,
+            ticket_id TEXT,
+            latency_ms REAL,
+            result_json TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (batch_id, item_key)
+        )
+        """
+    )
+
+    # LLM circuit breaker, shared by every worker process on this database.
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS llm_circuit (
+            name TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            failures INTEGER NOT NULL,
+            opened_until REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+
+    # Shared LLM quota: one token bucket per limit (rpm/tpm) plus the queue of waiting calls.
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS llm_rate_buckets (
+            name TEXT PRIMARY KEY,
+            level REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS llm_rate_waiters (
+            waiter_id TEXT PRIMARY KEY,
+            priority INTEGER NOT NULL,
+            enqueued_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """
+    )
+
+    # Near-duplicate index: a MinHash signature per ticketed email plus one row per LSH band,
+    # so candidate lookup is a handful of primary-key probes. Bands reference the integer id to stay small.
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS email_fingerprints (
+            id INTEGER PRIMARY KEY,
+            ticket_id TEXT NOT NULL UNIQUE,
+            signature BLOB NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_email_fingerprints_created_at ON email_fingerprints (created_at)")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS email_fingerprint_bands (
+            band_key INTEGER NOT NULL,
+            fingerprint_id INTEGER NOT NULL,
+            PRIMARY KEY (band_key, fingerprint_id)
+        ) WITHOUT ROWID
+        """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_email_fingerprint_bands_fingerprint_id ON email_fingerprint_bands (fingerprint_id)"
+    )
+
+    conn.commit()
+
+
+def _migrate_ticket_tables(conn: sqlite3.Connection) -> None:
+    # Moves rows out of the pre-unification sales_requests/support_requests tables (with
+    # their FTS tables, indexes and triggers) in one transaction. The existence check is
+    # repeated under the write lock, so concurrent starts migrate once.
+    legacy_sql = "SELECT name FROM sqlite_master WHERE type='table' AND name IN ('sales_requests', 'support_requests')"
+    if not conn.execute(legacy_sql).fetchall():
+        return
     conn.commit()
-    conn.close()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        legacy = {r["name"] for r in conn.execute(legacy_sql)}
+        if "sales_requests" in legacy:
+            conn.execute(
+                """
+                INSERT OR IGNORE INTO tickets (
+                    ticket_id, kind, created_at, customer_hint, email_subject, email_body, attachments_json,
+                    intent, confidence, classification_json
+                )
+                SELECT ticket_id, 'sales', created_at, customer_hint, email_subject, email_body, attachments_json,
+                       json_extract(classification_json, '$.intent'), json_extract(classification_json, '$.confidence'),
+                       classification_json
+                FROM sales_requests
+                """
+            )
+        if "support_requests" in legacy:
+            conn.execute(
+                """
+                INSERT OR IGNORE INTO tickets (
+                    ticket_id, kind, created_at, customer_hint, email_subject, email_body, attachments_json,
+                    intent, confidence, classification_json
+                )
+                SELECT ticket_id, 'support', created_at, customer_hint, email_subject, email_body, attachments_json,
+                       intent, confidence, classification_json
+                FROM support_requests
+                """
+            )
+        for table in legacy:
+            conn.execute(f"DROP TABLE IF EXISTS {table}_fts")
+            conn.execute(f"DROP TABLE {table}")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
 
 
 def seed_dummy_products_if_empty() -> None:
@@ -72,7 +448,6 @@ def seed_dummy_products_if_empty() -> None:
     cur.execute("SELECT COUNT(*) as c FROM products")
     c = cur.fetchone()["c"]
     if c > 0:
-        conn.close()
         return
 
     products = [
@@ -132,7 +507,63 @@ def seed_dummy_products_if_empty() -> None:
     )
 
     conn.commit()
-    conn.close()
+
+
+TICKET_INSERT = """
+    INSERT INTO tickets (
+        ticket_id, kind, created_at, customer_hint, email_subject, email_body, attachments_json,
+        intent, confidence, classification_json
+    )
+    VALUES (
+        :ticket_id, :kind, :created_at, :customer_hint, :email_subject, :email_body, :attachments_json,
+        :intent, :confidence, :classification_json
+    )
+"""
+
+
+def sales_ticket_row(
+    email_subject: str,
+    email_body: str,
+    attachments: List[Dict[str, Any]],
+    classification: Dict[str, Any],
+    customer_hint: Optional[str] = None,
+) -> Dict[str, Any]:
+    confidence = classification.get("confidence")
+    return {
+        "ticket_id": f"SR-{uuid.uuid4().hex[:10].upper()}",
+        "kind": "sales",
+        "created_at": datetime.utcnow().isoformat(),
+        "customer_hint": customer_hint,
+        "email_subject": email_subject,
+        "email_body": email_body,
+        "attachments_json": json.dumps(attachments, ensure_ascii=False),
+        "intent": classification.get("intent"),
+        "confidence": float(confidence) if confidence is not None else None,
+        "classification_json": json.dumps(classification, ensure_ascii=False),
+    }
+
+
+def support_ticket_row(
+    email_subject: str,
+    email_body: str,
+    attachments: List[Dict[str, Any]],
+    intent: str,
+    confidence: float,
+    classification: Dict[str, Any],
+    customer_hint: Optional[str] = None,
+) -> Dict[str, Any]:
+    return {
+        "ticket_id": f"SUP-{uuid.uuid4().hex[:10].upper()}",
+        "kind": "support",
+        "created_at": datetime.utcnow().isoformat(),
+        "customer_hint": customer_hint,
+        "email_subject": email_subject,
+        "email_body": email_body,
+        "attachments_json": json.dumps(attachments, ensure_ascii=False),
+        "intent": intent,
+        "confidence": float(confidence),
+        "classification_json": json.dumps(classification, ensure_ascii=False),
+    }
 
 
 def create_sales_ticket(
@@ -142,27 +573,10 @@ def create_sales_ticket(
     classification: Dict[str, Any],
     customer_hint: Optional[str] = None,
 ) -> str:
-    conn = get_conn()
-    cur = conn.cursor()
-    ticket_id = f"SR-{uuid.uuid4().hex[:10].upper()}"
-    cur.execute(
-        """
-        INSERT INTO sales_requests (ticket_id, created_at, customer_hint, email_subject, email_body, attachments_json, classification_json)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            ticket_id,
-            datetime.utcnow().isoformat(),
-            customer_hint,
-            email_subject,
-            email_body,
-            json.dumps(attachments, ensure_ascii=False),
-            json.dumps(classification, ensure_ascii=False),
-        ),
-    )
-    conn.commit()
-    conn.close()
-    return ticket_id
+    row = sales_ticket_row(email_subject, email_body, attachments, classification, customer_hint)
+    with get_conn() as conn:
+        conn.execute(TICKET_INSERT, row)
+    return row["ticket_id"]
 
 
 def create_support_ticket(
@@ -174,114 +588,698 @@ def create_support_ticket(
     classification: Dict[str, Any],
     customer_hint: Optional[str] = None,
 ) -> str:
+    row = support_ticket_row(email_subject, email_body, attachments, intent, confidence, classification, customer_hint)
+    with get_conn() as conn:
+        conn.execute(TICKET_INSERT, row)
+    return row["ticket_id"]
+
+
+def commit_batch(
+    batch_id: str,
+    sales_rows: List[Dict[str, Any]],
+    support_rows: List[Dict[str, Any]],
+    items: List[Dict[str, Any]],
+) -> None:
+    # Tickets and their batch_items markers commit together, so a resumed batch never
+    # re-creates a ticket for an item that was already written.
+    now = datetime.utcnow().isoformat()
+    with get_conn() as conn:
+        if sales_rows or support_rows:
+            conn.executemany(TICKET_INSERT, [*sales_rows, *support_rows])
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO batch_items (batch_id, item_key, status, ticket_id, latency_ms, result_json, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (batch_id, it["key"], it["status"], it.get("ticket_id"), it.get("latency_ms"),
+                 json.dumps(it, ensure_ascii=False), now)
+                for it in items
+            ],
+        )
+
+
+def get_batch_item_statuses(batch_id: str) -> Dict[str, str]:
+    conn = get_conn()
+    rows = conn.execute("SELECT item_key, status FROM batch_items WHERE batch_id=?", (batch_id,)).fetchall()
+    return {r["item_key"]: r["status"] for r in rows}
+
+
+def iter_batch_results(batch_id: str, include_errors: bool = True) -> Iterator[Dict[str, Any]]:
+    conn = get_conn()
+    sql = "SELECT result_json FROM batch_items WHERE batch_id=?"
+    if not include_errors:
+        sql += " AND status != 'error'"
+    for r in conn.execute(sql + " ORDER BY updated_at, item_key", (batch_id,)).fetchall():
+        yield json.loads(r["result_json"])
+
+
+def batch_counts(batch_id: str) -> Dict[str, int]:
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT status, COUNT(*) AS n FROM batch_items WHERE batch_id=? GROUP BY status", (batch_id,)
+    ).fetchall()
+    return {r["status"]: int(r["n"]) for r in rows}
+
+
+def get_ticket(ticket_id: str) -> Optional[Dict[str, Any]]:
+    row = get_conn().execute("SELECT * FROM tickets WHERE ticket_id=?", (ticket_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def search_tickets(
+    kind: Optional[str] = None,
+    intent: Optional[str] = None,
+    min_confidence: Optional[float] = None,
+    max_confidence: Optional[float] = None,
+    text: Optional[str] = None,
+    created_from: Optional[str] = None,
+    created_to: Optional[str] = None,
+    before: Optional[Tuple[str, str]] = None,
+    limit: int = 50,
+) -> Iterator[Dict[str, Any]]:
+    # Newest first. `before` is the (created_at, ticket_id) of the last row of the previous
+    # page, so every page is an index range rather than an OFFSET scan. Rows are yielded
+    # as SQLite steps the statement.
+    phrases = _fts_terms(re.findall(r"\w+", text or ""), prefix=False)
+    if text and not phrases:
+        return
+    where: List[str] = []
+    params: List[Any] = []
+    source = "tickets"
+    if phrases:
+        source = "tickets_fts JOIN tickets ON tickets.rowid = tickets_fts.rowid"
+        where.append("tickets_fts MATCH ?")
+        params.append(" ".join(phrases))
+    for clause, value in (
+        ("kind = ?", kind),
+        ("intent = ?", intent),
+        ("confidence >= ?", min_confidence),
+        ("confidence <= ?", max_confidence),
+        ("created_at >= ?", created_from),
+        ("created_at < ?", created_to),
+    ):
+        if value is not None:
+            where.append(clause)
+            params.append(value)
+    if before is not None:
+        where.append("created_at <= ? AND (created_at < ? OR ticket_id < ?)")
+        params.extend([before[0], before[0], before[1]])
+    sql = f"""
+        SELECT ticket_id, kind, created_at, customer_hint, tickets.email_subject, intent, confidence
+        FROM {source}
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY created_at DESC, ticket_id DESC
+        LIMIT ?
+    """
+    for row in get_conn().execute(sql, (*params, limit)):
+        yield dict(row)
+
+
+def _fts_terms(terms: List[str], prefix: bool) -> List[str]:
+    out = []
+    for t in terms:
+        tokens = re.findall(r"\w+", (t or "").lower())
+        if tokens:
+            out.append('"' + " ".join(tokens) + '"' + ("*" if prefix else ""))
+    return out
+
+
+def _search_products_fts(
+    columns: str, terms: List[str], limit: int, prefix: bool, ranked: bool = True
+) -> List[Dict[str, Any]]:
+    phrases = _fts_terms(terms, prefix)
+    if not phrases:
+        return []
     conn = get_conn()
     cur = conn.cursor()
-    ticket_id = f"SUP-{uuid.uuid4().hex[:10].upper()}"
+    order = "ORDER BY bm25(products_fts)" if ranked else ""
     cur.execute(
-        """
-        INSERT INTO support_requests (
-            ticket_id, created_at, customer_hint, email_subject, email_body, attachments_json,
-            intent, confidence, classification_json
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        f"""
+        SELECT p.* FROM products_fts
+        JOIN products p ON p.rowid = products_fts.rowid
+        WHERE products_fts MATCH ?
+        {order}
+        LIMIT ?
         """,
-        (
-            ticket_id,
-            datetime.utcnow().isoformat(),
-            customer_hint,
-            email_subject,
-            email_body,
-            json.dumps(attachments, ensure_ascii=False),
-            intent,
-            float(confidence),
-            json.dumps(classification, ensure_ascii=False),
-        ),
+        (f"{columns} : ({' OR '.join(phrases)})", limit),
     )
-    conn.commit()
-    conn.close()
-    return ticket_id
+    rows = [dict(r) for r in cur.fetchall()]
+    return rows
 
 
-def get_ticket(ticket_id: str) -> Optional[Dict[str, Any]]:
+def search_products_by_exact_mention(mentions: List[str]) -> List[Dict[str, Any]]:
+    # One BM25-ranked FTS query for all mentions (token-prefix match on sku/name).
+    return _search_products_fts("{sku name}", mentions, limit=10 * max(1, len(mentions)), prefix=True)
+
+
+def search_products_by_need_keywords(keywords: List[str], limit: int = 10) -> List[Dict[str, Any]]:
+    rows = _search_products_fts("keywords", keywords, limit=limit, prefix=False)
+    if len(rows) < limit:
+        # Top up with prefix phrases, so "track" still finds "tracking" as the old substring
+        # LIKE did (only matches starting mid-word are lost). Unranked: a short prefix can
+        # match much of the catalog, and ranking would have to score all of it.
+        seen = {r["sku"] for r in rows}
+        more = _search_products_fts("keywords", keywords, limit=limit + len(rows), prefix=True, ranked=False)
+        rows += [r for r in more if r["sku"] not in seen][: limit - len(rows)]
+    return rows
+
+
+def get_active_products() -> List[Dict[str, Any]]:
     conn = get_conn()
     cur = conn.cursor()
+    cur.execute("SELECT * FROM products WHERE is_active=1 ORDER BY price_usd ASC")
+    rows = [dict(r) for r in cur.fetchall()]
+    return rows
 
-    if ticket_id.startswith("SR-"):
-        cur.execute("SELECT * FROM sales_requests WHERE ticket_id=?", (ticket_id,))
-        row = cur.fetchone()
-        conn.close()
-        return dict(row) if row else None
 
-    if ticket_id.startswith("SUP-"):
-        cur.execute("SELECT * FROM support_requests WHERE ticket_id=?", (ticket_id,))
-        row = cur.fetchone()
-        conn.close()
-        return dict(row) if row else None
+def get_products_snapshot() -> Tuple[int, List[Dict[str, Any]]]:
+    # Revision and rows are read in one transaction so a snapshot never mixes two catalog versions.
+    conn = get_conn()
+    conn.execute("BEGIN")
+    try:
+        row = conn.execute("SELECT revision FROM catalog_meta WHERE id=1").fetchone()
+        rows = conn.execute("SELECT * FROM products ORDER BY price_usd ASC, sku ASC").fetchall()
+    finally:
+        conn.commit()
+    return (int(row["revision"]) if row else 0), [dict(r) for r in rows]
 
-    cur.execute("SELECT * FROM sales_requests WHERE ticket_id=?", (ticket_id,))
-    row = cur.fetchone()
-    if row:
-        conn.close()
-        return dict(row)
 
-    cur.execute("SELECT * FROM support_requests WHERE ticket_id=?", (ticket_id,))
+def get_catalog_revision() -> int:
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT revision FROM catalog_meta WHERE id=1")
     row = cur.fetchone()
-    conn.close()
+    return int(row["revision"]) if row else 0
+
+
+def llm_cache_get(cache_key: str, min_created_at: float) -> Optional[Dict[str, Any]]:
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT value, created_at FROM llm_cache WHERE cache_key=? AND created_at >= ?",
+            (cache_key, min_created_at),
+        )
+        row = cur.fetchone()
+        if row:
+            cur.execute("UPDATE llm_cache SET last_used_at=? WHERE cache_key=?", (time.time(), cache_key))
     return dict(row) if row else None
 
 
-def search_products_by_exact_mention(mentions: List[str]) -> List[Dict[str, Any]]:
-    if not mentions:
-        return []
+def llm_cache_put(cache_key: str, value: str, created_at: float) -> None:
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT OR REPLACE INTO llm_cache (cache_key, value, created_at, last_used_at)
+            VALUES (?, ?, ?, ?)
+            """,
+            (cache_key, value, created_at, created_at),
+        )
+
+
+def llm_cache_prune(max_rows: int, min_created_at: float) -> int:
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM llm_cache WHERE created_at < ?", (min_created_at,))
+        removed = cur.rowcount
+        cur.execute(
+            """
+            DELETE FROM llm_cache WHERE cache_key IN (
+                SELECT cache_key FROM llm_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (max_rows,),
+        )
+        removed += cur.rowcount
+    return removed
+
+
+def get_labeled_tickets(limit: int = 20000) -> List[Dict[str, Any]]:
     conn = get_conn()
     cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT email_subject, email_body, kind AS category, intent
+        FROM tickets
+        LIMIT ?
+        """,
+        (limit,),
+    )
+    rows = [dict(r) for r in cur.fetchall()]
+    return rows
+
 
-    results: List[Dict[str, Any]] = []
-    for m in mentions:
-        like = f"%{m.strip()}%"
+def record_preclassifier_shadow(
+    run_id: str,
+    pre_category: Optional[str],
+    pre_intent: Optional[str],
+    pre_confidence: float,
+    llm_category: str,
+    llm_intent: str,
+) -> None:
+    with get_conn() as conn:
+        cur = conn.cursor()
         cur.execute(
             """
-            SELECT * FROM products
-            WHERE (sku LIKE ? OR name LIKE ?)
-            LIMIT 10
+            INSERT INTO preclassifier_shadow (
+                run_id, created_at, pre_category, pre_intent, pre_confidence, llm_category, llm_intent
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?)
             """,
-            (like, like),
+            (run_id, datetime.utcnow().isoformat(), pre_category, pre_intent, float(pre_confidence), llm_category, llm_intent),
         )
-        for row in cur.fetchall():
-            results.append(dict(row))
 
-    conn.close()
-    uniq = {r["sku"]: r for r in results}
-    return list(uniq.values())
 
+def prune_preclassifier_shadow(before: datetime) -> int:
+    with get_conn() as conn:
+        cur = conn.execute("DELETE FROM preclassifier_shadow WHERE created_at < ?", (before.isoformat(),))
+    return cur.rowcount
 
-def search_products_by_need_keywords(keywords: List[str], limit: int = 10) -> List[Dict[str, Any]]:
-    if not keywords:
-        return []
+
+def preclassifier_shadow_report(threshold: float) -> Dict[str, Any]:
     conn = get_conn()
     cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT
+            COUNT(*) AS total,
+            SUM(pre_category = llm_category) AS category_agree,
+            SUM(pre_category = llm_category AND pre_intent = llm_intent) AS full_agree,
+            SUM(pre_confidence >= :t) AS confident,
+            SUM(pre_confidence >= :t AND pre_category = llm_category) AS confident_category_agree,
+            SUM(pre_confidence >= :t AND pre_category = llm_category AND pre_intent = llm_intent) AS confident_full_agree
+        FROM preclassifier_shadow
+        """,
+        {"t": threshold},
+    )
+    row = {k: (v or 0) for k, v in dict(cur.fetchone()).items()}
 
-    where = " OR ".join(["keywords LIKE ?"] * len(keywords))
-    params = [f"%{k.strip()}%" for k in keywords]
+    def ratio(a: int, b: int) -> Optional[float]:
+        return round(a / b, 4) if b else None
 
-    cur.execute(
+    return {
+        "samples": row["total"],
+        "category_agreement": ratio(row["category_agree"], row["total"]),
+        "full_agreement": ratio(row["full_agree"], row["total"]),
+        "above_threshold": row["confident"],
+        "coverage": ratio(row["confident"], row["total"]),
+        "above_threshold_category_agreement": ratio(row["confident_category_agree"], row["confident"]),
+        "above_threshold_full_agreement": ratio(row["confident_full_agree"], row["confident"]),
+    }
+
+
+def run_create(run_id: str, owner: str) -> None:
+    now = time.time()
+    with get_conn() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO runs (run_id, owner, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            (run_id, owner, now, now),
+        )
+
+
+def run_exists(run_id: str) -> bool:
+    conn = get_conn()
+    return conn.execute("SELECT 1 FROM runs WHERE run_id=?", (run_id,)).fetchone() is not None
+
+
+def run_append_event(run_id: str, payload: Dict[str, Any], finished: bool = False) -> int:
+    now = time.time()
+    with get_conn() as conn:
+        row = conn.execute(
+            """
+            INSERT INTO run_events (run_id, seq, created_at, payload_json)
+            SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ? FROM run_events WHERE run_id=?
+            RETURNING seq
+            """,
+            (run_id, now, json.dumps(payload, ensure_ascii=False), run_id),
+        ).fetchone()
+        conn.execute(
+            "UPDATE runs SET updated_at=?, finished_at=CASE WHEN ? THEN ? ELSE finished_at END WHERE run_id=?",
+            (now, finished, now, run_id),
+        )
+    return int(row["seq"])
+
+
+def run_read_events(run_id: str, after_seq: int = 0, limit: int = 500) -> List[Tuple[int, Dict[str, Any]]]:
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT seq, payload_json FROM run_events WHERE run_id=? AND seq>? ORDER BY seq LIMIT ?",
+        (run_id, after_seq, limit),
+    ).fetchall()
+    return [(int(r["seq"]), json.loads(r["payload_json"])) for r in rows]
+
+
+def run_unfinished(owner_prefix: str) -> List[Dict[str, Any]]:
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT run_id, owner FROM runs WHERE finished_at IS NULL AND owner LIKE ?", (owner_prefix + "%",)
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def run_gc(finished_before: float, abandoned_before: float) -> int:
+    with get_conn() as conn:
+        ids = [
+            r["run_id"]
+            for r in conn.execute(
+                "SELECT run_id FROM runs WHERE finished_at < ? OR (finished_at IS NULL AND updated_at < ?)",
+                (finished_before, abandoned_before),
+            ).fetchall()
+        ]
+        conn.executemany("DELETE FROM run_events WHERE run_id=?", [(i,) for i in ids])
+        conn.executemany("DELETE FROM runs WHERE run_id=?", [(i,) for i in ids])
+    return len(ids)
+
+
+def run_counts() -> Dict[str, int]:
+    conn = get_conn()
+    row = conn.execute(
+        """
+        SELECT COUNT(*) AS runs, SUM(finished_at IS NULL) AS active,
+               (SELECT COUNT(*) FROM run_events) AS events
+        FROM runs
+        """
+    ).fetchone()
+    return {"runs": int(row["runs"] or 0), "active": int(row["active"] or 0), "events": int(row["events"] or 0)}
+
+
+def attachment_blob_ref(sha256: str, size_bytes: int, run_id: Optional[str] = None) -> bool:
+    # Returns True when the blob is new to the spool, False when it deduplicates an existing one.
+    # With a run_id the run holds the blob until attachment_release_run.
+    now = time.time()
+    with get_conn() as conn:
+        held = 0
+        if run_id is not None:
+            held = conn.execute(
+                "INSERT OR IGNORE INTO attachment_holds (run_id, sha256, created_at) VALUES (?, ?, ?)",
+                (run_id, sha256, now),
+            ).rowcount
+        cur = conn.execute(
+            "UPDATE attachment_blobs SET refs = refs + ?, last_used_at=? WHERE sha256=?", (held, now, sha256)
+        )
+        if cur.rowcount:
+            return False
+        conn.execute(
+            "INSERT INTO attachment_blobs (sha256, size_bytes, refs, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)",
+            (sha256, size_bytes, held, now, now),
+        )
+    return True
+
+
+def _release_holds(conn: sqlite3.Connection, where: str, params: Tuple[Any, ...]) -> int:
+    conn.execute(
         f"""
-        SELECT * FROM products
-        WHERE ({where})
-        LIMIT ?
+        UPDATE attachment_blobs
+        SET refs = MAX(0, refs - (SELECT COUNT(*) FROM attachment_holds h WHERE h.sha256 = attachment_blobs.sha256 AND {where})),
+            last_used_at = ?
+        WHERE sha256 IN (SELECT h.sha256 FROM attachment_holds h WHERE {where})
         """,
-        (*params, limit),
+        (*params, time.time(), *params),
     )
+    return conn.execute(f"DELETE FROM attachment_holds AS h WHERE {where}", params).rowcount
 
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    return rows
 
+def attachment_release_run(run_id: str) -> int:
+    with get_conn() as conn:
+        return _release_holds(conn, "h.run_id = ?", (run_id,))
 
-def get_active_products() -> List[Dict[str, Any]]:
+
+def attachment_release_stale(held_before: float) -> int:
+    # Holds left behind by runs that never finished (crashed worker, dead process).
+    with get_conn() as conn:
+        return _release_holds(conn, "h.created_at < ?", (held_before,))
+
+
+def attachment_blob_sweep(idle_before: float, max_bytes: int, remove: Callable[[str], None]) -> List[str]:
+    # Evicts unreferenced blobs idle since idle_before, then least recently used ones until the
+    # spool fits max_bytes. remove() runs inside the write transaction, so an upload of the same
+    # content can't re-reference a blob between its row and its file going away.
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM products WHERE is_active=1 ORDER BY price_usd ASC")
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    return rows
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        total = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM attachment_blobs").fetchone()[0]
+        evicted: List[str] = []
+        rows = conn.execute(
+            "SELECT sha256, size_bytes, last_used_at FROM attachment_blobs WHERE refs = 0 ORDER BY last_used_at"
+        ).fetchall()
+        for row in rows:
+            if row["last_used_at"] >= idle_before and total <= max_bytes:
+                break
+            remove(row["sha256"])
+            evicted.append(row["sha256"])
+            total -= row["size_bytes"]
+        conn.executemany("DELETE FROM attachment_blobs WHERE sha256=?", [(sha,) for sha in evicted])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return evicted
+
+
+def attachment_blob_exists(sha256: str) -> bool:
+    conn = get_conn()
+    return conn.execute("SELECT 1 FROM attachment_blobs WHERE sha256=?", (sha256,)).fetchone() is not None
+
+
+def attachment_spool_stats() -> Dict[str, int]:
+    conn = get_conn()
+    row = conn.execute(
+        "SELECT COUNT(*) AS blobs, COALESCE(SUM(size_bytes), 0) AS bytes, COALESCE(SUM(refs), 0) AS refs FROM attachment_blobs"
+    ).fetchone()
+    return {"blobs": int(row["blobs"]), "bytes": int(row["bytes"]), "refs": int(row["refs"])}
+
+
+def attachment_text_get(sha256: str, version: int) -> Optional[Dict[str, Any]]:
+    conn = get_conn()
+    row = conn.execute(
+        "SELECT status, text FROM attachment_text WHERE sha256=? AND version=?", (sha256, version)
+    ).fetchone()
+    return dict(row) if row else None
+
+
+def attachment_text_put(sha256: str, version: int, status: str, text: str) -> None:
+    with get_conn() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO attachment_text (sha256, version, status, text, created_at) VALUES (?, ?, ?, ?, ?)",
+            (sha256, version, status, text, time.time()),
+        )
+
+
+def insert_run_spans(run_id: str, spans: List[Dict[str, Any]]) -> None:
+    with get_conn() as conn:
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO run_spans (run_id, seq, kind, name, started_at, duration_ms, attrs_json)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (run_id, i, sp["kind"], sp["name"], sp["started_at"], sp["duration_ms"],
+                 json.dumps(sp.get("attrs") or {}, ensure_ascii=False))
+                for i, sp in enumerate(sorted(spans, key=lambda sp: sp["started_at"]), start=1)
+            ],
+        )
+
+
+def get_run_spans(run_id: str) -> List[Dict[str, Any]]:
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT kind, name, started_at, duration_ms, attrs_json FROM run_spans WHERE run_id=? ORDER BY seq", (run_id,)
+    ).fetchall()
+    out = []
+    for r in rows:
+        d = dict(r)
+        d["attrs"] = json.loads(d.pop("attrs_json"))
+        out.append(d)
+    return out
+
+
+def prune_run_spans(before: float) -> int:
+    with get_conn() as conn:
+        cur = conn.execute(
+            "DELETE FROM run_spans WHERE run_id IN (SELECT DISTINCT run_id FROM run_spans WHERE started_at < ?)", (before,)
+        )
+    return cur.rowcount
+
+
+def circuit_get(name: str) -> Dict[str, Any]:
+    row = get_conn().execute(
+        "SELECT state, failures, opened_until FROM llm_circuit WHERE name=?", (name,)
+    ).fetchone()
+    return dict(row) if row else {"state": "closed", "failures": 0, "opened_until": 0.0}
+
+
+def circuit_record_failure(name: str, threshold: int, cooldown_s: float, now: float) -> Dict[str, Any]:
+    # A failed half-open probe, or reaching the threshold, (re)opens the circuit.
+    with get_conn() as conn:
+        row = conn.execute(
+            """
+            INSERT INTO llm_circuit (name, state, failures, opened_until, updated_at)
+            VALUES (:name, CASE WHEN :threshold <= 1 THEN 'open' ELSE 'closed' END, 1,
+                    CASE WHEN :threshold <= 1 THEN :until ELSE 0 END, :now)
+            ON CONFLICT(name) DO UPDATE SET
+                failures = failures + 1,
+                state = CASE WHEN state = 'half_open' OR failures + 1 >= :threshold THEN 'open' ELSE state END,
+                opened_until = CASE WHEN state = 'half_open' OR (state = 'closed' AND failures + 1 >= :threshold)
+                                    THEN :until ELSE opened_until END,
+                updated_at = :now
+            RETURNING state, failures, opened_until
+            """,
+            {"name": name, "threshold": threshold, "until": now + cooldown_s, "now": now},
+        ).fetchone()
+    return dict(row)
+
+
+def circuit_record_success(name: str, now: float) -> None:
+    with get_conn() as conn:
+        conn.execute(
+            "UPDATE llm_circuit SET state='closed', failures=0, opened_until=0, updated_at=? WHERE name=?", (now, name)
+        )
+
+
+def circuit_try_probe(name: str, cooldown_s: float, now: float) -> bool:
+    # Exactly one caller across processes moves an expired open circuit to half_open and probes.
+    with get_conn() as conn:
+        cur = conn.execute(
+            """
+            UPDATE llm_circuit SET state='half_open', opened_until=?, updated_at=?
+            WHERE name=? AND state IN ('open', 'half_open') AND opened_until <= ?
+            """,
+            (now + cooldown_s, now, name, now),
+        )
+    return cur.rowcount == 1
+
+
+def rate_try_acquire(
+    waiter_id: str, priority: int, costs: Dict[str, Tuple[float, float, float]], now: float, ttl_s: float
+) -> Tuple[bool, float, int]:
+    # costs: bucket -> (amount, capacity, refill_per_s). Takes from every bucket or none.
+    # Returns (acquired, seconds until the buckets could cover this waiter's turn, waiters
+    # ahead of it). Waiters ahead are assumed to cost as much as this one, so the estimate
+    # for a queued waiter is when the head should have drained. Not acquiring (re)queues waiter_id.
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM llm_rate_waiters WHERE expires_at < ?", (now,))
+        mine = conn.execute("SELECT enqueued_at FROM llm_rate_waiters WHERE waiter_id=?", (waiter_id,)).fetchone()
+        enqueued_at = mine["enqueued_at"] if mine else now
+        ahead = conn.execute(
+            """
+            SELECT COUNT(*) FROM llm_rate_waiters
+            WHERE waiter_id != ? AND (priority < ? OR (priority = ? AND enqueued_at < ?))
+            """,
+            (waiter_id, priority, priority, enqueued_at),
+        ).fetchone()[0]
+
+        levels: Dict[str, float] = {}
+        wait_s = 0.0
+        for name, (amount, capacity, rate) in costs.items():
+            row = conn.execute("SELECT level, updated_at FROM llm_rate_buckets WHERE name=?", (name,)).fetchone()
+            level = capacity if row is None else min(capacity, row["level"] + (now - row["updated_at"]) * rate)
+            levels[name] = level
+            # Requests bigger than the bucket wait for a full bucket instead of forever.
+            need = min(amount, capacity) * (ahead + 1)
+            if level < need:
+                wait_s = max(wait_s, (need - level) / rate if rate > 0 else float("inf"))
+        if ahead == 0 and wait_s == 0.0:
+            conn.executemany(
+                """
+                INSERT INTO llm_rate_buckets (name, level, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET level=excluded.level, updated_at=excluded.updated_at
+                """,
+                [(name, levels[name] - min(amount, capacity), now) for name, (amount, capacity, _) in costs.items()],
+            )
+            conn.execute("DELETE FROM llm_rate_waiters WHERE waiter_id=?", (waiter_id,))
+            conn.commit()
+            return True, 0.0, 0
+
+        conn.execute(
+            """
+            INSERT INTO llm_rate_waiters (waiter_id, priority, enqueued_at, expires_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(waiter_id) DO UPDATE SET expires_at=excluded.expires_at
+            """,
+            (waiter_id, priority, enqueued_at, now + ttl_s),
+        )
+        conn.commit()
+        return False, wait_s, ahead
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def rate_leave(waiter_id: str) -> None:
+    with get_conn() as conn:
+        conn.execute("DELETE FROM llm_rate_waiters WHERE waiter_id=?", (waiter_id,))
+
+
+def rate_adjust(name: str, delta: float, capacity: float, rate: float, now: float) -> None:
+    # Credits (or debits) a bucket once the real token usage is known.
+    with get_conn() as conn:
+        conn.execute(
+            """
+            UPDATE llm_rate_buckets
+            SET level = MIN(:capacity, level + (:now - updated_at) * :rate + :delta), updated_at = :now
+            WHERE name = :name
+            """,
+            {"name": name, "delta": delta, "capacity": capacity, "rate": rate, "now": now},
+        )
+
+
+def rate_stats() -> Dict[str, Any]:
+    conn = get_conn()
+    buckets = {r["name"]: {"level": r["level"], "updated_at": r["updated_at"]}
+               for r in conn.execute("SELECT name, level, updated_at FROM llm_rate_buckets")}
+    waiters = {str(r["priority"]): r["n"] for r in conn.execute(
+        "SELECT priority, COUNT(*) AS n FROM llm_rate_waiters WHERE expires_at >= ? GROUP BY priority", (time.time(),)
+    )}
+    return {"buckets": buckets, "waiting_by_priority": waiters}
+
+
+def fingerprint_put(ticket_id: str, signature: bytes, band_keys: List[int], created_at: float) -> None:
+    with get_conn() as conn:
+        cur = conn.execute(
+            """
+            INSERT INTO email_fingerprints (ticket_id, signature, created_at) VALUES (?, ?, ?)
+            ON CONFLICT(ticket_id) DO UPDATE SET signature=excluded.signature, created_at=excluded.created_at
+            RETURNING id
+            """,
+            (ticket_id, signature, created_at),
+        )
+        fingerprint_id = cur.fetchone()[0]
+        # A re-fingerprinted ticket must not stay findable through its old signature's bands.
+        conn.execute("DELETE FROM email_fingerprint_bands WHERE fingerprint_id=?", (fingerprint_id,))
+        conn.executemany(
+            "INSERT OR IGNORE INTO email_fingerprint_bands (band_key, fingerprint_id) VALUES (?, ?)",
+            [(key, fingerprint_id) for key in band_keys],
+        )
+
+
+def fingerprint_candidates(band_keys: List[int], min_created_at: float) -> List[Dict[str, Any]]:
+    marks = ",".join("?" * len(band_keys))
+    rows = get_conn().execute(
+        f"""
+        SELECT f.ticket_id, f.signature, f.created_at
+        FROM email_fingerprints f
+        WHERE f.id IN (SELECT fingerprint_id FROM email_fingerprint_bands WHERE band_key IN ({marks}))
+          AND f.created_at >= ?
+        """,
+        (*band_keys, min_created_at),
+    ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def fingerprint_prune(before: float) -> int:
+    with get_conn() as conn:
+        conn.execute(
+            """
+            DELETE FROM email_fingerprint_bands
+            WHERE fingerprint_id IN (SELECT id FROM email_fingerprints WHERE created_at < ?)
+            """,
+            (before,),
+        )
+        cur = conn.execute("DELETE FROM email_fingerprints WHERE created_at < ?", (before,))
+    return cur.rowcount
+
+
+def fingerprint_count() -> int:
+    return int(get_conn().execute("SELECT COUNT(*) FROM email_fingerprints").fetchone()[0])
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import re
+import struct
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import config
+import db
+
+# Near-duplicate detection for incoming mail: the same complaint sent to several
+# addresses, or a rep re-submitting, should link to the existing ticket instead of
+# running the whole graph again. Emails are reduced to a MinHash signature over word
+# 3-shingles; LSH bands (db.email_fingerprint_bands) find candidates with a few
+# primary-key probes and the signature estimates the Jaccard similarity. Shingles are
+# namespaced by the set of attachment sha256s, so the same cover note with a different
+# invoice or screenshot shares nothing with the first one.
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_REPLY_PREFIX_RE = re.compile(r"^\s*((re|fw|fwd|aw)\s*:\s*)+", re.IGNORECASE)
+_SHINGLE = 3
+# 36 hashes in 12 bands of 3: pairs at similarity 0.7 share a band ~99% of the time, at 0.2 ~9%.
+_PERMUTATIONS = 36
+_ROWS = 3
+_BANDS = _PERMUTATIONS // _ROWS
+_SIGNATURE = struct.Struct(f"<{_PERMUTATIONS}I")
+_DIGESTS = -(-_SIGNATURE.size // 64)
+_PRUNE_EVERY = 1000
+
+_lock = threading.Lock()
+_stored = 0
+
+
+def _tokens(subject: str, body: str) -> List[str]:
+    # Quoted reply lines are what re-sent mail most often differs in, so they're dropped.
+    lines = [ln for ln in (body or "").splitlines() if not ln.lstrip().startswith(">")]
+    text = _REPLY_PREFIX_RE.sub("", subject or "") + "\n" + "\n".join(lines)
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _shingle_hashes(shingle: str) -> tuple:
+    data = shingle.encode("utf-8")
+    # Personalised 64-byte digests, cut into independent 32-bit hash functions.
+    digests = b"".join(hashlib.blake2b(data, digest_size=64, person=bytes([k])).digest() for k in range(_DIGESTS))
+    return _SIGNATURE.unpack_from(digests)
+
+
+def signature(subject: str, body: str, attachments: Sequence[str] = ()) -> Optional[bytes]:
+    tokens = _tokens(subject, body)
+    if len(tokens) < config.DEDUP_MIN_TOKENS:
+        return None
+    prefix = ",".join(sorted(set(attachments))) + "|" if attachments else ""
+    shingles = {prefix + " ".join(tokens[i:i + _SHINGLE]) for i in range(len(tokens) - _SHINGLE + 1)}
+    return _SIGNATURE.pack(*map(min, zip(*map(_shingle_hashes, shingles))))
+
+
+def band_keys(sig: bytes) -> List[int]:
+    width = _ROWS * 4
+    return [
+        int.from_bytes(hashlib.blake2b(bytes([b]) + sig[b * width:(b + 1) * width], digest_size=8).digest(),
+                       "little", signed=True)
+        for b in range(_BANDS)
+    ]
+
+
+def similarity(a: bytes, b: bytes) -> float:
+    return sum(x == y for x, y in zip(_SIGNATURE.unpack(a), _SIGNATURE.unpack(b))) / _PERMUTATIONS
+
+
+def find_duplicate(sig: Optional[bytes], now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    if sig is None:
+        return None
+    now = time.time() if now is None else now
+    best = None
+    for row in db.fingerprint_candidates(band_keys(sig), now - config.DEDUP_WINDOW_S):
+        score = similarity(sig, row["signature"])
+        if score < config.DEDUP_MIN_SIMILARITY:
+            continue
+        if best is None or (score, row["created_at"]) > (best["similarity"], best["created_at"]):
+            best = {"ticket_id": row["ticket_id"], "similarity": score, "created_at": row["created_at"]}
+    if best is None:
+        return None
+    # The ticket may not be written yet (batch runs commit in flushes); that counts as a miss.
+    ticket = db.get_ticket(best["ticket_id"])
+    if not ticket:
+        return None
+    best["classification"] = json.loads(ticket["classification_json"])
+    return best
+
+
+def remember(ticket_id: str, sig: Optional[bytes], now: Optional[float] = None) -> None:
+    global _stored
+    if sig is None or not ticket_id:
+        return
+    now = time.time() if now is None else now
+    db.fingerprint_put(ticket_id, sig, band_keys(sig), now)
+    with _lock:
+        _stored += 1
+        prune = _stored % _PRUNE_EVERY == 0
+    if prune:
+        db.fingerprint_prune(now - config.DEDUP_WINDOW_S)
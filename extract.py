@@ -0,0 +1,273 @@
+import math
+import multiprocessing
+import os
+import re
+import signal
+import threading
+import time
+import zipfile
+from concurrent.futures import CancelledError, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Tuple
+from xml.etree import ElementTree
+
+import config
+import db
+from attachments import blob_path
+
+try:
+    import resource
+except ImportError:  # Windows: no rlimits, only the wall-clock timeout applies
+    resource = None
+
+# Text extraction for spooled attachments. Parsing runs in a small process pool with
+# per-task CPU and address-space rlimits, so a pathological file kills (or fails) its
+# worker rather than stalling the graph. Results are cached by sha256 in attachment_text.
+
+EXTRACTOR_VERSION = 1
+
+_TEXT_EXT = (".txt", ".log", ".csv", ".tsv", ".md", ".json", ".xml", ".yaml", ".yml")
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def detect_kind(filename: str, content_type: str) -> Optional[str]:
+    name = (filename or "").lower()
+    ctype = (content_type or "").lower()
+    if name.endswith(".pdf") or ctype == "application/pdf":
+        return "pdf"
+    if name.endswith(".docx") or "wordprocessingml" in ctype:
+        return "docx"
+    if name.endswith(_TEXT_EXT) or ctype.startswith("text/"):
+        return "text"
+    return None
+
+
+def _extract_text(path: str) -> str:
+    with open(path, "rb") as f:
+        data = f.read(config.EXTRACT_MAX_CHARS * 4)
+    return data.decode("utf-8", errors="replace").replace("\x00", "")
+
+
+def _extract_pdf(path: str) -> str:
+    from pypdf import PdfReader
+
+    out: List[str] = []
+    size = 0
+    for page in PdfReader(path).pages:
+        text = page.extract_text() or ""
+        out.append(text)
+        size += len(text)
+        if size >= config.EXTRACT_MAX_CHARS:
+            break
+    return "\n".join(out)
+
+
+def _extract_docx(path: str) -> str:
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo("word/document.xml")
+        if info.file_size > config.EXTRACT_MAX_CHARS * 20:
+            raise ValueError("document.xml is too large")
+        root = ElementTree.fromstring(zf.read(info))
+    paragraphs = []
+    for p in root.iter(f"{_W_NS}p"):
+        paragraphs.append("".join(t.text or "" for t in p.iter(f"{_W_NS}t")))
+    return "\n".join(paragraphs)
+
+
+def _vm_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _apply_limits() -> None:
+    if resource is None:
+        return
+    # CPU time is cumulative per process, so the budget is re-armed for every task; the
+    # default SIGXCPU action kills the worker and the parent sees a broken pool.
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = int(math.ceil(usage.ru_utime + usage.ru_stime + config.EXTRACT_TIMEOUT_S)) + 1
+    resource.setrlimit(resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min(soft, hard), hard))
+    vm = _vm_bytes()
+    if vm is not None:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = vm + config.EXTRACT_MAX_MEMORY_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+
+
+def _reset_memory_limit() -> None:
+    if resource is not None:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (hard, hard))
+
+
+def _set_alarm(seconds: float) -> None:
+    # SIGALRM's default action ends this worker only; the parent recycles the pool without
+    # touching other runs' queued files. (No setitimer on Windows: CPU limits only.)
+    if hasattr(signal, "setitimer"):
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+
+
+def extract_file(path: str, kind: str) -> Tuple[str, str]:
+    # Runs in a pool worker. Returns (status, text).
+    _apply_limits()
+    _set_alarm(config.EXTRACT_TIMEOUT_S + 1)
+    try:
+        if kind == "pdf":
+            text = _extract_pdf(path)
+        elif kind == "docx":
+            text = _extract_docx(path)
+        else:
+            text = _extract_text(path)
+    except ImportError as e:
+        return "unsupported", str(e)
+    except MemoryError:
+        return "memory_limit", ""
+    except Exception as e:
+        return "failed", f"{type(e).__name__}: {e}"[:300]
+    finally:
+        _set_alarm(0)
+        _reset_memory_limit()
+    text = re.sub(r"[ \t]+", " ", text)
+    text = re.sub(r"\n\s*\n+", "\n\n", text).strip()
+    return "ok", text[: config.EXTRACT_MAX_CHARS]
+
+
+def _pool_context() -> Any:
+    # forkserver/spawn children start small and single-threaded, unlike a fork of the web process.
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+_lock = threading.Lock()
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=config.EXTRACT_WORKERS, mp_context=_pool_context())
+        return _pool
+
+
+def _recycle_pool(broken: ProcessPoolExecutor) -> None:
+    global _pool
+    with _lock:
+        if _pool is broken:
+            _pool = None
+    # Files other runs queued on the old pool are left to finish there; any that die with it
+    # are resubmitted by _result.
+    broken.shutdown(wait=False)
+
+
+def shutdown() -> None:
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit(job: Dict[str, Any]) -> bool:
+    pool = _get_pool()
+    try:
+        job["future"] = pool.submit(extract_file, job["path"], job["kind"])
+    except BrokenProcessPool:
+        _recycle_pool(pool)
+        return False
+    job["pool"] = pool
+    return True
+
+
+def _result(job: Dict[str, Any], deadline: float) -> Tuple[str, str]:
+    while True:
+        try:
+            return job["future"].result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeout:
+            # A file still queued behind others is just dropped; one being parsed is ended by the
+            # worker's alarm and CPU rlimit, and a fresh pool serves later files meanwhile.
+            if not job["future"].cancel():
+                _recycle_pool(job["pool"])
+            return "timeout", ""
+        except (BrokenProcessPool, CancelledError):
+            # Some worker of this pool died (possibly on another run's file): one more try on a fresh pool.
+            _recycle_pool(job["pool"])
+            if job["retried"]:
+                return "killed", ""
+            job["retried"] = True
+            if not _submit(job):
+                return "killed", ""
+
+
+def extract_all(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    results: List[Dict[str, Any]] = []
+    jobs: List[Dict[str, Any]] = []
+    for record in records:
+        out = {"filename": record.get("filename"), "sha256": record.get("sha256"), "text": "", "cached": False}
+        results.append(out)
+        kind = detect_kind(record.get("filename") or "", record.get("content_type") or "")
+        if kind is None or not record.get("sha256"):
+            out["status"] = "skipped"
+            continue
+        cached = db.attachment_text_get(record["sha256"], EXTRACTOR_VERSION)
+        if cached is not None:
+            out.update(status=cached["status"], text=cached["text"], cached=True)
+            continue
+        job = {"out": out, "path": str(blob_path(record["sha256"]).resolve()), "kind": kind, "retried": False,
+               "started": time.perf_counter()}
+        if not _submit(job):
+            out["status"] = "killed"
+            continue
+        jobs.append(job)
+
+    # Files are parsed in parallel under one EXTRACT_TIMEOUT_S deadline for the whole email,
+    # so N slow attachments cost the timeout once, not N times.
+    deadline = time.monotonic() + config.EXTRACT_TIMEOUT_S
+    for job in jobs:
+        out = job["out"]
+        status, text = _result(job, deadline)
+        out.update(status=status, ms=round((time.perf_counter() - job["started"]) * 1000, 2))
+        if status == "ok":
+            out["text"] = text
+        elif text:
+            out["error"] = text
+        # Timeouts and killed workers are not cached: they can depend on load, not just content.
+        if status in ("ok", "failed", "unsupported", "memory_limit"):
+            db.attachment_text_put(out["sha256"], EXTRACTOR_VERSION, status, out["text"])
+    return results
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+def _clip(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    head = max_chars * 2 // 3
+    tail = max_chars - head
+    return text[:head].rstrip() + "\n[...truncated...]\n" + text[-tail:].lstrip()
+
+
+def fit_to_budget(extracted: List[Dict[str, Any]], token_budget: Optional[int] = None) -> List[Dict[str, Any]]:
+    # Splits the budget across files with text; short files give their unused share to the rest.
+    budget_chars = (config.EXTRACT_TOKEN_BUDGET if token_budget is None else token_budget) * 4
+    with_text = sorted((e for e in extracted if e.get("text")), key=lambda e: len(e["text"]))
+    remaining = len(with_text)
+    out: Dict[int, str] = {}
+    for e in with_text:
+        share = budget_chars // remaining if remaining else 0
+        clipped = _clip(e["text"], share)
+        out[id(e)] = clipped
+        budget_chars -= len(clipped)
+        remaining -= 1
+    return [{**e, "text": out.get(id(e), "")} for e in extracted]
+
+
+def render_for_prompt(extracted: List[Dict[str, Any]]) -> str:
+    parts = [f"--- {e['filename']} ---\n{e['text']}" for e in extracted if e.get("text")]
+    return "\n\n".join(parts) if parts else "(none)"
@@ -0,0 +1,211 @@
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import AIMessage
+
+import config
+from llm_client import as_request
+
+# Offline stand-in for the chat model: replays recorded responses per call name with a
+# log-normal latency and an injected error rate. Recordings are JSONL lines of
+# {"name": "<LLMRequest.name>", "content": "<raw model output>", "match": "<optional substring of the email>"};
+# set LLM_RECORD_PATH while running against OpenAI to capture them.
+
+STREAM_CHUNK_CHARS = 16
+
+DEFAULT_RESPONSES: Dict[str, List[Dict[str, Any]]] = {
+    "classify": [
+        {"match": "bundle", "content": {"category": "sales", "intent": "best_price_offer_or_bundling", "confidence": 0.9,
+                                        "reasoning": "Asks for bundle pricing."}},
+        {"match": "error", "content": {"category": "support", "intent": "other", "confidence": 0.9,
+                                       "reasoning": "Reports an error in the product."}},
+        {"match": "fail", "content": {"category": "support", "intent": "other", "confidence": 0.85,
+                                      "reasoning": "Reports a failing feature."}},
+        {"content": {"category": "sales", "intent": "requirement_to_product_suggestion", "confidence": 0.8,
+                     "reasoning": "Describes needs and asks for a recommendation."}},
+    ],
+    "classify_fused": [
+        {"match": "bundle", "content": {
+            "category": "sales", "intent": "best_price_offer_or_bundling", "confidence": 0.9,
+            "reasoning": "Asks for bundle pricing.", "mentions": [], "need_keywords": ["crm", "dashboards"],
+            "wants_bundles": True, "needs_more_info": False, "follow_up_questions": [], "support_symptoms": [],
+            "environment_hints": [], "urgency": "medium"}},
+        {"match": "error", "content": {
+            "category": "support", "intent": "other", "confidence": 0.9, "reasoning": "Reports an error in the product.",
+            "mentions": [], "need_keywords": [], "wants_bundles": False, "needs_more_info": False,
+            "follow_up_questions": [], "support_symptoms": ["error 500"], "environment_hints": ["prod"],
+            "urgency": "high"}},
+        {"match": "fail", "content": {
+            "category": "support", "intent": "other", "confidence": 0.85, "reasoning": "Reports a failing feature.",
+            "mentions": [], "need_keywords": [], "wants_bundles": False, "needs_more_info": False,
+            "follow_up_questions": [], "support_symptoms": ["export fails"], "environment_hints": [],
+            "urgency": "medium"}},
+        {"content": {"category": "sales", "intent": "requirement_to_product_suggestion", "confidence": 0.8,
+                     "reasoning": "Describes needs and asks for a recommendation.", "mentions": [],
+                     "need_keywords": ["crm", "pipeline"], "wants_bundles": False, "needs_more_info": False,
+                     "follow_up_questions": [], "support_symptoms": [], "environment_hints": [], "urgency": "medium"}},
+    ],
+    "intent": [
+        {"content": {"mentions": ["NimbusCRM Pro"], "need_keywords": ["crm", "pipeline", "email tracking"],
+                     "wants_bundles": False, "needs_more_info": False, "follow_up_questions": [],
+                     "support_symptoms": ["login fails"], "environment_hints": ["prod"], "urgency": "high"}},
+    ],
+    "recommend": [
+        {"content": {"recommendations": [
+            {"sku": "PROD-CRM-001", "name": "NimbusCRM Starter", "purpose": "Small teams CRM", "price_usd": 49.0,
+             "score": 0.9, "reasoning": "Covers pipelines and email tracking."},
+            {"sku": "PROD-CRM-010", "name": "NimbusCRM Pro", "purpose": "Advanced CRM", "price_usd": 149.0,
+             "score": 0.7, "reasoning": "Adds automation and analytics if the team grows."},
+        ]}},
+    ],
+    "bundle_reasoning": [
+        {"content": {"reasons": [f"Option {i + 1}: balanced price and coverage." for i in range(5)]}},
+    ],
+}
+
+
+class FakeLLMError(Exception):
+    # Mirrors the shape of provider errors (status_code) so retry logic can treat it alike.
+    def __init__(self, message: str, status_code: int = 503):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def load_recordings(path: Optional[str]) -> Dict[str, List[Dict[str, Any]]]:
+    if not path or not Path(path).exists():
+        return {}
+    out: Dict[str, List[Dict[str, Any]]] = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                rec = json.loads(line)
+                out.setdefault(rec["name"], []).append(rec)
+    return out
+
+
+def _content(rec: Dict[str, Any]) -> str:
+    c = rec["content"]
+    return c if isinstance(c, str) else json.dumps(c, ensure_ascii=False)
+
+
+class FakeLLM:
+    def __init__(
+        self,
+        recordings: Optional[Dict[str, List[Dict[str, Any]]]] = None,
+        latency_ms: Optional[float] = None,
+        latency_sigma: Optional[float] = None,
+        error_rate: Optional[float] = None,
+        seed: Optional[int] = None,
+    ):
+        self.responses = {**DEFAULT_RESPONSES, **(recordings or {})}
+        self.latency_ms = config.FAKE_LLM_LATENCY_MS if latency_ms is None else latency_ms
+        self.latency_sigma = config.FAKE_LLM_LATENCY_SIGMA if latency_sigma is None else latency_sigma
+        self.error_rate = config.FAKE_LLM_ERROR_RATE if error_rate is None else error_rate
+        self._rnd = random.Random(config.FAKE_LLM_SEED if seed is None else seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _sample(self) -> tuple:
+        with self._lock:
+            self.calls += 1
+            # Log-normal with the configured median; sigma controls the tail.
+            delay = self.latency_ms * self._rnd.lognormvariate(0.0, self.latency_sigma) / 1000.0 if self.latency_ms > 0 else 0.0
+            fail = self._rnd.random() < self.error_rate
+        return delay, fail
+
+    def _respond(self, request: Any) -> AIMessage:
+        request = as_request(request)
+        text = "\n".join(str(m.content) for m in request.messages)
+        # Match against the email only: prompts also carry KB hints and catalog JSON, which
+        # mention "bundle" and "error" whatever the email says. Bare requests fall back to
+        # their last message.
+        tail = request.email_text or (str(request.messages[-1].content) if request.messages else "")
+        tail = tail.lower()
+        candidates = self.responses.get(request.name) or [{"content": {}}]
+        matched = [r for r in candidates if r.get("match") and r["match"].lower() in tail]
+        pool = matched or [r for r in candidates if not r.get("match")] or candidates
+        pick = pool[int(hashlib.sha256(text.encode("utf-8")).hexdigest(), 16) % len(pool)]
+        content = _content(pick)
+        return AIMessage(
+            content=content,
+            usage_metadata={
+                "input_tokens": (len(text) + 3) // 4,
+                "output_tokens": (len(content) + 3) // 4,
+                "total_tokens": (len(text) + len(content) + 6) // 4,
+            },
+            response_metadata={"model_name": "fake"},
+        )
+
+    def _chunks(self, content: str) -> List[str]:
+        return [content[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(content), STREAM_CHUNK_CHARS)] or [""]
+
+    def invoke(self, request: Any, **kwargs: Any) -> AIMessage:
+        request = as_request(request)
+        delay, fail = self._sample()
+        if request.on_delta is None:
+            if delay:
+                time.sleep(delay)
+            if fail:
+                raise FakeLLMError("Injected fake LLM failure")
+            return self._respond(request)
+        # Streaming: the first half of the latency is time to first token, the rest is spread over chunks.
+        request.on_delta(None)
+        msg = self._respond(request)
+        chunks = self._chunks(str(msg.content))
+        time.sleep(delay / 2)
+        for i, chunk in enumerate(chunks):
+            if fail and i == len(chunks) // 2:
+                raise FakeLLMError("Injected fake LLM failure")
+            request.on_delta(chunk)
+            time.sleep(delay / 2 / len(chunks))
+        return msg
+
+    async def ainvoke(self, request: Any, **kwargs: Any) -> AIMessage:
+        request = as_request(request)
+        delay, fail = self._sample()
+        if request.on_delta is None:
+            if delay:
+                await asyncio.sleep(delay)
+            if fail:
+                raise FakeLLMError("Injected fake LLM failure")
+            return self._respond(request)
+        request.on_delta(None)
+        msg = self._respond(request)
+        chunks = self._chunks(str(msg.content))
+        await asyncio.sleep(delay / 2)
+        for i, chunk in enumerate(chunks):
+            if fail and i == len(chunks) // 2:
+                raise FakeLLMError("Injected fake LLM failure")
+            request.on_delta(chunk)
+            await asyncio.sleep(delay / 2 / len(chunks))
+        return msg
+
+
+class RecordingLLM:
+    # Appends every response to a recordings file that FakeLLM can replay.
+    def __init__(self, llm: Any, path: str):
+        self.llm = llm
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _record(self, request: Any, msg: Any) -> None:
+        line = json.dumps({"name": as_request(request).name, "content": msg.content}, ensure_ascii=False)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    def invoke(self, request: Any, **kwargs: Any) -> Any:
+        msg = self.llm.invoke(request, **kwargs)
+        self._record(request, msg)
+        return msg
+
+    async def ainvoke(self, request: Any, **kwargs: Any) -> Any:
+        msg = await self.llm.ainvoke(request, **kwargs)
+        await asyncio.to_thread(self._record, request, msg)
+        return msg
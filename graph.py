@@ -1,64 +1,308 @@
-from typing import TypedDict, List, Dict, Any, Optional
-from langgraph.graph import StateGraph, END
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from typing import TypedDict, List, Dict, Any, Optional, Callable, Annotated
+import asyncio
+import functools
+import inspect
 import json
+import dataclasses
+import operator
+import re
+import time
 
 from schemas import (
     EmailInput, ClassificationResult, FinalAgentResponse,
     SalesWorkflowResult, SupportWorkflowResult,
-    ProductRecommendation, BundleOption
+    ProductRecommendation, BundleOption,
+    IntentDetails, FusedClassification
 )
+from pydantic import ValidationError
 from guardrails import basic_input_guardrails, validate_or_raise, clamp_confidence
+import config
 import db
-
-KB = {
-    "sales": ["pricing", "quote", "discount", "bundle", "purchase", "buy", "trial", "demo", "renewal", "invoice"],
-    "support": ["error", "bug", "issue", "not working", "down", "broken", "failed", "incident", "unable", "crash"],
-    "intent_rules": {
-        "specific_product_query": ["sku", "product code", "looking for", "is available", "availability"],
-        "requirement_to_product_suggestion": ["recommend", "suggest", "best fit", "need a solution", "requirements"],
-        "best_price_offer_or_bundling": ["bundle", "best price", "discount", "offer", "package"],
-        "need_more_information": ["clarify", "need more info", "not sure", "details needed"]
-    }
-}
-
+import catalog
+import bundler
+import dedup
+import extract
+from llm_client import LLMRequest, build_llm
+from llm_policy import LLMCallFailed
+from json_stream import JsonArrayStream, parse_items
+from kb import KB
+import metrics
+import preclassifier
+from rate_limit import PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_URGENT
+
+def _merge(left: Dict[str, Any], right: Dict[str, Any]) -> Dict[str, Any]:
+    return {**(left or {}), **(right or {})}
+
+# Workflow branches fan out into parallel nodes, so nodes return partial updates and
+# list/dict fields written by several nodes carry reducers.
 class AgentState(TypedDict):
     run_id: str
     email: Dict[str, Any]
     attachments_meta: List[Dict[str, Any]]
-    status_events: List[Dict[str, Any]]
+    attachment_text: Optional[List[Dict[str, Any]]]
+    status_events: Annotated[List[Dict[str, Any]], operator.add]
+    node_timings: Annotated[Dict[str, float], _merge]
     classification: Optional[Dict[str, Any]]
+    ticket_id: Optional[str]
+    intent_details: Optional[Dict[str, Any]]
     final: Optional[Dict[str, Any]]
+    priority: str
+    fingerprint: Optional[bytes]
+
+def _publish(payload: Dict[str, Any]) -> None:
+    from langgraph.config import get_stream_writer
+
+    try:
+        writer = get_stream_writer()
+    except RuntimeError:
+        return
+    writer(payload)
+
+def _emit(events: List[Dict[str, Any]], step: str, message: str, progress: int) -> List[Dict[str, Any]]:
+    ev = {"step": step, "message": message, "progress": progress}
+    events.append(ev)
+    _publish(ev)
+    return events
+
+def new_state(
+    run_id: str, email: Dict[str, Any], attachments_meta: List[Dict[str, Any]], priority: str = "interactive"
+) -> AgentState:
+    return {
+        "run_id": run_id,
+        "email": email,
+        "attachments_meta": attachments_meta,
+        "attachment_text": None,
+        "status_events": [],
+        "node_timings": {},
+        "classification": None,
+        "ticket_id": None,
+        "intent_details": None,
+        "final": None,
+        "priority": priority,
+        "fingerprint": None,
+    }
+
+def _timed(name: str, node: Callable[[AgentState], Any]) -> Callable[[AgentState], Any]:
+    def _with_timing(state: AgentState, update: Dict[str, Any], started: float, wall: float) -> Dict[str, Any]:
+        seconds = time.perf_counter() - started
+        metrics.record_node(state.get("run_id"), name, wall, seconds)
+        update = dict(update or {})
+        update["node_timings"] = {name: round(seconds * 1000, 2)}
+        return update
+
+    def _failed(state: AgentState, e: Exception, started: float, wall: float) -> None:
+        metrics.record_node(state.get("run_id"), name, wall, time.perf_counter() - started, error=type(e).__name__)
+
+    if inspect.iscoroutinefunction(node):
+        @functools.wraps(node)
+        async def timed_async(state: AgentState) -> Dict[str, Any]:
+            started, wall = time.perf_counter(), time.time()
+            try:
+                update = await node(state)
+            except Exception as e:
+                _failed(state, e, started, wall)
+                raise
+            return _with_timing(state, update, started, wall)
+        return timed_async
+
+    @functools.wraps(node)
+    def timed(state: AgentState) -> Dict[str, Any]:
+        started, wall = time.perf_counter(), time.time()
+        try:
+            update = node(state)
+        except Exception as e:
+            _failed(state, e, started, wall)
+            raise
+        return _with_timing(state, update, started, wall)
+    return timed
+
+# call name -> (SSE event, key of the array in the JSON response, item schema)
+ITEM_CALLS = {
+    "recommend": ("recommendation", "recommendations", ProductRecommendation),
+}
+
+# Parsers shared by the nodes and the cache: a response is only cached if it parses the
+# way the node that asked for it will parse it.
+def _parse_classification(content: str) -> ClassificationResult:
+    data = json.loads(content)
+    data["confidence"] = clamp_confidence(data.get("confidence", 0.0))
+    return validate_or_raise(ClassificationResult, data)
+
+def _parse_fused(content: str) -> FusedClassification:
+    data = json.loads(content)
+    data["confidence"] = clamp_confidence(data.get("confidence", 0.0))
+    return FusedClassification.model_validate(data)
+
+def _parse_object(content: str) -> Dict[str, Any]:
+    data = json.loads(content)
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+    return data
+
+def _parse_validated_items(content: str, call: str, limit: int) -> List[Any]:
+    _, key, model = ITEM_CALLS[call]
+    out = []
+    for item in parse_items(content, key)[:limit]:
+        item["score"] = clamp_confidence(item.get("score", 0.0))
+        out.append(model.model_validate(item))
+    return out
+
+def _has_reasons(msg: Any) -> bool:
+    return isinstance(_parse_object(msg.content).get("reasons"), list)
+
+def _accepts(parse: Callable[[str], Any]) -> Callable[[Any], bool]:
+    def accept(msg: Any) -> bool:
+        parse(msg.content)
+        return True
+    return accept
+
+_URGENT_RE = re.compile(r"\b(urgent|asap|outage|critical|sev ?1|p1|immediately|production down)\b", re.IGNORECASE)
+
+def _llm_priority(state: AgentState) -> int:
+    # Bulk backfills always queue last; otherwise support mail that looks urgent (or that
+    # intent extraction flagged high) goes ahead of ordinary interactive calls. Until
+    # classification says support, "urgent" in the text is not enough: sales mail uses it too.
+    if state.get("priority") == "bulk":
+        return PRIORITY_BULK
+    if (state.get("intent_details") or {}).get("urgency") == "high":
+        return PRIORITY_URGENT
+    category = (state.get("classification") or {}).get("category")
+    email = state.get("email") or {}
+    if category == "support" and _URGENT_RE.search(f"{email.get('subject', '')}\n{email.get('body', '')}"):
+        return PRIORITY_URGENT
+    return PRIORITY_INTERACTIVE
+
+def _on_quota_wait(step: str) -> Callable[[str, float], None]:
+    def notify(event: str, wait_ms: float) -> None:
+        if event == "queued":
+            _publish({"step": step, "message": "Waiting for LLM quota...", "progress": None})
+        else:
+            _publish({"step": step, "message": f"LLM quota wait: {wait_ms:.0f} ms", "progress": None,
+                      "queue_wait_ms": round(wait_ms, 2)})
+    return notify
+
+def _schedule(state: AgentState, request: Any) -> Any:
+    if not isinstance(request, LLMRequest):
+        return request
+    email = state.get("email") or {}
+    return dataclasses.replace(
+        request, priority=_llm_priority(state), on_wait=_on_quota_wait(request.name),
+        email_text=f"{email.get('subject', '')}\n{email.get('body', '')}",
+    )
+
+def _call_llm(llm: Any, state: AgentState, request: Any) -> Any:
+    started, wall = time.perf_counter(), time.time()
+    name = getattr(request, "name", "llm")
+    request = _schedule(state, request)
+    try:
+        msg = llm.invoke(request)
+    except Exception as e:
+        metrics.record_llm_call(
+            state.get("run_id"), name, wall, time.perf_counter() - started,
+            error=getattr(e, "code", None) or type(e).__name__, retries=getattr(e, "retries", None),
+        )
+        raise
+    metrics.record_llm_call(state.get("run_id"), name, wall, time.perf_counter() - started, msg)
+    return msg
+
+async def _acall_llm(llm: Any, state: AgentState, request: Any) -> Any:
+    started, wall = time.perf_counter(), time.time()
+    name = getattr(request, "name", "llm")
+    request = _schedule(state, request)
+    try:
+        msg = await llm.ainvoke(request)
+    except Exception as e:
+        metrics.record_llm_call(
+            state.get("run_id"), name, wall, time.perf_counter() - started,
+            error=getattr(e, "code", None) or type(e).__name__, retries=getattr(e, "retries", None),
+        )
+        raise
+    metrics.record_llm_call(state.get("run_id"), name, wall, time.perf_counter() - started, msg)
+    return msg
+
+# Nodes that call the LLM are generators: they yield formatted messages and get the
+# model response sent back, so one node body serves both the sync and async graphs.
+# A failed call is thrown in at the yield, so a node can fall back instead of failing the run.
+def _sync_node(llm: Any, fn: Callable[[AgentState], Any]) -> Callable[[AgentState], AgentState]:
+    if not inspect.isgeneratorfunction(fn):
+        return fn
+
+    @functools.wraps(fn)
+    def node(state: AgentState) -> AgentState:
+        gen = fn(state)
+        try:
+            messages = next(gen)
+            while True:
+                try:
+                    msg = _call_llm(llm, state, messages)
+                except Exception as e:
+                    messages = gen.throw(e)
+                else:
+                    messages = gen.send(msg)
+        except StopIteration as stop:
+            return stop.value
+
+    return node
+
+_DONE = object()
+
+def _step(gen: Any, value: Any, error: Optional[BaseException] = None) -> Any:
+    # StopIteration can't cross asyncio.to_thread, so completion is returned as a marker.
+    try:
+        return gen.throw(error) if error is not None else gen.send(value)
+    except StopIteration as stop:
+        return (_DONE, stop.value)
+
+def _async_node(llm: Any, fn: Callable[[AgentState], Any]) -> Callable[[AgentState], Any]:
+    if not inspect.isgeneratorfunction(fn):
+        return fn
+
+    @functools.wraps(fn)
+    async def node(state: AgentState) -> AgentState:
+        gen = fn(state)
+        # Non-LLM work between calls (SQLite, validation) runs off the event loop.
+        out = await asyncio.to_thread(_step, gen, None)
+        while not (isinstance(out, tuple) and out and out[0] is _DONE):
+            try:
+                msg = await _acall_llm(llm, state, out)
+            except Exception as e:
+                out = await asyncio.to_thread(_step, gen, None, e)
+            else:
+                out = await asyncio.to_thread(_step, gen, msg)
+        return out[1]
 
-def _emit(state: AgentState, step: str, message: str, progress: int) -> AgentState:
-    state["status_events"].append({"step": step, "message": message, "progress": progress})
-    return state
+    return node
 
-def build_graph() -> Any:
-    print("calling gpt")
-    llm = ChatOpenAI(model="gpt-4o", temperature=0.0, model_kwargs={"response_format": {"type": "json_object"}})
-    print("called gpt")
+def build_graph(async_mode: bool = False, fused: Optional[bool] = None, llm: Any = None, tickets: Any = None) -> Any:
+    fused = config.FUSED_CLASSIFY if fused is None else fused
+    # Ticket writes go through `tickets` (db by default); batch runs pass a buffer instead.
+    tickets = tickets if tickets is not None else db
+    llm = llm if llm is not None else build_llm()
+    # langgraph and the prompt templates are most of this module's import cost, so they load with the first graph.
+    from langchain_core.prompts import ChatPromptTemplate
+    from langgraph.graph import StateGraph, END
+    import product_index
 
     classify_prompt = ChatPromptTemplate.from_messages([
         ("system",
          "You are a strict email classifier for a sales/support organization. "
          "Return ONLY valid JSON that matches this schema:\n"
-         "{"
+         "{{"
          "\"category\": \"sales|support|unknown\", "
          "\"intent\": \"specific_product_query|requirement_to_product_suggestion|best_price_offer_or_bundling|need_more_information|other\", "
          "\"confidence\": number between 0 and 1, "
          "\"reasoning\": string"
-         "}.\n"
+         "}}.\n"
          "Use the provided knowledge base hints, but rely on the email content."),
         ("user",
-         "KNOWLEDGE BASE HINTS:\n{kb}\n\nEMAIL SUBJECT:\n{subject}\n\nEMAIL BODY:\n{body}\n")
+         "KNOWLEDGE BASE HINTS:\n{kb}\n\nEMAIL SUBJECT:\n{subject}\n\nEMAIL BODY:\n{body}\n\n"
+         "ATTACHMENTS (extracted text, may be truncated):\n{attachments}\n")
     ])
 
     intent_prompt = ChatPromptTemplate.from_messages([
         ("system",
          "You extract intent details. Return ONLY valid JSON:\n"
-         "{"
+         "{{"
          "\"mentions\": [\"...\"], "
          "\"need_keywords\": [\"...\"], "
          "\"wants_bundles\": true|false, "
@@ -67,81 +311,258 @@ def build_graph() -> Any:
          "\"support_symptoms\": [\"...\"], "
          "\"environment_hints\": [\"...\"], "
          "\"urgency\": \"low|medium|high\""
-         "}\n"
+         "}}\n"
          "Keep arrays short (max 8 items)."),
         ("user",
-         "EMAIL SUBJECT:\n{subject}\n\nEMAIL BODY:\n{body}\n\nCLASSIFICATION:\n{classification}\n")
+         "EMAIL SUBJECT:\n{subject}\n\nEMAIL BODY:\n{body}\n\n"
+         "ATTACHMENTS (extracted text, may be truncated):\n{attachments}\n\nCLASSIFICATION:\n{classification}\n")
+    ])
+
+    fused_prompt = ChatPromptTemplate.from_messages([
+        ("system",
+         "You are a strict email classifier for a sales/support organization and you also extract intent details. "
+         "Return ONLY valid JSON that matches this schema:\n"
+         "{{"
+         "\"category\": \"sales|support|unknown\", "
+         "\"intent\": \"specific_product_query|requirement_to_product_suggestion|best_price_offer_or_bundling|need_more_information|other\", "
+         "\"confidence\": number between 0 and 1, "
+         "\"reasoning\": string, "
+         "\"mentions\": [\"...\"], "
+         "\"need_keywords\": [\"...\"], "
+         "\"wants_bundles\": true|false, "
+         "\"needs_more_info\": true|false, "
+         "\"follow_up_questions\": [\"...\"], "
+         "\"support_symptoms\": [\"...\"], "
+         "\"environment_hints\": [\"...\"], "
+         "\"urgency\": \"low|medium|high\""
+         "}}.\n"
+         "Keep arrays short (max 8 items). "
+         "Use the provided knowledge base hints, but rely on the email content."),
+        ("user",
+         "KNOWLEDGE BASE HINTS:\n{kb}\n\nEMAIL SUBJECT:\n{subject}\n\nEMAIL BODY:\n{body}\n\n"
+         "ATTACHMENTS (extracted text, may be truncated):\n{attachments}\n")
     ])
 
     recommend_prompt = ChatPromptTemplate.from_messages([
         ("system",
-         "You are a product recommendation engine. Return ONLY valid JSON array. "
+         "You are a product recommendation engine. Return ONLY a valid JSON object: "
+         "{{\"recommendations\": [...]}}. "
          "Each item must have: sku, name, purpose, price_usd, score(0..1), reasoning. "
          "Rank best first. Provide 1-5 items."),
         ("user",
          "CUSTOMER NEEDS:\n{needs}\n\nAVAILABLE PRODUCTS:\n{products}\n")
     ])
 
-    bundle_prompt = ChatPromptTemplate.from_messages([
+    bundle_reason_prompt = ChatPromptTemplate.from_messages([
         ("system",
-         "You create bundle options. Return ONLY valid JSON array. "
-         "Each item: name, items(array of SKUs or product names), total_price_usd, score(0..1), reasoning. "
-         "Return exactly 5 items."),
+         "You explain pre-built product bundles to a sales rep. Do not change items or prices. "
+         "Return ONLY a valid JSON object: {{\"reasons\": [...]}} with one short reason per bundle, "
+         "in the same order as the bundles given."),
         ("user",
-         "CUSTOMER CONTEXT:\n{context}\n\nAVAILABLE ACTIVE PRODUCTS:\n{products}\n"
-         "Bundling guidance: keep bundles realistic and price-sensitive.")
+         "CUSTOMER CONTEXT:\n{context}\n\nBUNDLES:\n{bundles}\n")
     ])
 
-    def node_validate_input(state: AgentState) -> AgentState:
-        _emit(state, "validate", "Validating input and attachments...", 5)
+    def node_validate_input(state: AgentState) -> Dict[str, Any]:
+        events = _emit([], "validate", "Validating input and attachments...", 5)
         email = EmailInput.model_validate(state["email"])
         basic_input_guardrails(email.body)
-        state["email"] = email.model_dump()
-        return _emit(state, "validate", "Input validated.", 10)
+        _emit(events, "validate", "Input validated.", 10)
+        return {"email": email.model_dump(), "status_events": events}
+
+    def node_dedup(state: AgentState) -> Dict[str, Any]:
+        if not config.DEDUP_ENABLED:
+            return {}
+        email = state["email"]
+        shas = [a.get("sha256") or "" for a in state.get("attachments_meta") or []]
+        fingerprint = dedup.signature(email["subject"], email["body"], shas)
+        match = dedup.find_duplicate(fingerprint)
+        metrics.DEDUP_LOOKUPS.inc(result="skipped" if fingerprint is None else ("hit" if match else "miss"))
+        if not match:
+            return {"fingerprint": fingerprint}
+
+        # Same email as an existing ticket: link to it and reuse its classification.
+        ticket_id = match["ticket_id"]
+        events = _emit([], "dedup", f"Near-duplicate of {ticket_id}; linking instead of creating a new ticket.", 90)
+        cls = ClassificationResult.model_validate(match["classification"])
+        linked = {
+            "ticket_id": ticket_id,
+            "message_to_rep": (
+                f"This email is a near-duplicate of ticket {ticket_id} ({match['similarity']:.0%} similar). "
+                "No new ticket was created; continue on the existing one."
+            ),
+        }
+        final = FinalAgentResponse(
+            category=cls.category,
+            classification=cls,
+            sales=SalesWorkflowResult(**linked) if cls.category == "sales" else None,
+            support=SupportWorkflowResult(**linked) if cls.category != "sales" else None,
+            raw_debug={"duplicate_of": ticket_id, "similarity": round(match["similarity"], 3)},
+        )
+        return {
+            "classification": cls.model_dump(), "ticket_id": ticket_id, "final": final.model_dump(),
+            "status_events": events,
+        }
+
+    def route_duplicate(state: AgentState) -> str:
+        return "finalize" if state.get("final") else "extract_attachments"
+
+    def node_extract_attachments(state: AgentState) -> Dict[str, Any]:
+        records = state.get("attachments_meta") or []
+        if not config.EXTRACT_ENABLED or not records:
+            return {}
+        events = _emit([], "extract", f"Extracting text from {len(records)} attachment(s)...", 12)
+        extracted = extract.fit_to_budget(extract.extract_all(records))
+        tokens = sum(extract.estimate_tokens(e["text"]) for e in extracted)
+        readable = sum(1 for e in extracted if e["text"])
+        _emit(events, "extract", f"Extracted text from {readable}/{len(records)} attachment(s) (~{tokens} tokens).", 15)
+        return {"attachment_text": extracted, "status_events": events}
+
+    def attachments_text(state: AgentState) -> str:
+        return extract.render_for_prompt(state.get("attachment_text") or [])
 
-    def node_classify(state: AgentState) -> AgentState:
-        _emit(state, "classify", "Classifying email (sales vs support) and intent...", 20)
+    def _classify_fused(state: AgentState, events: List[Dict[str, Any]]):
         email = state["email"]
-        msg = llm.invoke(classify_prompt.format_messages(
+        msg = yield LLMRequest("classify_fused", fused_prompt.format_messages(
             kb=json.dumps(KB, ensure_ascii=False),
             subject=email["subject"],
-            body=email["body"]
-        ))
-        data = json.loads(msg.content)
-        data["confidence"] = clamp_confidence(data.get("confidence", 0.0))
-        cls = validate_or_raise(ClassificationResult, data)
-        state["classification"] = cls.model_dump()
-        return _emit(state, "classify", f"Classified as {cls.category} ({cls.intent}).", 35)
-
-    def route_category(state: AgentState) -> str:
+            body=email["body"],
+            attachments=attachments_text(state)
+        ), accept=_accepts(_parse_fused))
+        try:
+            fused_cls = _parse_fused(msg.content)
+        except (ValueError, AttributeError):
+            _emit(events, "classify", "Combined classification was invalid; falling back to two-step mode...", 25)
+            return None
+        cls = ClassificationResult.model_validate(fused_cls.model_dump(include=set(ClassificationResult.model_fields)))
+        details = IntentDetails.model_validate(fused_cls.model_dump(include=set(IntentDetails.model_fields)))
+        return cls, details.model_dump()
+
+    def _classify_llm(state: AgentState, events: List[Dict[str, Any]]):
+        if fused:
+            out = yield from _classify_fused(state, events)
+            if out is not None:
+                return out
+
+        email = state["email"]
+        msg = yield LLMRequest("classify", classify_prompt.format_messages(
+            kb=json.dumps(KB, ensure_ascii=False),
+            subject=email["subject"],
+            body=email["body"],
+            attachments=attachments_text(state)
+        ), accept=_accepts(_parse_classification))
+        return _parse_classification(msg.content), None
+
+    def node_classify(state: AgentState):
+        events = _emit([], "classify", "Classifying email (sales vs support) and intent...", 20)
+        email = state["email"]
+
+        pre = None
+        if config.PRECLASSIFIER_MODE in ("on", "shadow"):
+            attached = "\n".join(e["text"] for e in state.get("attachment_text") or [] if e.get("text"))
+            pre = preclassifier.get_classifier().classify(email["subject"], f"{email['body']}\n{attached}")
+        if config.PRECLASSIFIER_MODE == "on" and pre is not None and pre.confidence >= config.PRECLASSIFIER_THRESHOLD:
+            cls = ClassificationResult.model_validate(pre.to_classification())
+            _emit(events, "classify", f"Classified locally as {cls.category} ({cls.intent}).", 35)
+            return {"classification": cls.model_dump(), "status_events": events}
+
+        cls, details = yield from _classify_llm(state, events)
+        if config.PRECLASSIFIER_MODE in ("on", "shadow"):
+            preclassifier.record_shadow(state["run_id"], pre, cls.model_dump())
+
+        _emit(events, "classify", f"Classified as {cls.category} ({cls.intent}).", 35)
+        update: Dict[str, Any] = {"classification": cls.model_dump(), "status_events": events}
+        if details is not None:
+            update["intent_details"] = details
+        return update
+
+    def route_category(state: AgentState) -> List[str]:
         c = (state.get("classification") or {}).get("category", "unknown")
         if c == "sales":
-            return "sales_workflow"
+            return ["sales_ticket", "sales_intent", "sales_prefetch"]
         if c == "support":
-            return "support_workflow"
-        return "unknown_workflow"
+            return ["support_ticket", "support_intent"]
+        return ["unknown_workflow"]
 
-    def node_sales_workflow(state: AgentState) -> AgentState:
-        _emit(state, "sales", "Starting sales workflow: logging ticket...", 45)
+    def _extract_intent(state: AgentState):
         email = state["email"]
-        cls = state["classification"]
+        msg = yield LLMRequest("intent", intent_prompt.format_messages(
+            subject=email["subject"],
+            body=email["body"],
+            attachments=attachments_text(state),
+            classification=json.dumps(state["classification"] or {}, ensure_ascii=False)
+        ), accept=_accepts(_parse_object))
+        return _parse_object(msg.content)
 
-        ticket_id = db.create_sales_ticket(
+    def node_sales_ticket(state: AgentState) -> Dict[str, Any]:
+        events = _emit([], "sales", "Starting sales workflow: logging ticket...", 45)
+        email = state["email"]
+        ticket_id = tickets.create_sales_ticket(
             email_subject=email["subject"],
             email_body=email["body"],
             attachments=state["attachments_meta"],
-            classification=cls,
+            classification=state["classification"],
             customer_hint=None
         )
-        _emit(state, "sales", f"Sales ticket created: {ticket_id}", 55)
+        dedup.remember(ticket_id, state.get("fingerprint"))
+        _emit(events, "sales", f"Sales ticket created: {ticket_id}", 55)
+        return {"ticket_id": ticket_id, "status_events": events}
+
+    def node_sales_intent(state: AgentState):
+        if state.get("intent_details") is not None:
+            return {}
+        events = _emit([], "sales", "Extracting intent details from email...", 50)
+        details = yield from _extract_intent(state)
+        _emit(events, "sales", "Intent details extracted.", 60)
+        return {"intent_details": details, "status_events": events}
+
+    def node_sales_prefetch(state: AgentState) -> Dict[str, Any]:
+        # Speculative: if the catalog changed, the snapshot is rebuilt here while the ticket
+        # insert and intent extraction are in flight rather than inside sales_recommend.
+        intent = (state["classification"] or {}).get("intent")
+        if intent in ("requirement_to_product_suggestion", "best_price_offer_or_bundling"):
+            snapshot = catalog.get_catalog()
+            if config.PRODUCT_INDEX_ENABLED:
+                product_index.get_index(snapshot)
+        return {}
+
+    def _catalog_json(snapshot: catalog.CatalogSnapshot, query: str, k: int) -> str:
+        # Top-k active products for the email, so the prompt doesn't grow with the catalog.
+        if not config.PRODUCT_INDEX_ENABLED or len(snapshot.active) <= k:
+            return snapshot.active_json
+        return json.dumps(product_index.search_products(query, k, snapshot), ensure_ascii=False)
+
+    def _generate_items(call: str, messages: Any, cache_extra: str, limit: int = 5):
+        # Streams the recommend call; each item is validated and published as its own
+        # event as soon as it is complete. The parsed final response stays authoritative.
+        kind, key, model = ITEM_CALLS[call]
+
+        def publish(index: int, item: Dict[str, Any]) -> bool:
+            item = dict(item, score=clamp_confidence(item.get("score", 0.0)))
+            try:
+                validated = model.model_validate(item)
+            except ValidationError:
+                return False
+            _publish({"event": kind, "step": "sales", "index": index, "item": validated.model_dump()})
+            return True
+
+        stream = JsonArrayStream(publish, limit=limit)
+        msg = yield LLMRequest(call, messages, cache_extra=cache_extra, on_delta=stream.feed,
+                               accept=_accepts(lambda content: _parse_validated_items(content, call, limit)))
+        out = _parse_validated_items(msg.content, call, limit)
+        # Cache hits (and non-streaming backends) publish everything here, as do retries for
+        # items an earlier attempt streamed invalid.
+        for index, item in enumerate(out):
+            if index not in stream.emitted:
+                publish(index, item.model_dump())
+        return out
+
+    def node_sales_recommend(state: AgentState):
+        events: List[Dict[str, Any]] = []
+        email = state["email"]
+        cls = state["classification"]
+        ticket_id = state["ticket_id"]
+        details = state.get("intent_details") or {}
 
-        _emit(state, "sales", "Extracting intent details from email...", 60)
-        msg = llm.invoke(intent_prompt.format_messages(
-            subject=email["subject"],
-            body=email["body"],
-            classification=json.dumps(cls, ensure_ascii=False)
-        ))
-        details = json.loads(msg.content)
         mentions = (details.get("mentions") or [])[:8]
         need_keywords = (details.get("need_keywords") or [])[:8]
         wants_bundles = bool(details.get("wants_bundles"))
@@ -149,12 +570,13 @@ def build_graph() -> Any:
         follow_up_questions = (details.get("follow_up_questions") or [])[:6]
 
         intent = cls.get("intent", "other")
+        snapshot = catalog.get_catalog()
         recs: List[ProductRecommendation] = []
         bundles: List[BundleOption] = []
         rep_message = ""
 
         if intent == "specific_product_query":
-            _emit(state, "sales", "Searching product database for mentioned products...", 70)
+            _emit(events, "sales", "Searching product database for mentioned products...", 70)
             found = db.search_products_by_exact_mention(mentions)
             if not found:
                 rep_message = (
@@ -165,14 +587,10 @@ def build_graph() -> Any:
                 active_found = [p for p in found if p["is_active"] == 1]
                 inactive_found = [p for p in found if p["is_active"] == 0]
                 if active_found:
-                    msg2 = llm.invoke(recommend_prompt.format_messages(
+                    recs = yield from _generate_items("recommend", recommend_prompt.format_messages(
                         needs="Customer asked for specific product(s). Recommend the closest match from the list.",
                         products=json.dumps(active_found, ensure_ascii=False)
-                    ))
-                    arr = json.loads(msg2.content)
-                    for item in arr[:5]:
-                        item["score"] = clamp_confidence(item.get("score", 0.0))
-                        recs.append(ProductRecommendation.model_validate(item))
+                    ), snapshot.cache_key)
                     rep_message = f"Ticket {ticket_id} logged. Found matching product(s) for the customer."
                 else:
                     rep_message = f"Ticket {ticket_id} logged. The mentioned product appears to be no longer available."
@@ -180,38 +598,52 @@ def build_graph() -> Any:
                         rep_message += " Consider proposing active alternatives."
 
         elif intent == "requirement_to_product_suggestion":
-            _emit(state, "sales", "Interpreting requirements and finding suitable products...", 70)
+            _emit(events, "sales", "Interpreting requirements and finding suitable products...", 70)
             candidates = db.search_products_by_need_keywords(need_keywords, limit=10)
-            active = [p for p in candidates if p["is_active"] == 1] or db.get_active_products()
-            msg2 = llm.invoke(recommend_prompt.format_messages(
+            active = [p for p in candidates if p["is_active"] == 1]
+            query = " ".join([*need_keywords, email["subject"], email["body"]])
+            recs = yield from _generate_items("recommend", recommend_prompt.format_messages(
                 needs=json.dumps({"need_keywords": need_keywords, "subject": email["subject"]}, ensure_ascii=False),
-                products=json.dumps(active, ensure_ascii=False)
-            ))
-            arr = json.loads(msg2.content)
-            for item in arr[:5]:
-                item["score"] = clamp_confidence(item.get("score", 0.0))
-                recs.append(ProductRecommendation.model_validate(item))
+                products=(json.dumps(active, ensure_ascii=False) if active
+                          else _catalog_json(snapshot, query, config.PRODUCT_INDEX_TOP_K))
+            ), snapshot.cache_key)
             rep_message = f"Ticket {ticket_id} logged. Suggested multiple product options at different price points."
 
         elif intent == "best_price_offer_or_bundling" or wants_bundles:
-            _emit(state, "sales", "Creating bundle options and best price offers...", 70)
-            active = db.get_active_products()
-            msg2 = llm.invoke(bundle_prompt.format_messages(
-                context=json.dumps({"need_keywords": need_keywords, "mentions": mentions}, ensure_ascii=False),
-                products=json.dumps(active, ensure_ascii=False),
-            ))
-            arr = json.loads(msg2.content)
-            for item in arr[:5]:
-                item["score"] = clamp_confidence(item.get("score", 0.0))
-                bundles.append(BundleOption.model_validate(item))
-            bundles.sort(key=lambda b: b.total_price_usd)
-            rep_message = f"Ticket {ticket_id} logged. Generated 5 bundle options sorted by price."
+            _emit(events, "sales", "Building bundle options from catalog prices...", 70)
+            query = " ".join([*need_keywords, *mentions, email["subject"], email["body"]])
+            mentioned = [p["sku"] for p in db.search_products_by_exact_mention(mentions)] if mentions else []
+            budget = bundler.parse_budget(email["body"])
+            options = bundler.build_bundles(snapshot, query, mentioned, budget)
+            # Items and prices are final here, so they go out before the (optional) reasoning call.
+            for index, option in enumerate(options):
+                _publish({"event": "bundle", "step": "sales", "index": index, "item": option})
+            if options and config.BUNDLE_REASONING == "llm":
+                try:
+                    msg = yield LLMRequest("bundle_reasoning", bundle_reason_prompt.format_messages(
+                        context=json.dumps({"need_keywords": need_keywords, "mentions": mentions,
+                                            "budget_usd": budget}, ensure_ascii=False),
+                        bundles=json.dumps([{k: o[k] for k in ("name", "items", "total_price_usd")} for o in options],
+                                           ensure_ascii=False),
+                    ), cache_extra=snapshot.cache_key, accept=_has_reasons)
+                except LLMCallFailed as e:
+                    # The bundles are already final; a timeout, open circuit or quota give-up
+                    # only costs the prose, so the template reasons stay.
+                    _publish({"step": "sales", "message": f"Bundle reasoning unavailable ({e.code}).",
+                              "progress": None})
+                else:
+                    options = bundler.apply_reasons(options, msg.content)
+            bundles = [BundleOption.model_validate(o) for o in options]
+            rep_message = (f"Ticket {ticket_id} logged. Built {len(bundles)} bundle option(s) from catalog prices, "
+                           "sorted by price.")
+            if budget is not None and not bundles:
+                rep_message += f" No active products fit the ${budget:,.2f} budget."
 
         else:
             needs_more_info = True
 
         if needs_more_info:
-            _emit(state, "sales", "Need more information to proceed accurately.", 78)
+            _emit(events, "sales", "Need more information to proceed accurately.", 78)
             if not follow_up_questions:
                 follow_up_questions = [
                     "Which product category are you most interested in (CRM, Support Desk, Analytics, etc.)?",
@@ -228,7 +660,7 @@ def build_graph() -> Any:
             follow_up_questions=follow_up_questions
         )
 
-        _emit(state, "sales", "Validating output against guardrails...", 88)
+        _emit(events, "sales", "Validating output against guardrails...", 88)
         validate_or_raise(SalesWorkflowResult, result.model_dump())
 
         final = FinalAgentResponse(
@@ -236,15 +668,15 @@ def build_graph() -> Any:
             classification=ClassificationResult.model_validate(cls),
             sales=result
         )
-        state["final"] = final.model_dump()
-        return _emit(state, "sales", "Sales workflow complete.", 95)
+        _emit(events, "sales", "Sales workflow complete.", 95)
+        return {"final": final.model_dump(), "status_events": events}
 
-    def node_support_workflow(state: AgentState) -> AgentState:
-        _emit(state, "support", "Starting support workflow: logging ticket...", 45)
+    def node_support_ticket(state: AgentState) -> Dict[str, Any]:
+        events = _emit([], "support", "Starting support workflow: logging ticket...", 45)
         email = state["email"]
         cls = state["classification"] or {}
 
-        ticket_id = db.create_support_ticket(
+        ticket_id = tickets.create_support_ticket(
             email_subject=email["subject"],
             email_body=email["body"],
             attachments=state["attachments_meta"],
@@ -253,15 +685,24 @@ def build_graph() -> Any:
             classification=cls,
             customer_hint=None
         )
-        _emit(state, "support", f"Support ticket created: {ticket_id}", 55)
+        dedup.remember(ticket_id, state.get("fingerprint"))
+        _emit(events, "support", f"Support ticket created: {ticket_id}", 55)
+        return {"ticket_id": ticket_id, "status_events": events}
+
+    def node_support_intent(state: AgentState):
+        if state.get("intent_details") is not None:
+            return {}
+        events = _emit([], "support", "Extracting troubleshooting context and follow-up questions...", 50)
+        details = yield from _extract_intent(state)
+        _emit(events, "support", "Troubleshooting context extracted.", 65)
+        return {"intent_details": details, "status_events": events}
+
+    def node_support_compose(state: AgentState) -> Dict[str, Any]:
+        events: List[Dict[str, Any]] = []
+        cls = state["classification"] or {}
+        ticket_id = state["ticket_id"]
+        details = state.get("intent_details") or {}
 
-        _emit(state, "support", "Extracting troubleshooting context and follow-up questions...", 65)
-        msg = llm.invoke(intent_prompt.format_messages(
-            subject=email["subject"],
-            body=email["body"],
-            classification=json.dumps(cls, ensure_ascii=False)
-        ))
-        details = json.loads(msg.content)
         follow_up_questions = (details.get("follow_up_questions") or [])[:6]
         symptoms = (details.get("support_symptoms") or [])[:8]
         env = (details.get("environment_hints") or [])[:8]
@@ -291,7 +732,7 @@ def build_graph() -> Any:
             follow_up_questions=follow_up_questions
         )
 
-        _emit(state, "support", "Validating output against guardrails...", 88)
+        _emit(events, "support", "Validating output against guardrails...", 88)
         validate_or_raise(SupportWorkflowResult, result.model_dump())
 
         final = FinalAgentResponse(
@@ -299,11 +740,11 @@ def build_graph() -> Any:
             classification=ClassificationResult.model_validate(cls),
             support=result
         )
-        state["final"] = final.model_dump()
-        return _emit(state, "support", "Support workflow complete.", 95)
+        _emit(events, "support", "Support workflow complete.", 95)
+        return {"final": final.model_dump(), "status_events": events}
 
-    def node_unknown_workflow(state: AgentState) -> AgentState:
-        _emit(state, "unknown", "Unable to confidently classify. Asking for more information...", 60)
+    def node_unknown_workflow(state: AgentState) -> Dict[str, Any]:
+        events = _emit([], "unknown", "Unable to confidently classify. Asking for more information...", 60)
         cls = state["classification"] or {
             "category": "unknown",
             "intent": "need_more_information",
@@ -323,31 +764,49 @@ def build_graph() -> Any:
                 ]
             )
         )
-        state["final"] = final.model_dump()
-        return _emit(state, "unknown", "Done.", 95)
+        _emit(events, "unknown", "Done.", 95)
+        return {"final": final.model_dump(), "status_events": events}
 
-    def node_finalize(state: AgentState) -> AgentState:
-        _emit(state, "finalize", "Finalizing response...", 99)
+    def node_finalize(state: AgentState) -> Dict[str, Any]:
+        events = _emit([], "finalize", "Finalizing response...", 99)
         validate_or_raise(FinalAgentResponse, state["final"])
-        return _emit(state, "finalize", "Completed.", 100)
+        _emit(events, "finalize", "Completed.", 100)
+        return {"status_events": events}
+
+    drive = _async_node if async_mode else _sync_node
+    nodes = {
+        "validate_input": node_validate_input,
+        "dedup": node_dedup,
+        "extract_attachments": node_extract_attachments,
+        "classify": node_classify,
+        "sales_ticket": node_sales_ticket,
+        "sales_intent": node_sales_intent,
+        "sales_prefetch": node_sales_prefetch,
+        "sales_recommend": node_sales_recommend,
+        "support_ticket": node_support_ticket,
+        "support_intent": node_support_intent,
+        "support_compose": node_support_compose,
+        "unknown_workflow": node_unknown_workflow,
+        "finalize": node_finalize,
+    }
 
     g = StateGraph(AgentState)
-    g.add_node("validate_input", node_validate_input)
-    g.add_node("classify", node_classify)
-    g.add_node("sales_workflow", node_sales_workflow)
-    g.add_node("support_workflow", node_support_workflow)
-    g.add_node("unknown_workflow", node_unknown_workflow)
-    g.add_node("finalize", node_finalize)
+    for name, fn in nodes.items():
+        g.add_node(name, _timed(name, drive(llm, fn)))
 
     g.set_entry_point("validate_input")
-    g.add_edge("validate_input", "classify")
-    g.add_conditional_edges("classify", route_category, {
-        "sales_workflow": "sales_workflow",
-        "support_workflow": "support_workflow",
-        "unknown_workflow": "unknown_workflow",
-    })
-    g.add_edge("sales_workflow", "finalize")
-    g.add_edge("support_workflow", "finalize")
+    g.add_edge("validate_input", "dedup")
+    g.add_conditional_edges("dedup", route_duplicate, ["extract_attachments", "finalize"])
+    g.add_edge("extract_attachments", "classify")
+    g.add_conditional_edges("classify", route_category, [
+        "sales_ticket", "sales_intent", "sales_prefetch",
+        "support_ticket", "support_intent",
+        "unknown_workflow",
+    ])
+    g.add_edge(["sales_ticket", "sales_intent", "sales_prefetch"], "sales_recommend")
+    g.add_edge(["support_ticket", "support_intent"], "support_compose")
+    g.add_edge("sales_recommend", "finalize")
+    g.add_edge("support_compose", "finalize")
     g.add_edge("unknown_workflow", "finalize")
     g.add_edge("finalize", END)
 
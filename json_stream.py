@@ -0,0 +1,85 @@
+import json
+from typing import Any, Callable, Dict, List, Optional, Set
+
+# Incremental parsing of the first JSON array in a streamed model response, e.g.
+# {"recommendations": [{...}, {...}]} or a bare [...]. Each top-level object in the
+# array is handed to on_item as soon as its closing brace arrives.
+
+
+class JsonArrayStream:
+    def __init__(self, on_item: Callable[[int, Dict[str, Any]], bool], limit: Optional[int] = None):
+        # on_item returns whether it used the item; only those count as emitted.
+        self.on_item = on_item
+        self.limit = limit
+        # Survives reset(): a retried attempt re-streams from the start and must not repeat
+        # items, but may still deliver ones an earlier attempt got wrong.
+        self.emitted: Set[int] = set()
+        self.reset()
+
+    def reset(self) -> None:
+        self._buf = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._escape = False
+        self._array_depth: Optional[int] = None
+        self._item_start: Optional[int] = None
+        self._done = False
+        self._count = 0
+
+    def feed(self, text: Optional[str]) -> None:
+        # None marks the start of a new attempt.
+        if text is None:
+            self.reset()
+            return
+        if self._done or not text:
+            return
+        self._buf += text
+        buf = self._buf
+        while self._pos < len(buf) and not self._done:
+            ch = buf[self._pos]
+            if self._in_str:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch in "[{":
+                if ch == "[" and self._array_depth is None:
+                    self._array_depth = self._depth + 1
+                elif ch == "{" and self._depth == self._array_depth:
+                    self._item_start = self._pos
+                self._depth += 1
+            elif ch in "]}":
+                self._depth -= 1
+                if ch == "}" and self._item_start is not None and self._depth == self._array_depth:
+                    self._item(buf[self._item_start:self._pos + 1])
+                    self._item_start = None
+                elif ch == "]" and self._array_depth is not None and self._depth == self._array_depth - 1:
+                    self._done = True
+            self._pos += 1
+
+    def _item(self, raw: str) -> None:
+        index = self._count
+        self._count += 1
+        if index in self.emitted or (self.limit is not None and index >= self.limit):
+            return
+        try:
+            item = json.loads(raw)
+        except ValueError:
+            return
+        if self.on_item(index, item):
+            self.emitted.add(index)
+
+
+def parse_items(content: str, key: str) -> List[Dict[str, Any]]:
+    # json_object mode returns an object; older prompts (and some recordings) return a bare array.
+    data = json.loads(content)
+    if isinstance(data, dict):
+        data = data[key] if isinstance(data.get(key), list) else next(
+            (v for v in data.values() if isinstance(v, list)), []
+        )
+    return [item for item in data if isinstance(item, dict)] if isinstance(data, list) else []
@@ -0,0 +1,10 @@
+KB = {
+    "sales": ["pricing", "quote", "discount", "bundle", "purchase", "buy", "trial", "demo", "renewal", "invoice"],
+    "support": ["error", "bug", "issue", "not working", "down", "broken", "failed", "incident", "unable", "crash"],
+    "intent_rules": {
+        "specific_product_query": ["sku", "product code", "looking for", "is available", "availability"],
+        "requirement_to_product_suggestion": ["recommend", "suggest", "best fit", "need a solution", "requirements"],
+        "best_price_offer_or_bundling": ["bundle", "best price", "discount", "offer", "package"],
+        "need_more_information": ["clarify", "need more info", "not sure", "details needed"]
+    }
+}
@@ -0,0 +1,44 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+# Built-on-first-use holder for the expensive runtime objects (LLM client, compiled
+# graphs), so importing app/asgi stays cheap and a missing API key surfaces on
+# readiness rather than as an import error. Failed builds are retried on the next get().
+
+
+class Lazy:
+    def __init__(self, name: str, factory: Callable[[], Any]):
+        self.name = name
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value: Any = None
+        self._ready = False
+        self.build_ms: Optional[float] = None
+        self.error: Optional[str] = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready
+
+    def get(self) -> Any:
+        if self._ready:
+            return self._value
+        with self._lock:
+            if not self._ready:
+                started = time.perf_counter()
+                try:
+                    self._value = self._factory()
+                except Exception as e:
+                    self.error = f"{type(e).__name__}: {e}"
+                    raise
+                self.build_ms = round((time.perf_counter() - started) * 1000, 2)
+                self.error = None
+                self._ready = True
+        return self._value
+
+    def peek(self) -> Any:
+        return self._value if self._ready else None
+
+    def status(self) -> Dict[str, Any]:
+        return {"ready": self._ready, "build_ms": self.build_ms, "error": self.error}
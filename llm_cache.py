@@ -0,0 +1,154 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from langchain_core.messages import AIMessage
+
+import config
+import db
+from llm_client import LLMRequest, as_request
+
+
+def cache_key(key_params: Dict[str, Any], request: LLMRequest) -> str:
+    payload = {
+        "params": key_params,
+        "messages": [(m.type, m.content) for m in request.messages],
+        "extra": request.cache_extra,
+    }
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _to_record(msg: Any) -> Dict[str, Any]:
+    return {
+        "content": msg.content,
+        "usage_metadata": dict(getattr(msg, "usage_metadata", None) or {}),
+    }
+
+
+def _from_record(record: Dict[str, Any], tier: str) -> AIMessage:
+    return AIMessage(
+        content=record["content"],
+        response_metadata={"cache_hit": True, "cache_tier": tier},
+    )
+
+
+class CachedLLM:
+    # Content-addressed response cache in front of a chat model: an in-process LRU tier
+    # backed by the llm_cache table in runtime.db. Entries expire after ttl_s.
+    def __init__(
+        self,
+        llm: Any,
+        key_params: Dict[str, Any],
+        ttl_s: Optional[int] = None,
+        memory_items: Optional[int] = None,
+        max_rows: Optional[int] = None,
+    ):
+        self.llm = llm
+        self.key_params = key_params
+        self.ttl_s = config.LLM_CACHE_TTL_S if ttl_s is None else ttl_s
+        self.memory_items = config.LLM_CACHE_MEMORY_ITEMS if memory_items is None else memory_items
+        self.max_rows = config.LLM_CACHE_MAX_ROWS if max_rows is None else max_rows
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._stats = {"memory_hits": 0, "sqlite_hits": 0, "misses": 0, "stores": 0, "rejected": 0, "evictions": 0}
+        self._stores_since_prune = 0
+
+    def _memory_get(self, key: str, now: float) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            hit = self._memory.get(key)
+            if hit is None:
+                return None
+            created_at, record = hit
+            if now - created_at > self.ttl_s:
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            self._stats["memory_hits"] += 1
+            return record
+
+    def _memory_put(self, key: str, created_at: float, record: Dict[str, Any]) -> None:
+        with self._lock:
+            self._memory[key] = (created_at, record)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_items:
+                self._memory.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def _lookup(self, key: str) -> Optional[AIMessage]:
+        now = time.time()
+        record = self._memory_get(key, now)
+        if record is not None:
+            return _from_record(record, "memory")
+
+        row = db.llm_cache_get(key, min_created_at=now - self.ttl_s)
+        if row is not None:
+            record = json.loads(row["value"])
+            self._memory_put(key, row["created_at"], record)
+            with self._lock:
+                self._stats["sqlite_hits"] += 1
+            return _from_record(record, "sqlite")
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def _accepted(self, request: LLMRequest, msg: Any) -> bool:
+        if request.accept is None:
+            return True
+        try:
+            ok = bool(request.accept(msg))
+        except Exception:
+            ok = False
+        if not ok:
+            with self._lock:
+                self._stats["rejected"] += 1
+        return ok
+
+    def _store(self, key: str, msg: Any) -> None:
+        now = time.time()
+        record = _to_record(msg)
+        self._memory_put(key, now, record)
+        db.llm_cache_put(key, json.dumps(record, ensure_ascii=False), now)
+        with self._lock:
+            self._stats["stores"] += 1
+            self._stores_since_prune += 1
+            prune = self._stores_since_prune >= 100
+            if prune:
+                self._stores_since_prune = 0
+        if prune:
+            db.llm_cache_prune(self.max_rows, min_created_at=now - self.ttl_s)
+
+    def invoke(self, request: Any, **kwargs: Any) -> Any:
+        request = as_request(request)
+        key = cache_key(self.key_params, request)
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached
+        msg = self.llm.invoke(request, **kwargs)
+        if self._accepted(request, msg):
+            self._store(key, msg)
+        return msg
+
+    async def ainvoke(self, request: Any, **kwargs: Any) -> Any:
+        request = as_request(request)
+        key = cache_key(self.key_params, request)
+        cached = await asyncio.to_thread(self._lookup, key)
+        if cached is not None:
+            return cached
+        msg = await self.llm.ainvoke(request, **kwargs)
+        if self._accepted(request, msg):
+            await asyncio.to_thread(self._store, key, msg)
+        return msg
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            out: Dict[str, Any] = dict(self._stats)
+            out["memory_items"] = len(self._memory)
+        lookups = out["memory_hits"] + out["sqlite_hits"] + out["misses"]
+        out["hit_ratio"] = round((out["memory_hits"] + out["sqlite_hits"]) / lookups, 3) if lookups else None
+        return out
@@ -0,0 +1,93 @@
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, Optional, Sequence, Union
+
+from langchain_core.messages import BaseMessage
+
+
+@dataclass(frozen=True)
+class LLMRequest:
+    name: str
+    messages: Sequence[BaseMessage]
+    # Extra cache-key material for prompts whose answer depends on state outside the
+    # messages themselves (e.g. the product catalog revision).
+    cache_extra: str = ""
+    # Scheduling only (never part of the cache key): rate-limit priority, lower is sooner,
+    # and a hook told when the call queues for quota and when it is admitted.
+    priority: int = 1
+    on_wait: Optional[Callable[[str, float], None]] = field(default=None, compare=False, repr=False)
+    # When set, the model response is streamed: called with each text delta, and with
+    # None whenever a (re)try starts over.
+    on_delta: Optional[Callable[[Optional[str]], None]] = field(default=None, compare=False, repr=False)
+    # Checks a fresh response before the cache stores it; a falsy result or an exception keeps
+    # a malformed answer from being replayed to every retry of the same email.
+    accept: Optional[Callable[[Any], bool]] = field(default=None, compare=False, repr=False)
+    # Subject and body of the email the prompt is about (already inside the messages, so not
+    # part of the cache key); the offline fake matches its scripted answers against it.
+    email_text: str = field(default="", compare=False, repr=False)
+
+
+def as_request(request: Union[LLMRequest, List[BaseMessage]]) -> LLMRequest:
+    if isinstance(request, LLMRequest):
+        return request
+    return LLMRequest(name="llm", messages=list(request))
+
+
+class ChatClient:
+    # Innermost layer: unwraps LLMRequest for the LangChain chat model. Wrappers
+    # (cache, ...) take and pass on LLMRequest objects.
+    def __init__(self, model: Any):
+        self.model = model
+
+    def invoke(self, request: Any, **kwargs: Any) -> Any:
+        request = as_request(request)
+        if request.on_delta is None:
+            return self.model.invoke(list(request.messages), **kwargs)
+        request.on_delta(None)
+        full = None
+        for chunk in self.model.stream(list(request.messages), stream_usage=True, **kwargs):
+            request.on_delta(chunk.content)
+            full = chunk if full is None else full + chunk
+        return full
+
+    async def ainvoke(self, request: Any, **kwargs: Any) -> Any:
+        request = as_request(request)
+        if request.on_delta is None:
+            return await self.model.ainvoke(list(request.messages), **kwargs)
+        request.on_delta(None)
+        full = None
+        async for chunk in self.model.astream(list(request.messages), stream_usage=True, **kwargs):
+            request.on_delta(chunk.content)
+            full = chunk if full is None else full + chunk
+        return full
+
+
+def build_llm(provider: Optional[str] = None, cache: Optional[bool] = None) -> Any:
+    import config
+    from llm_cache import CachedLLM
+    from llm_policy import ResilientLLM
+    from rate_limit import RateLimitedLLM
+
+    provider = (provider or config.LLM_PROVIDER).lower()
+    cache = config.LLM_CACHE_ENABLED if cache is None else cache
+    params = {"model": "gpt-4o", "temperature": 0.0, "model_kwargs": {"response_format": {"type": "json_object"}}}
+    llm: Any
+    if provider == "fake":
+        from fake_llm import FakeLLM, load_recordings
+
+        llm = FakeLLM(load_recordings(config.FAKE_LLM_RECORDINGS))
+        params = {"provider": "fake"}
+    else:
+        from langchain_openai import ChatOpenAI
+
+        # Timeouts and retries are owned by ResilientLLM; the client's own stay out of the cache key.
+        llm = ChatClient(ChatOpenAI(**params, timeout=config.LLM_TIMEOUT_S, max_retries=0))
+    llm = ResilientLLM(llm)
+    if provider != "fake" and config.LLM_RECORD_PATH:
+        from fake_llm import RecordingLLM
+
+        llm = RecordingLLM(llm, config.LLM_RECORD_PATH)
+    if config.LLM_RATE_RPM > 0 or config.LLM_RATE_TPM > 0:
+        llm = RateLimitedLLM(llm)
+    if cache:
+        llm = CachedLLM(llm, key_params=params)
+    return llm
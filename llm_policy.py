@@ -0,0 +1,367 @@
+import asyncio
+import contextvars
+import dataclasses
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import config
+import db
+from llm_client import as_request
+
+# Timeout, retry, hedging and circuit-breaker policy around the raw chat model. It sits
+# under the response cache, so cache hits skip all of it. Outcomes are attached to the
+# returned message's response_metadata (retries, hedged, hedge_won) for metrics.
+
+RETRYABLE_STATUS = (408, 409, 429)
+
+
+class LLMCallFailed(RuntimeError):
+    # Raised when a call gives up; `code` is what clients see in the run's error event.
+    def __init__(self, call: str, code: str, message: str, retries: int = 0, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.call = call
+        self.code = code
+        self.retries = retries
+        self.retry_after = retry_after
+
+
+class LLMTimeout(TimeoutError):
+    pass
+
+
+def _status_of(e: BaseException) -> Optional[int]:
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(e: BaseException) -> bool:
+    if isinstance(e, (TimeoutError, ConnectionError)):
+        return True
+    status = _status_of(e)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    # openai's timeout/connection errors carry no status code.
+    return type(e).__name__ in ("APITimeoutError", "APIConnectionError")
+
+
+def _retry_after(e: BaseException) -> Optional[float]:
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    raw = headers.get("retry-after") if hasattr(headers, "get") else None
+    try:
+        return float(raw) if raw is not None else None
+    except ValueError:
+        return None
+
+
+def backoff_s(attempt: int, e: Optional[BaseException] = None) -> float:
+    # Full jitter; a server-provided Retry-After wins when it is longer.
+    delay = random.uniform(0, min(config.LLM_BACKOFF_MAX_S, config.LLM_BACKOFF_BASE_S * (2 ** attempt)))
+    hint = _retry_after(e) if e is not None else None
+    return min(config.LLM_BACKOFF_MAX_S, max(delay, hint or 0.0))
+
+
+class _DeltaGate:
+    # Streamed deltas reach the caller only from the current attempt; a timed-out attempt
+    # may still be running in its thread and must not interleave with the retry.
+    def __init__(self, on_delta: Any):
+        self.on_delta = on_delta
+        self.current = -1
+        self._lock = threading.Lock()
+
+    def bind(self, request: Any, attempt: int) -> Any:
+        if self.on_delta is None:
+            return request
+        with self._lock:
+            self.current = attempt
+
+        def forward(text: Optional[str]) -> None:
+            with self._lock:
+                if self.current == attempt:
+                    self.on_delta(text)
+
+        return dataclasses.replace(request, on_delta=forward)
+
+    def close(self) -> None:
+        # After the call returns or gives up, no attempt may write to the caller any more.
+        with self._lock:
+            self.current = -1
+
+
+class CircuitBreaker:
+    # State lives in the llm_circuit table so every worker sees the same circuit; each
+    # process only re-reads it every LLM_BREAKER_REFRESH_S while it looks closed.
+    def __init__(self, name: str, threshold: Optional[int] = None, cooldown_s: Optional[float] = None):
+        self.name = name
+        self.threshold = config.LLM_BREAKER_FAILURES if threshold is None else threshold
+        self.cooldown_s = config.LLM_BREAKER_COOLDOWN_S if cooldown_s is None else cooldown_s
+        self._lock = threading.Lock()
+        self._cached: Dict[str, Any] = {"state": "closed", "failures": 0, "opened_until": 0.0}
+        self._fetched_at = 0.0
+        self.rejected = 0
+
+    def _state(self, now: float, fresh: bool = False) -> Dict[str, Any]:
+        with self._lock:
+            if fresh or now - self._fetched_at >= config.LLM_BREAKER_REFRESH_S:
+                self._cached = db.circuit_get(self.name)
+                self._fetched_at = now
+            return dict(self._cached)
+
+    def _remember(self, state: Dict[str, Any], now: float) -> None:
+        with self._lock:
+            self._cached = state
+            self._fetched_at = now
+
+    def before_call(self, call: str) -> None:
+        if self.threshold <= 0:
+            return
+        now = time.time()
+        state = self._state(now)
+        if state["state"] == "closed":
+            return
+        state = self._state(now, fresh=True)
+        if state["state"] == "closed" or (state["opened_until"] <= now and db.circuit_try_probe(self.name, self.cooldown_s, now)):
+            return
+        with self._lock:
+            self.rejected += 1
+        retry_after = max(0.0, state["opened_until"] - now)
+        raise LLMCallFailed(
+            call, "llm_circuit_open", f"LLM is unavailable (circuit open, retry in {retry_after:.0f}s)",
+            retry_after=retry_after,
+        )
+
+    def record_failure(self) -> None:
+        if self.threshold > 0:
+            now = time.time()
+            self._remember(db.circuit_record_failure(self.name, self.threshold, self.cooldown_s, now), now)
+
+    def record_success(self) -> None:
+        if self.threshold <= 0:
+            return
+        now = time.time()
+        # Only write when something needs resetting; the common case stays read-only.
+        state = self._state(now)
+        if state["state"] != "closed" or state["failures"]:
+            db.circuit_record_success(self.name, now)
+            self._remember({"state": "closed", "failures": 0, "opened_until": 0.0}, now)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._state(time.time(), fresh=True), "threshold": self.threshold,
+                "cooldown_s": self.cooldown_s, "rejected_here": self.rejected}
+
+
+class ResilientLLM:
+    def __init__(
+        self,
+        llm: Any,
+        breaker: Optional[CircuitBreaker] = None,
+        timeout_s: Optional[float] = None,
+        max_retries: Optional[int] = None,
+        hedge: Optional[bool] = None,
+    ):
+        self.llm = llm
+        self.breaker = breaker or CircuitBreaker("llm")
+        self.timeout_s = config.LLM_TIMEOUT_S if timeout_s is None else timeout_s
+        self.max_retries = config.LLM_MAX_RETRIES if max_retries is None else max_retries
+        self.hedge = config.LLM_HEDGE_ENABLED if hedge is None else hedge
+        # Sync calls run here so a stuck request can be abandoned at the deadline or hedged.
+        self._executor = ThreadPoolExecutor(max_workers=config.LLM_CALL_THREADS, thread_name_prefix="llm-call")
+        self._lock = threading.Lock()
+        self._latency: Dict[str, Deque[float]] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    def _observe(self, call: str, seconds: float) -> None:
+        with self._lock:
+            self._latency.setdefault(call, deque(maxlen=200)).append(seconds)
+
+    def hedge_delay_s(self, call: str) -> float:
+        # p95 of recent successful attempts for this call; a fixed delay until there are enough.
+        with self._lock:
+            samples = sorted(self._latency.get(call) or ())
+        if len(samples) < config.LLM_HEDGE_MIN_SAMPLES:
+            return config.LLM_HEDGE_DELAY_S
+        return max(config.LLM_HEDGE_MIN_DELAY_S, samples[int(0.95 * (len(samples) - 1))])
+
+    def _count(self, call: str, key: str, n: int = 1) -> None:
+        with self._lock:
+            bucket = self._stats.setdefault(call, {"calls": 0, "retries": 0, "hedged": 0, "hedge_wins": 0,
+                                                   "timeouts": 0, "failed": 0})
+            bucket[key] += n
+
+    def _submit(self, request: Any, kwargs: Dict[str, Any]) -> Any:
+        # Each attempt runs in a copy of the caller's context (the graph's stream writer lives there).
+        return self._executor.submit(contextvars.copy_context().run, self.llm.invoke, request, **kwargs)
+
+    def _attempt(self, request: Any, call: str, kwargs: Dict[str, Any]) -> Tuple[Any, bool, bool]:
+        started = time.monotonic()
+        deadline = started + self.timeout_s
+        # Streamed calls are not hedged: two streams would race into one consumer.
+        hedge = self.hedge and request.on_delta is None
+        hedge_at = started + self.hedge_delay_s(call) if hedge else None
+        futures = {self._submit(request, kwargs): 0}
+        error: Optional[BaseException] = None
+        while futures:
+            now = time.monotonic()
+            until = min(deadline, hedge_at) if hedge_at is not None else deadline
+            done, _ = wait(list(futures), timeout=max(0.0, until - now), return_when=FIRST_COMPLETED)
+            for fut in done:
+                idx = futures.pop(fut)
+                if fut.exception() is None:
+                    for other in futures:
+                        other.cancel()
+                    self._observe(call, time.monotonic() - started)
+                    return fut.result(), hedge_at is None and hedge, idx == 1
+                error = fut.exception()
+            if not done:
+                if time.monotonic() >= deadline:
+                    raise LLMTimeout(f"{call} timed out after {self.timeout_s:g}s")
+                if hedge_at is not None:
+                    hedge_at = None
+                    futures[self._submit(request, kwargs)] = 1
+        assert error is not None
+        raise error
+
+    async def _aattempt(self, request: Any, call: str, kwargs: Dict[str, Any]) -> Tuple[Any, bool, bool]:
+        started = time.monotonic()
+        deadline = started + self.timeout_s
+        hedge = self.hedge and request.on_delta is None
+        hedge_at = started + self.hedge_delay_s(call) if hedge else None
+        tasks = {asyncio.ensure_future(self.llm.ainvoke(request, **kwargs)): 0}
+        error: Optional[BaseException] = None
+        try:
+            while tasks:
+                until = min(deadline, hedge_at) if hedge_at is not None else deadline
+                done, _ = await asyncio.wait(
+                    list(tasks), timeout=max(0.0, until - time.monotonic()), return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    idx = tasks.pop(task)
+                    if task.exception() is None:
+                        self._observe(call, time.monotonic() - started)
+                        return task.result(), hedge_at is None and hedge, idx == 1
+                    error = task.exception()
+                if not done:
+                    if time.monotonic() >= deadline:
+                        raise LLMTimeout(f"{call} timed out after {self.timeout_s:g}s")
+                    if hedge_at is not None:
+                        hedge_at = None
+                        tasks[asyncio.ensure_future(self.llm.ainvoke(request, **kwargs))] = 1
+        finally:
+            for task in tasks:
+                task.cancel()
+        assert error is not None
+        raise error
+
+    def _give_up(self, call: str, e: BaseException, retries: int) -> LLMCallFailed:
+        self._count(call, "failed")
+        self._count(call, "retries", retries)
+        if not is_retryable(e):
+            # Auth, bad-request and parser errors: retrying cannot help.
+            return LLMCallFailed(call, "llm_failed", f"LLM call '{call}' failed: {type(e).__name__}", retries)
+        if isinstance(e, LLMTimeout):
+            return LLMCallFailed(call, "llm_timeout", f"LLM call '{call}' timed out after {retries + 1} attempt(s)", retries)
+        return LLMCallFailed(
+            call, "llm_unavailable", f"LLM call '{call}' failed after {retries + 1} attempt(s): {type(e).__name__}", retries
+        )
+
+    def _tag(self, msg: Any, call: str, retries: int, hedged: bool, hedge_won: bool) -> Any:
+        self._count(call, "calls")
+        if retries:
+            self._count(call, "retries", retries)
+        if hedged:
+            self._count(call, "hedged")
+        if hedge_won:
+            self._count(call, "hedge_wins")
+        meta = dict(getattr(msg, "response_metadata", None) or {})
+        meta.update(retries=retries, hedged=hedged, hedge_won=hedge_won)
+        try:
+            msg.response_metadata = meta
+        except (AttributeError, TypeError, ValueError):
+            pass
+        return msg
+
+    def _failed_attempt(self, call: str, e: BaseException, attempt: int) -> Optional[float]:
+        # Returns the backoff before the next attempt, or None to give up.
+        if isinstance(e, LLMTimeout):
+            self._count(call, "timeouts")
+        if not is_retryable(e):
+            return None
+        self.breaker.record_failure()
+        if attempt >= self.max_retries:
+            return None
+        return backoff_s(attempt, e)
+
+    def invoke(self, request: Any, **kwargs: Any) -> Any:
+        request = as_request(request)
+        call = request.name
+        gate = _DeltaGate(request.on_delta)
+        try:
+            for attempt in range(self.max_retries + 1):
+                self.breaker.before_call(call)
+                try:
+                    msg, hedged, won = self._attempt(gate.bind(request, attempt), call, kwargs)
+                except LLMCallFailed:
+                    raise
+                except Exception as e:
+                    delay = self._failed_attempt(call, e, attempt)
+                    if delay is None:
+                        raise self._give_up(call, e, attempt) from e
+                    time.sleep(delay)
+                    continue
+                self.breaker.record_success()
+                return self._tag(msg, call, attempt, hedged, won)
+            raise AssertionError("unreachable")
+        finally:
+            gate.close()
+
+    async def ainvoke(self, request: Any, **kwargs: Any) -> Any:
+        request = as_request(request)
+        call = request.name
+        gate = _DeltaGate(request.on_delta)
+        try:
+            for attempt in range(self.max_retries + 1):
+                await asyncio.to_thread(self.breaker.before_call, call)
+                try:
+                    msg, hedged, won = await self._aattempt(gate.bind(request, attempt), call, kwargs)
+                except LLMCallFailed:
+                    raise
+                except Exception as e:
+                    delay = await asyncio.to_thread(self._failed_attempt, call, e, attempt)
+                    if delay is None:
+                        raise self._give_up(call, e, attempt) from e
+                    await asyncio.sleep(delay)
+                    continue
+                await asyncio.to_thread(self.breaker.record_success)
+                return self._tag(msg, call, attempt, hedged, won)
+            raise AssertionError("unreachable")
+        finally:
+            gate.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            calls = {k: dict(v) for k, v in self._stats.items()}
+        for call in calls:
+            calls[call]["hedge_delay_s"] = round(self.hedge_delay_s(call), 3)
+        return {
+            "timeout_s": self.timeout_s,
+            "max_retries": self.max_retries,
+            "hedge": self.hedge,
+            "breaker": self.breaker.stats(),
+            "calls": calls,
+        }
+
+
+def find_policy(llm: Any) -> Optional[ResilientLLM]:
+    # Walks wrapper layers (cache, recorder) down to the policy, if there is one.
+    seen: List[Any] = []
+    while llm is not None and llm not in seen:
+        if isinstance(llm, ResilientLLM):
+            return llm
+        seen.append(llm)
+        llm = getattr(llm, "llm", None)
+    return None
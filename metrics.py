@@ -0,0 +1,225 @@
+import bisect
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import config
+import db
+
+# Per-run spans (graph nodes and LLM calls) plus process-wide Prometheus-style counters
+# and histograms. Spans are buffered per run_id and written to run_spans when the run
+# finishes; the registry is per process, so scrape every worker.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(**labels: Any) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = _labels(**labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_fmt_labels(labels)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._series: Dict[Labels, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _labels(**labels)
+        with self._lock:
+            # Per-bucket counts followed by sum and count.
+            series = self._series.setdefault(key, [0.0] * (len(self.buckets) + 2))
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                series[idx] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                cumulative = 0.0
+                for bound, n in zip(self.buckets, series):
+                    cumulative += n
+                    lines.append(f"{self.name}_bucket{_fmt_labels(labels, ('le', f'{bound:g}'))} {cumulative:g}")
+                lines.append(f"{self.name}_bucket{_fmt_labels(labels, ('le', '+Inf'))} {series[-1]:g}")
+                lines.append(f"{self.name}_sum{_fmt_labels(labels)} {series[-2]:.6f}")
+                lines.append(f"{self.name}_count{_fmt_labels(labels)} {series[-1]:g}")
+        return lines
+
+
+NODE_SECONDS = Histogram("agent_node_duration_seconds", "Wall time per graph node.")
+RUN_SECONDS = Histogram("agent_run_duration_seconds", "Wall time per run by category and intent branch.")
+LLM_SECONDS = Histogram("agent_llm_call_duration_seconds", "Wall time per LLM call, including cache lookups.")
+LLM_CALLS = Counter("agent_llm_calls_total", "LLM calls by call name and cache result.")
+LLM_TOKENS = Counter("agent_llm_tokens_total", "Tokens billed by call name and kind (prompt/completion).")
+LLM_COST = Counter("agent_llm_cost_usd_total", "Estimated LLM spend in USD by call name.")
+LLM_RETRIES = Counter("agent_llm_retries_total", "Retried LLM attempts by call name.")
+LLM_QUEUE_SECONDS = Histogram("agent_llm_queue_wait_seconds", "Time LLM calls waited for client-side RPM/TPM quota.")
+LLM_HEDGES = Counter("agent_llm_hedges_total", "Hedged LLM calls by call name and which request won.")
+FIRST_ITEM_SECONDS = Histogram(
+    "agent_run_first_item_seconds", "Time from run start to the first streamed recommendation or bundle, by kind."
+)
+DEDUP_LOOKUPS = Counter("agent_dedup_lookups_total", "Near-duplicate index lookups by result (hit/miss/skipped).")
+RUNS = Counter("agent_runs_total", "Finished runs by category and status.")
+NODE_ERRORS = Counter("agent_node_errors_total", "Graph nodes that raised, by node.")
+
+REGISTRY = (
+    RUNS, RUN_SECONDS, FIRST_ITEM_SECONDS, NODE_SECONDS, NODE_ERRORS, LLM_CALLS, LLM_SECONDS, LLM_QUEUE_SECONDS, LLM_TOKENS, LLM_COST,
+    LLM_RETRIES, LLM_HEDGES, DEDUP_LOOKUPS,
+)
+
+_lock = threading.Lock()
+_spans: Dict[str, List[Dict[str, Any]]] = {}
+_finished = 0
+
+
+def _add_span(run_id: Optional[str], span: Dict[str, Any]) -> None:
+    if not run_id:
+        return
+    with _lock:
+        _spans.setdefault(run_id, []).append(span)
+
+
+def record_node(run_id: Optional[str], node: str, started_at: float, seconds: float, error: Optional[str] = None) -> None:
+    NODE_SECONDS.observe(seconds, node=node)
+    if error:
+        NODE_ERRORS.inc(node=node)
+    _add_span(run_id, {
+        "kind": "node", "name": node, "started_at": started_at, "duration_ms": round(seconds * 1000, 3),
+        "attrs": {"error": error} if error else {},
+    })
+
+
+def usage_of(msg: Any) -> Tuple[int, int]:
+    usage = getattr(msg, "usage_metadata", None) or {}
+    return int(usage.get("input_tokens", 0) or 0), int(usage.get("output_tokens", 0) or 0)
+
+
+def record_llm_call(
+    run_id: Optional[str], call: str, started_at: float, seconds: float, msg: Any = None, error: Optional[str] = None,
+    retries: Optional[int] = None,
+) -> None:
+    meta = getattr(msg, "response_metadata", None) or {}
+    cache_hit = bool(meta.get("cache_hit"))
+    retries = int(meta.get("retries", 0) or 0) if retries is None else retries
+    hedged = bool(meta.get("hedged"))
+    prompt_tokens, completion_tokens = (0, 0) if cache_hit else usage_of(msg)
+    cost = (prompt_tokens * config.LLM_PRICE_PROMPT_PER_1K + completion_tokens * config.LLM_PRICE_COMPLETION_PER_1K) / 1000
+
+    LLM_SECONDS.observe(seconds, call=call)
+    LLM_CALLS.inc(call=call, cache="error" if error else ("hit" if cache_hit else "miss"))
+    if prompt_tokens:
+        LLM_TOKENS.inc(prompt_tokens, call=call, kind="prompt")
+    if completion_tokens:
+        LLM_TOKENS.inc(completion_tokens, call=call, kind="completion")
+    if cost:
+        LLM_COST.inc(cost, call=call)
+    if retries:
+        LLM_RETRIES.inc(retries, call=call)
+    if "queue_wait_ms" in meta:
+        LLM_QUEUE_SECONDS.observe(float(meta["queue_wait_ms"]) / 1000, call=call)
+    if hedged:
+        LLM_HEDGES.inc(call=call, winner="hedge" if meta.get("hedge_won") else "primary")
+
+    attrs: Dict[str, Any] = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cost_usd": round(cost, 6),
+        "retries": retries,
+        "cache_hit": cache_hit,
+    }
+    if cache_hit:
+        attrs["cache_tier"] = meta.get("cache_tier")
+    if meta.get("queue_wait_ms"):
+        attrs["queue_wait_ms"] = meta["queue_wait_ms"]
+    if hedged:
+        attrs["hedge_won"] = bool(meta.get("hedge_won"))
+    if error:
+        attrs["error"] = error
+    _add_span(run_id, {
+        "kind": "llm", "name": call, "started_at": started_at, "duration_ms": round(seconds * 1000, 3), "attrs": attrs,
+    })
+
+
+def finish_run(run_id: str, final: Optional[Dict[str, Any]], seconds: float, error: Optional[str] = None) -> None:
+    global _finished
+    final = final or {}
+    category = final.get("category") or "none"
+    intent = (final.get("classification") or {}).get("intent") or "none"
+    RUNS.inc(category=category, status="error" if error else "ok")
+    if not error:
+        RUN_SECONDS.observe(seconds, category=category, intent=intent)
+
+    with _lock:
+        spans = _spans.pop(run_id, [])
+        _finished += 1
+        prune = _finished % 1000 == 0
+    spans.append({
+        "kind": "run", "name": "run", "started_at": time.time() - seconds, "duration_ms": round(seconds * 1000, 3),
+        "attrs": {"category": category, "intent": intent, **({"error": error} if error else {})},
+    })
+    db.insert_run_spans(run_id, spans)
+    if prune:
+        db.prune_run_spans(time.time() - config.METRICS_SPAN_RETENTION_S)
+
+
+def _sampled(name: str, kind: str, help_text: str, samples: Sequence[Tuple[Labels, float]]) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{_fmt_labels(labels)} {value:g}" for labels, value in samples)
+    return lines
+
+
+def admission_lines(stats: Dict[str, Any]) -> List[str]:
+    # Read at scrape time from WorkerPool.stats() (WSGI) or AsyncRunLimiter.stats() (ASGI).
+    running = stats.get("active_workers", stats.get("inflight", 0))
+    return (
+        _sampled("agent_pool_running_runs", "gauge", "Runs executing now.", [((), running)])
+        + _sampled("agent_pool_queue_depth", "gauge", "Admitted runs waiting for a worker.",
+                   [((), stats.get("queue_depth", 0))])
+        + _sampled("agent_pool_tenant_inflight_runs", "gauge", "Admitted runs per tenant, queued or running.",
+                   [(_labels(tenant=t), n) for t, n in sorted(stats["tenants_inflight"].items())])
+        + _sampled("agent_pool_rejections_total", "counter", "Requests refused at admission by reason.",
+                   [(_labels(reason=r), n) for r, n in sorted(stats["rejected"].items())])
+    )
+
+
+def render(admission: Optional[Dict[str, Any]] = None) -> str:
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    if admission is not None:
+        lines.extend(admission_lines(admission))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,226 @@
+import math
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import config
+import db
+from kb import KB
+
+# Deterministic first-pass classifier over the KB keyword rules. All phrases are
+# compiled into one alternation so a scan is a single regex pass over the email.
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def _tokens(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall(text.lower()) if len(t) > 1]
+
+
+def _strength(hits: int, other_hits: int) -> float:
+    if hits <= 0:
+        return 0.0
+    return (hits / (hits + other_hits)) * (1.0 - 0.5 ** hits)
+
+
+class RuleMatcher:
+    def __init__(self, kb: Dict[str, Any]):
+        self.labels: Dict[str, List[Tuple[str, str]]] = {}
+        for category in ("sales", "support"):
+            for phrase in kb.get(category, []):
+                self.labels.setdefault(phrase.lower(), []).append(("category", category))
+        for intent, phrases in (kb.get("intent_rules") or {}).items():
+            for phrase in phrases:
+                self.labels.setdefault(phrase.lower(), []).append(("intent", intent))
+        alternation = "|".join(
+            re.escape(p).replace(r"\ ", r"\s+") for p in sorted(self.labels, key=len, reverse=True)
+        )
+        self.pattern = re.compile(r"\b(?:" + alternation + r")\b")
+
+    def match(self, text: str) -> Tuple[Counter, Counter, List[str]]:
+        categories: Counter = Counter()
+        intents: Counter = Counter()
+        matched: List[str] = []
+        for m in self.pattern.finditer(text.lower()):
+            phrase = " ".join(m.group(0).split())
+            matched.append(phrase)
+            for kind, label in self.labels.get(phrase, []):
+                (categories if kind == "category" else intents)[label] += 1
+        return categories, intents, matched
+
+
+class NaiveBayes:
+    def __init__(self) -> None:
+        self.doc_counts: Counter = Counter()
+        self.token_counts: Dict[str, Counter] = {}
+        self.token_totals: Counter = Counter()
+        self.vocab: set = set()
+
+    def fit(self, samples: Iterable[Tuple[List[str], str]]) -> "NaiveBayes":
+        for tokens, label in samples:
+            self.doc_counts[label] += 1
+            counts = self.token_counts.setdefault(label, Counter())
+            counts.update(tokens)
+            self.token_totals[label] += len(tokens)
+            self.vocab.update(tokens)
+        return self
+
+    @property
+    def samples(self) -> int:
+        return sum(self.doc_counts.values())
+
+    def predict_proba(self, tokens: List[str]) -> Dict[str, float]:
+        total_docs = self.samples
+        if not total_docs:
+            return {}
+        v = len(self.vocab) or 1
+        scores: Dict[str, float] = {}
+        for label, docs in self.doc_counts.items():
+            counts = self.token_counts[label]
+            denom = self.token_totals[label] + v
+            s = math.log(docs / total_docs)
+            for t in tokens:
+                s += math.log((counts.get(t, 0) + 1) / denom)
+            scores[label] = s
+        top = max(scores.values())
+        exp = {k: math.exp(s - top) for k, s in scores.items()}
+        z = sum(exp.values())
+        return {k: e / z for k, e in exp.items()}
+
+
+@dataclass
+class PreClassification:
+    category: str
+    intent: str
+    confidence: float
+    matched: List[str] = field(default_factory=list)
+    source: str = "rules"
+
+    def to_classification(self) -> Dict[str, Any]:
+        hits = ", ".join(sorted(set(self.matched))[:12]) or "none"
+        return {
+            "category": self.category,
+            "intent": self.intent,
+            "confidence": round(self.confidence, 3),
+            "reasoning": f"Local pre-classifier ({self.source}); matched keyword rules: {hits}."[:1000],
+        }
+
+
+def _combine(rule_label: str, rule_conf: float, proba: Dict[str, float]) -> Tuple[str, float]:
+    if not proba:
+        return rule_label, rule_conf
+    model_label = max(proba, key=proba.get)
+    model_conf = proba[model_label]
+    if rule_conf <= 0.0:
+        return model_label, model_conf * 0.9
+    if model_label == rule_label:
+        return rule_label, 1.0 - (1.0 - rule_conf) * (1.0 - model_conf)
+    if model_conf > rule_conf:
+        return model_label, model_conf - rule_conf
+    return rule_label, rule_conf - model_conf
+
+
+class PreClassifier:
+    def __init__(self, kb: Dict[str, Any], category_model: Optional[NaiveBayes] = None,
+                 intent_model: Optional[NaiveBayes] = None):
+        self.matcher = RuleMatcher(kb)
+        self.category_model = category_model
+        self.intent_model = intent_model
+
+    def classify(self, subject: str, body: str) -> Optional[PreClassification]:
+        text = f"{subject}\n{body}"
+        categories, intents, matched = self.matcher.match(text)
+        sales, support = categories.get("sales", 0), categories.get("support", 0)
+        category = "sales" if sales >= support else "support"
+        conf = _strength(max(sales, support), min(sales, support))
+        source = "rules"
+
+        tokens: Optional[List[str]] = None
+        if self.category_model is not None:
+            tokens = _tokens(text)
+            category, conf = _combine(category, conf, self.category_model.predict_proba(tokens))
+            source = "rules+model"
+
+        if conf <= 0.0:
+            return None
+
+        if category == "support":
+            intent, intent_conf = "other", 1.0
+        else:
+            intent_label = intents.most_common(1)[0][0] if intents else "need_more_information"
+            top = intents.most_common(2)
+            second = top[1][1] if len(top) > 1 else 0
+            intent_conf = _strength(intents.get(intent_label, 0), second)
+            if self.intent_model is not None:
+                tokens = tokens if tokens is not None else _tokens(text)
+                intent_label, intent_conf = _combine(intent_label, intent_conf, self.intent_model.predict_proba(tokens))
+            intent = intent_label
+
+        return PreClassification(category, intent, max(0.0, min(1.0, min(conf, intent_conf))), matched, source)
+
+
+def train_models(limit: int = 20000) -> Tuple[Optional[NaiveBayes], Optional[NaiveBayes]]:
+    rows = db.get_labeled_tickets(limit)
+    if len(rows) < config.PRECLASSIFIER_MIN_SAMPLES:
+        return None, None
+    category_model = NaiveBayes().fit((_tokens(f"{r['email_subject']}\n{r['email_body']}"), r["category"]) for r in rows)
+    intent_model = NaiveBayes().fit(
+        (_tokens(f"{r['email_subject']}\n{r['email_body']}"), r["intent"])
+        for r in rows if r["category"] == "sales" and r["intent"]
+    )
+    return category_model, (intent_model if intent_model.samples else None)
+
+
+_lock = threading.Lock()
+_classifier: Optional[PreClassifier] = None
+_shadow_lock = threading.Lock()
+_shadow_writes = 0
+
+
+def get_classifier() -> PreClassifier:
+    global _classifier
+    with _lock:
+        if _classifier is None:
+            models: Tuple[Optional[NaiveBayes], Optional[NaiveBayes]] = (None, None)
+            if config.PRECLASSIFIER_USE_MODEL:
+                models = train_models()
+            _classifier = PreClassifier(KB, *models)
+        return _classifier
+
+
+def reload_classifier() -> PreClassifier:
+    global _classifier
+    with _lock:
+        _classifier = None
+    return get_classifier()
+
+
+def record_shadow(run_id: str, pre: Optional[PreClassification], llm_cls: Dict[str, Any]) -> None:
+    db.record_preclassifier_shadow(
+        run_id=run_id,
+        pre_category=pre.category if pre else None,
+        pre_intent=pre.intent if pre else None,
+        pre_confidence=pre.confidence if pre else 0.0,
+        llm_category=llm_cls.get("category", "unknown"),
+        llm_intent=llm_cls.get("intent", "other"),
+    )
+    global _shadow_writes
+    with _shadow_lock:
+        _shadow_writes += 1
+        prune = _shadow_writes % 100 == 0
+    # Shadow rows are only needed for the agreement report, so old ones age out like spans do.
+    if prune:
+        db.prune_preclassifier_shadow(datetime.utcnow() - timedelta(seconds=config.PRECLASSIFIER_SHADOW_RETENTION_S))
+
+
+def shadow_report(threshold: Optional[float] = None) -> Dict[str, Any]:
+    threshold = config.PRECLASSIFIER_THRESHOLD if threshold is None else threshold
+    report = db.preclassifier_shadow_report(threshold)
+    report["threshold"] = threshold
+    report["mode"] = config.PRECLASSIFIER_MODE
+    clf = get_classifier()
+    report["model_samples"] = clf.category_model.samples if clf.category_model else 0
+    return report
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import catalog
+import config
+
+# Local retrieval over the active catalog, so recommend/bundle prompts carry the top-k
+# products for the email instead of the whole catalog. Products are indexed once per
+# catalog snapshot, either as dense vectors from a CPU sentence-transformers model
+# (PRODUCT_INDEX_MODEL) or as a sparse TF-IDF matrix. Either way the arrays are saved
+# as .npy files and memory-mapped, so every worker process shares one copy through the
+# page cache, and a query is one vectorized cosine pass.
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_TERM_MASK = (1 << 24) - 1
+
+
+def product_text(p: Dict[str, Any]) -> str:
+    return f"{p['name']} {p['category']} {p['purpose']} {p.get('keywords') or ''} {p['sku']}"
+
+
+def _terms(text: str) -> Counter:
+    # Unigrams and bigrams as stable 24-bit ids (crc32, unlike hash(), is the same in every process).
+    tokens = _TOKEN_RE.findall(text.lower())
+    terms = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    return Counter(zlib.crc32(t.encode("utf-8")) & _TERM_MASK for t in terms)
+
+
+class TfidfBackend:
+    # Column-major (term -> postings) sparse matrix: vocab[i] owns docs/weights[offsets[i]:offsets[i+1]].
+    name = "tfidf"
+    files = ("vocab", "idf", "offsets", "docs", "weights")
+
+    def __init__(self, arrays: Dict[str, np.ndarray], n_docs: int):
+        self.arrays = arrays
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, texts: Sequence[str]) -> Dict[str, np.ndarray]:
+        term_ids: List[int] = []
+        doc_ids: List[int] = []
+        tfs: List[int] = []
+        for doc, text in enumerate(texts):
+            for term, tf in _terms(text).items():
+                term_ids.append(term)
+                doc_ids.append(doc)
+                tfs.append(tf)
+        terms = np.asarray(term_ids, dtype=np.uint32)
+        docs = np.asarray(doc_ids, dtype=np.int32)
+        vocab, inverse, df = np.unique(terms, return_inverse=True, return_counts=True)
+        idf = (np.log((1.0 + len(texts)) / (1.0 + df)) + 1.0).astype(np.float32)
+        weights = (1.0 + np.log(np.asarray(tfs, dtype=np.float32))) * idf[inverse]
+        norms = np.sqrt(np.bincount(docs, weights=weights * weights, minlength=len(texts)))
+        weights = weights / np.where(norms > 0, norms, 1.0)[docs]
+        order = np.lexsort((docs, inverse))
+        return {
+            "vocab": vocab,
+            "idf": idf,
+            "offsets": np.concatenate([[0], np.cumsum(df)]).astype(np.int64),
+            "docs": docs[order],
+            "weights": weights[order].astype(np.float32),
+        }
+
+    def scores(self, text: str) -> np.ndarray:
+        a = self.arrays
+        counts = _terms(text)
+        ids = np.fromiter(counts.keys(), dtype=np.uint32, count=len(counts))
+        pos = np.searchsorted(a["vocab"], ids)
+        known = pos < len(a["vocab"])
+        known[known] = a["vocab"][pos[known]] == ids[known]
+        if not known.any():
+            return np.zeros(self.n_docs, dtype=np.float64)
+        tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))[known]
+        pos = pos[known]
+        q = (1.0 + np.log(tf)) * a["idf"][pos]
+        q /= np.linalg.norm(q)
+        starts, ends = a["offsets"][pos], a["offsets"][pos + 1]
+        docs = np.concatenate([a["docs"][s:e] for s, e in zip(starts, ends)])
+        weights = np.concatenate([a["weights"][s:e] * w for s, e, w in zip(starts, ends, q)])
+        return np.bincount(docs, weights=weights, minlength=self.n_docs)
+
+
+class EmbeddingBackend:
+    name = "embedding"
+    files = ("matrix",)
+    _model: Any = None
+    _lock = threading.Lock()
+
+    def __init__(self, arrays: Dict[str, np.ndarray], n_docs: int):
+        self.matrix = arrays["matrix"]
+        self.n_docs = n_docs
+
+    @classmethod
+    def model(cls) -> Any:
+        with cls._lock:
+            if cls._model is None:
+                from sentence_transformers import SentenceTransformer
+
+                cls._model = SentenceTransformer(config.PRODUCT_INDEX_MODEL, device="cpu")
+            return cls._model
+
+    @classmethod
+    def encode(cls, texts: Sequence[str]) -> np.ndarray:
+        return np.asarray(cls.model().encode(list(texts), normalize_embeddings=True), dtype=np.float32)
+
+    @classmethod
+    def build(cls, texts: Sequence[str]) -> Dict[str, np.ndarray]:
+        return {"matrix": cls.encode(texts)}
+
+    def scores(self, text: str) -> np.ndarray:
+        return self.matrix @ self.encode([text])[0]
+
+
+_backend_error: Optional[str] = None
+
+
+def _backend() -> Any:
+    global _backend_error
+    if config.PRODUCT_INDEX_MODEL and _backend_error is None:
+        try:
+            EmbeddingBackend.model()
+            return EmbeddingBackend
+        except Exception as e:  # not installed, bad model name, failed download: TF-IDF it is
+            _backend_error = f"{type(e).__name__}: {e}"
+    return TfidfBackend
+
+
+class ProductIndex:
+    def __init__(self, snapshot: catalog.CatalogSnapshot, skus: Tuple[str, ...], backend: Any, build_ms: float):
+        self.snapshot = snapshot
+        self.skus = skus
+        self.backend = backend
+        self.build_ms = build_ms
+
+    def search(self, text: str, k: int) -> List[Tuple[str, float]]:
+        if not self.skus or k <= 0:
+            return []
+        scores = self.backend.scores(text)
+        k = min(k, len(self.skus))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.skus[i], float(scores[i])) for i in top]
+
+
+def _index_dir(backend: Any, products: Sequence[Dict[str, Any]]) -> Path:
+    # Keyed by content rather than revision: revisions restart with every database.
+    digest = hashlib.sha256(f"{backend.name}:{config.PRODUCT_INDEX_MODEL}".encode("utf-8"))
+    for p in products:
+        digest.update(b"\0" + p["sku"].encode("utf-8") + b"\0" + product_text(p).encode("utf-8"))
+    return Path(config.PRODUCT_INDEX_DIR) / f"{backend.name}-{digest.hexdigest()[:20]}"
+
+
+def _write(path: Path, skus: Tuple[str, ...], arrays: Dict[str, np.ndarray]) -> None:
+    # Written to a temp dir and renamed into place, so readers never see a partial index.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=f".{path.name}-", dir=path.parent))
+    for name, array in arrays.items():
+        np.save(tmp / f"{name}.npy", array)
+    (tmp / "skus.json").write_text(json.dumps(list(skus)), encoding="utf-8")
+    try:
+        os.replace(tmp, path)
+    except OSError:  # another process got there first
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+    # Indexes of older catalogs are dead weight. Processes still using one keep their
+    # memory maps; temp dirs (dot-prefixed) of concurrent writers are left alone.
+    prefix = path.name.split("-", 1)[0] + "-"
+    for old in path.parent.iterdir():
+        if old != path and old.name.startswith(prefix) and old.is_dir():
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def _load(path: Path, backend: Any) -> Dict[str, np.ndarray]:
+    return {name: np.load(path / f"{name}.npy", mmap_mode="r") for name in backend.files}
+
+
+def build_index(snapshot: catalog.CatalogSnapshot) -> ProductIndex:
+    started = time.perf_counter()
+    backend = _backend()
+    products = snapshot.active
+    skus = tuple(p["sku"] for p in products)
+    path = _index_dir(backend, products)
+    arrays: Dict[str, np.ndarray] = {}
+    if products:
+        if not (path / "skus.json").exists():
+            _write(path, skus, backend.build([product_text(p) for p in products]))
+        try:
+            arrays = _load(path, backend)
+        except FileNotFoundError:  # pruned by a process that indexed a newer catalog
+            _write(path, skus, backend.build([product_text(p) for p in products]))
+            arrays = _load(path, backend)
+    return ProductIndex(snapshot, skus, backend(arrays, len(skus)), round((time.perf_counter() - started) * 1000, 2))
+
+
+_lock = threading.Lock()
+_index: Optional[ProductIndex] = None
+
+
+def get_index(snapshot: Optional[catalog.CatalogSnapshot] = None) -> ProductIndex:
+    global _index
+    snapshot = snapshot or catalog.get_catalog()
+    current = _index
+    if current is not None and current.snapshot is snapshot:
+        return current
+    with _lock:
+        if _index is None or _index.snapshot is not snapshot:
+            _index = build_index(snapshot)
+        return _index
+
+
+def search_products(text: str, k: int, snapshot: Optional[catalog.CatalogSnapshot] = None) -> List[Dict[str, Any]]:
+    snapshot = snapshot or catalog.get_catalog()
+    return [snapshot.by_sku[sku] for sku, _ in get_index(snapshot).search(text, k)]
+
+
+def stats() -> Dict[str, Any]:
+    idx = _index
+    if idx is None:
+        return {"loaded": False, "model_error": _backend_error}
+    return {
+        "loaded": True,
+        "revision": idx.snapshot.revision,
+        "backend": idx.backend.name,
+        "products": len(idx.skus),
+        "build_ms": idx.build_ms,
+        "model_error": _backend_error,
+    }
@@ -0,0 +1,140 @@
+import asyncio
+import random
+import time
+import uuid
+from typing import Any, Dict, Optional, Tuple
+
+import config
+import db
+from llm_client import as_request
+from llm_policy import LLMCallFailed
+
+# Client-side RPM/TPM token buckets shared by every worker through SQLite, in front of
+# the policy layer (under the cache, so hits cost nothing). Calls are admitted in
+# priority order across processes; tokens are estimated from the formatted prompt
+# plus an expected completion, then corrected once the response reports real usage.
+
+PRIORITY_URGENT = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+
+_WAITER_TTL_S = 5.0
+
+
+def estimate_tokens(request: Any) -> int:
+    chars = sum(len(str(m.content)) for m in as_request(request).messages)
+    return (chars + 3) // 4 + config.LLM_RATE_COMPLETION_TOKENS
+
+
+class RateLimitedLLM:
+    def __init__(self, llm: Any, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.llm = llm
+        self.rpm = config.LLM_RATE_RPM if rpm is None else rpm
+        self.tpm = config.LLM_RATE_TPM if tpm is None else tpm
+
+    def _costs(self, tokens: int) -> Dict[str, Tuple[float, float, float]]:
+        costs: Dict[str, Tuple[float, float, float]] = {}
+        if self.rpm > 0:
+            costs["rpm"] = (1.0, float(self.rpm), self.rpm / 60.0)
+        if self.tpm > 0:
+            costs["tpm"] = (float(tokens), float(self.tpm), self.tpm / 60.0)
+        return costs
+
+    def _try(
+        self, waiter_id: str, priority: int, costs: Dict[str, Tuple[float, float, float]], blocked: int
+    ) -> Tuple[bool, float, bool]:
+        acquired, wait_s, ahead = db.rate_try_acquire(waiter_id, priority, costs, time.time(), _WAITER_TTL_S)
+        pause = wait_s
+        if ahead and wait_s <= 0:
+            # Our turn should have come but a waiter ahead has not taken it yet: back off with
+            # jitter instead of re-taking the write lock every poll interval.
+            pause = config.LLM_RATE_POLL_S * (2 ** min(blocked, 3)) * random.uniform(0.5, 1.0)
+        # Capped well under the waiter TTL so a sleeping waiter keeps its place.
+        return acquired, min(max(pause, 0.005), 1.0), ahead > 0
+
+    def _gave_up(self, request: Any, waiter_id: str, waited: float) -> LLMCallFailed:
+        db.rate_leave(waiter_id)
+        return LLMCallFailed(
+            as_request(request).name, "llm_rate_limited",
+            f"Gave up waiting {waited:.0f}s for LLM quota", retry_after=config.LLM_RATE_POLL_S,
+        )
+
+    def _settle(self, estimated: int, msg: Any) -> None:
+        usage = getattr(msg, "usage_metadata", None) or {}
+        actual = int(usage.get("total_tokens") or 0)
+        if self.tpm > 0 and actual:
+            db.rate_adjust("tpm", float(estimated - actual), float(self.tpm), self.tpm / 60.0, time.time())
+
+    def _tag(self, msg: Any, wait_ms: float, tokens: int) -> Any:
+        meta = dict(getattr(msg, "response_metadata", None) or {})
+        meta.update(queue_wait_ms=round(wait_ms, 2), estimated_tokens=tokens)
+        try:
+            msg.response_metadata = meta
+        except (AttributeError, TypeError, ValueError):
+            pass
+        return msg
+
+    def invoke(self, request: Any, **kwargs: Any) -> Any:
+        request = as_request(request)
+        tokens = estimate_tokens(request)
+        costs = self._costs(tokens)
+        waiter_id = uuid.uuid4().hex
+        started = time.monotonic()
+        notified = False
+        blocked = 0
+        while costs:
+            acquired, pause, behind = self._try(waiter_id, request.priority, costs, blocked)
+            if acquired:
+                break
+            blocked = blocked + 1 if behind else 0
+            waited = time.monotonic() - started
+            if waited >= config.LLM_RATE_MAX_WAIT_S:
+                raise self._gave_up(request, waiter_id, waited)
+            if not notified and request.on_wait:
+                request.on_wait("queued", 0.0)
+                notified = True
+            time.sleep(pause)
+        wait_ms = (time.monotonic() - started) * 1000
+        if notified and request.on_wait:
+            request.on_wait("admitted", wait_ms)
+        msg = self.llm.invoke(request, **kwargs)
+        self._settle(tokens, msg)
+        return self._tag(msg, wait_ms, tokens)
+
+    async def ainvoke(self, request: Any, **kwargs: Any) -> Any:
+        request = as_request(request)
+        tokens = estimate_tokens(request)
+        costs = self._costs(tokens)
+        waiter_id = uuid.uuid4().hex
+        started = time.monotonic()
+        notified = False
+        blocked = 0
+        while costs:
+            acquired, pause, behind = await asyncio.to_thread(self._try, waiter_id, request.priority, costs, blocked)
+            if acquired:
+                break
+            blocked = blocked + 1 if behind else 0
+            waited = time.monotonic() - started
+            if waited >= config.LLM_RATE_MAX_WAIT_S:
+                raise await asyncio.to_thread(self._gave_up, request, waiter_id, waited)
+            if not notified and request.on_wait:
+                request.on_wait("queued", 0.0)
+                notified = True
+            await asyncio.sleep(pause)
+        wait_ms = (time.monotonic() - started) * 1000
+        if notified and request.on_wait:
+            request.on_wait("admitted", wait_ms)
+        msg = await self.llm.ainvoke(request, **kwargs)
+        await asyncio.to_thread(self._settle, tokens, msg)
+        return self._tag(msg, wait_ms, tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rpm": self.rpm, "tpm": self.tpm, **db.rate_stats()}
+
+
+def find_limiter(llm: Any) -> Optional[RateLimitedLLM]:
+    while llm is not None:
+        if isinstance(llm, RateLimitedLLM):
+            return llm
+        llm = getattr(llm, "llm", None)
+    return None
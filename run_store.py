@@ -0,0 +1,248 @@
+import abc
+import asyncio
+import contextlib
+import os
+import socket
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Set, Tuple
+
+import config
+import db
+
+# Event log behind /api/start and /api/stream. Every status/final/error event gets a
+# per-run sequence number, used as the SSE id so a reconnect with Last-Event-ID resumes
+# after the last event the client saw, on any worker process.
+
+OWNER = f"{socket.gethostname()}:{os.getpid()}"
+TERMINAL = ("final", "error")
+
+Event = Tuple[int, Dict[str, Any]]
+
+
+class RunStore(abc.ABC):
+    # Whether other processes can append to this store. Only then do waiters poll
+    # (every RUN_STORE_POLL_S); appends from this process wake them directly.
+    shared = True
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._async_waiters: Dict[str, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+        self._last_gc = 0.0
+
+    @abc.abstractmethod
+    def create(self, run_id: str) -> None: ...
+
+    @abc.abstractmethod
+    def exists(self, run_id: str) -> bool: ...
+
+    @abc.abstractmethod
+    def _append(self, run_id: str, payload: Dict[str, Any], finished: bool) -> int: ...
+
+    @abc.abstractmethod
+    def read(self, run_id: str, after_seq: int = 0) -> List[Event]: ...
+
+    @abc.abstractmethod
+    def gc(self, now: Optional[float] = None) -> int: ...
+
+    @abc.abstractmethod
+    def recover(self) -> int: ...
+
+    @abc.abstractmethod
+    def stats(self) -> Dict[str, Any]: ...
+
+    def append(self, run_id: str, payload: Dict[str, Any]) -> int:
+        seq = self._append(run_id, payload, payload.get("type") in TERMINAL)
+        with self._cond:
+            self._cond.notify_all()
+            waiters = list(self._async_waiters.get(run_id, ()))
+        for loop, event in waiters:
+            # The loop may have shut down since the waiter registered.
+            with contextlib.suppress(RuntimeError):
+                loop.call_soon_threadsafe(event.set)
+        return seq
+
+    def _poll_s(self, remaining: float) -> float:
+        return min(remaining, config.RUN_STORE_POLL_S) if self.shared else remaining
+
+    def wait(self, run_id: str, after_seq: int, timeout: float) -> List[Event]:
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self.read(run_id, after_seq)
+            remaining = deadline - time.monotonic()
+            if events or remaining <= 0:
+                return events
+            with self._cond:
+                self._cond.wait(self._poll_s(remaining))
+
+    async def await_events(self, run_id: str, after_seq: int, timeout: float) -> List[Event]:
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = (loop, event)
+        with self._cond:
+            self._async_waiters.setdefault(run_id, set()).add(waiter)
+        try:
+            deadline = loop.time() + timeout
+            while True:
+                # Cleared before reading, so an append that lands after the read still wakes us.
+                event.clear()
+                events = await asyncio.to_thread(self.read, run_id, after_seq)
+                remaining = deadline - loop.time()
+                if events or remaining <= 0:
+                    return events
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(event.wait(), self._poll_s(remaining))
+        finally:
+            with self._cond:
+                waiters = self._async_waiters.get(run_id)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self._async_waiters[run_id]
+
+    def maybe_gc(self) -> int:
+        now = time.time()
+        if now - self._last_gc < config.RUN_STORE_GC_INTERVAL_S:
+            return 0
+        self._last_gc = now
+        return self.gc(now)
+
+
+class SQLiteRunStore(RunStore):
+    def create(self, run_id: str) -> None:
+        db.run_create(run_id, OWNER)
+
+    def exists(self, run_id: str) -> bool:
+        return db.run_exists(run_id)
+
+    def _append(self, run_id: str, payload: Dict[str, Any], finished: bool) -> int:
+        return db.run_append_event(run_id, payload, finished)
+
+    def read(self, run_id: str, after_seq: int = 0) -> List[Event]:
+        return db.run_read_events(run_id, after_seq)
+
+    def gc(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        return db.run_gc(now - config.RUN_STORE_FINISHED_TTL_S, now - config.RUN_STORE_ABANDONED_TTL_S)
+
+    def recover(self) -> int:
+        # Runs started by a process on this host that no longer exists will never finish;
+        # close them with an error so their streams end instead of waiting forever.
+        host = OWNER.split(":", 1)[0]
+        recovered = 0
+        for row in db.run_unfinished(host + ":"):
+            pid = int(row["owner"].rsplit(":", 1)[1])
+            if pid == os.getpid() or _pid_alive(pid):
+                continue
+            self.append(row["run_id"], {"type": "error", "message": "Run was interrupted by a server restart."})
+            recovered += 1
+        return recovered
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "sqlite", **db.run_counts()}
+
+
+class ProcessLocalRunStore(RunStore):
+    # Keeps runs in this process's memory: streams only work when /api/start and
+    # /api/stream hit the same process, and everything is lost on restart. Use it for
+    # single-process dev and tests; multi-worker deployments need the sqlite backend.
+    shared = False
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._runs: Dict[str, Dict[str, Any]] = {}
+
+    def create(self, run_id: str) -> None:
+        now = time.time()
+        with self._cond:
+            self._runs.setdefault(run_id, {"events": [], "updated_at": now, "finished_at": None})
+
+    def exists(self, run_id: str) -> bool:
+        return run_id in self._runs
+
+    def _append(self, run_id: str, payload: Dict[str, Any], finished: bool) -> int:
+        now = time.time()
+        with self._cond:
+            run = self._runs.setdefault(run_id, {"events": [], "updated_at": now, "finished_at": None})
+            run["events"].append(payload)
+            run["updated_at"] = now
+            if finished:
+                run["finished_at"] = now
+            return len(run["events"])
+
+    def read(self, run_id: str, after_seq: int = 0) -> List[Event]:
+        with self._cond:
+            events = list((self._runs.get(run_id) or {}).get("events") or [])
+        return [(i + 1, e) for i, e in enumerate(events) if i + 1 > after_seq]
+
+    def gc(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        finished_before = now - config.RUN_STORE_FINISHED_TTL_S
+        abandoned_before = now - config.RUN_STORE_ABANDONED_TTL_S
+        with self._cond:
+            stale = [
+                run_id for run_id, r in self._runs.items()
+                if (r["finished_at"] or now) < finished_before
+                or (r["finished_at"] is None and r["updated_at"] < abandoned_before)
+            ]
+            for run_id in stale:
+                del self._runs[run_id]
+        return len(stale)
+
+    def recover(self) -> int:
+        return 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "backend": "local",
+                "runs": len(self._runs),
+                "active": sum(1 for r in self._runs.values() if r["finished_at"] is None),
+                "events": sum(len(r["events"]) for r in self._runs.values()),
+            }
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def build_store(backend: Optional[str] = None) -> RunStore:
+    backend = (backend or config.RUN_STORE_BACKEND).lower()
+    if backend == "local":
+        return ProcessLocalRunStore()
+    return SQLiteRunStore()
+
+
+def iter_events(store: RunStore, run_id: str, after_seq: int, heartbeat_s: float = 30.0) -> Iterator[Optional[Event]]:
+    # Yields (seq, payload) until a terminal event, and None when heartbeat_s passes quietly.
+    while True:
+        events = store.wait(run_id, after_seq, heartbeat_s)
+        if not events:
+            yield None
+            continue
+        for seq, payload in events:
+            after_seq = seq
+            yield seq, payload
+            if payload.get("type") in TERMINAL:
+                return
+
+
+async def aiter_events(
+    store: RunStore, run_id: str, after_seq: int, heartbeat_s: float = 30.0
+) -> AsyncIterator[Optional[Event]]:
+    while True:
+        events = await store.await_events(run_id, after_seq, heartbeat_s)
+        if not events:
+            yield None
+            continue
+        for seq, payload in events:
+            after_seq = seq
+            yield seq, payload
+            if payload.get("type") in TERMINAL:
+                return
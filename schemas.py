@@ -1,10 +1,14 @@
 from pydantic import BaseModel, Field, conlist, confloat
 from typing import List, Literal, Optional, Dict, Any
 
+import config
+
 class AttachmentInfo(BaseModel):
     filename: str
     content_type: str
     size_bytes: int
+    sha256: Optional[str] = None
+    blob: Optional[str] = None
 
 class EmailInput(BaseModel):
     subject: str = Field(..., min_length=1, max_length=200)
@@ -23,6 +27,19 @@ class ClassificationResult(BaseModel):
     confidence: confloat(ge=0.0, le=1.0)
     reasoning: str = Field(..., min_length=10, max_length=1000)
 
+class IntentDetails(BaseModel):
+    mentions: List[str] = Field(default_factory=list)
+    need_keywords: List[str] = Field(default_factory=list)
+    wants_bundles: bool = False
+    needs_more_info: bool = False
+    follow_up_questions: List[str] = Field(default_factory=list)
+    support_symptoms: List[str] = Field(default_factory=list)
+    environment_hints: List[str] = Field(default_factory=list)
+    urgency: Literal["low", "medium", "high"] = "medium"
+
+class FusedClassification(ClassificationResult, IntentDetails):
+    pass
+
 class ProductRecommendation(BaseModel):
     sku: str
     name: str
@@ -33,7 +50,7 @@ class ProductRecommendation(BaseModel):
 
 class BundleOption(BaseModel):
     name: str
-    items: conlist(str, min_length=1, max_length=6)
+    items: conlist(str, min_length=1, max_length=config.BUNDLE_ITEMS_LIMIT)
     total_price_usd: float
     score: confloat(ge=0.0, le=1.0)
     reasoning: str = Field(..., min_length=10, max_length=800)
@@ -8,6 +8,28 @@ function addBubble(role, text) {
   div.textContent = text;
   chat.appendChild(div);
   chat.scrollTop = chat.scrollHeight;
+  return div;
+}
+
+function formatRecommendation(r, i) {
+  return `  ${i+1}) ${r.name} (${r.sku}) - $${r.price_usd}\n     Purpose: ${r.purpose}\n     Score: ${r.score}\n     Reason: ${r.reasoning}\n`;
+}
+
+function formatBundle(b, i) {
+  return `  ${i+1}) ${b.name} - $${b.total_price_usd}\n     Items: ${b.items.join(", ")}\n     Score: ${b.score}\n     Reason: ${b.reasoning}\n`;
+}
+
+function formatPartial(items) {
+  let out = "";
+  if (items.recommendation.length) {
+    out += `📦 Recommendations (generating...):\n`;
+    items.recommendation.forEach((r, i) => { if (r) out += formatRecommendation(r, i); });
+  }
+  if (items.bundle.length) {
+    out += `${out ? "\n" : ""}🎁 Bundle Options (generating...):\n`;
+    items.bundle.forEach((b, i) => { if (b) out += formatBundle(b, i); });
+  }
+  return out;
 }
 
 function setStatus(text, progress) {
@@ -25,16 +47,12 @@ function formatFinal(finalData) {
 
     if (finalData.sales.recommendations?.length) {
       out += `\n📦 Recommendations:\n`;
-      finalData.sales.recommendations.forEach((r, i) => {
-        out += `  ${i+1}) ${r.name} (${r.sku}) - $${r.price_usd}\n     Purpose: ${r.purpose}\n     Score: ${r.score}\n     Reason: ${r.reasoning}\n`;
-      });
+      finalData.sales.recommendations.forEach((r, i) => { out += formatRecommendation(r, i); });
     }
 
     if (finalData.sales.bundles?.length) {
       out += `\n🎁 Bundle Options (sorted by price):\n`;
-      finalData.sales.bundles.forEach((b, i) => {
-        out += `  ${i+1}) ${b.name} - $${b.total_price_usd}\n     Items: ${b.items.join(", ")}\n     Score: ${b.score}\n     Reason: ${b.reasoning}\n`;
-      });
+      finalData.sales.bundles.forEach((b, i) => { out += formatBundle(b, i); });
     }
 
     if (finalData.sales.follow_up_questions?.length) {
@@ -77,6 +95,12 @@ document.getElementById("sendBtn").addEventListener("click", async () => {
 
   const res = await fetch("/api/start", { method: "POST", body: fd });
   const payload = await res.json();
+  if (!res.ok) {
+    const wait = res.headers.get("Retry-After");
+    addBubble("assistant", `❌ Error: ${payload.error || "Request rejected."}${wait ? ` Retry in ${wait}s.` : ""}`);
+    setStatus("Busy.", 0);
+    return;
+  }
   const run_id = payload.run_id;
 
   const es = new EventSource(`/api/stream/${run_id}`);
@@ -89,14 +113,35 @@ document.getElementById("sendBtn").addEventListener("click", async () => {
     setStatus(`[${step}] ${msg}`, progress);
   });
 
+  // Items arrive one by one while the model is still writing; the final event replaces them.
+  const items = { recommendation: [], bundle: [] };
+  let live = null;
+  const onItem = (e) => {
+    const data = JSON.parse(e.data);
+    items[e.type][data.index] = data.item;
+    const text = formatPartial(items);
+    if (live) live.textContent = text;
+    else live = addBubble("assistant", text);
+    chat.scrollTop = chat.scrollHeight;
+  };
+  es.addEventListener("recommendation", onItem);
+  es.addEventListener("bundle", onItem);
+
   es.addEventListener("final", (e) => {
     const data = JSON.parse(e.data);
+    if (live) live.remove();
     addBubble("assistant", formatFinal(data.data));
     setStatus("Done.", 100);
     es.close();
   });
 
   es.addEventListener("error", (e) => {
+    if (e.data === undefined && es.readyState !== EventSource.CLOSED) {
+      // Connection dropped: the browser reconnects with Last-Event-ID and the server resumes from there.
+      setStatus("Connection lost, reconnecting...", null);
+      return;
+    }
+    if (live) live.remove();
     try {
       const data = JSON.parse(e.data);
       addBubble("assistant", `❌ Error: ${data.message}`);
@@ -0,0 +1,172 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+
+class PoolRejected(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def _limit(value: int) -> Optional[int]:
+    # 0 or less means no limit, as with LLM_RATE_RPM/TPM.
+    return value if value > 0 else None
+
+
+def _over(count: int, limit: Optional[int]) -> bool:
+    return limit is not None and count >= limit
+
+
+def _avg(values: List[float]) -> Optional[float]:
+    return round(sum(values) / len(values), 2) if values else None
+
+
+class WorkerPool:
+    def __init__(self, max_workers: int, max_pending: int, tenant_max_inflight: int):
+        self.max_workers = max(1, max_workers)
+        self.max_pending = _limit(max_pending)
+        self.tenant_max_inflight = _limit(tenant_max_inflight)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="run-worker")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._active = 0
+        self._tenant_inflight: Dict[str, int] = {}
+        self._wait_ms: "deque[float]" = deque(maxlen=500)
+        self._run_ms: "deque[float]" = deque(maxlen=500)
+        self._submitted = 0
+        self._completed = 0
+        self._rejected = {"queue_full": 0, "tenant_limit": 0}
+
+    def _retry_after_locked(self) -> int:
+        avg_run_s = (sum(self._run_ms) / len(self._run_ms) / 1000.0) if self._run_ms else 5.0
+        backlog = self._pending / self.max_workers + 1
+        return int(min(60, max(1, round(avg_run_s * backlog))))
+
+    def retry_after(self) -> int:
+        with self._lock:
+            return self._retry_after_locked()
+
+    def reserve(self, tenant: str) -> None:
+        # Admission without the work yet: the slot counts as pending until start() or cancel(),
+        # so a request can be rejected before its body is read.
+        with self._lock:
+            if _over(self._pending, self.max_pending):
+                self._rejected["queue_full"] += 1
+                raise PoolRejected("Worker queue is full.", self._retry_after_locked())
+            if _over(self._tenant_inflight.get(tenant, 0), self.tenant_max_inflight):
+                self._rejected["tenant_limit"] += 1
+                raise PoolRejected("Too many in-flight runs for this tenant.", self._retry_after_locked())
+            self._pending += 1
+            self._tenant_inflight[tenant] = self._tenant_inflight.get(tenant, 0) + 1
+
+    def cancel(self, tenant: str) -> None:
+        with self._lock:
+            self._pending -= 1
+            self._release_tenant_locked(tenant)
+
+    def _release_tenant_locked(self, tenant: str) -> None:
+        left = self._tenant_inflight.get(tenant, 1) - 1
+        if left > 0:
+            self._tenant_inflight[tenant] = left
+        else:
+            self._tenant_inflight.pop(tenant, None)
+
+    def submit(self, tenant: str, fn: Callable[..., Any], *args: Any) -> None:
+        self.reserve(tenant)
+        self.start(tenant, fn, *args)
+
+    def start(self, tenant: str, fn: Callable[..., Any], *args: Any) -> None:
+        # Runs a reserved slot; queue wait is measured from here, not from the reservation.
+        enqueued = time.perf_counter()
+        with self._lock:
+            self._submitted += 1
+
+        def run() -> None:
+            started = time.perf_counter()
+            with self._lock:
+                self._pending -= 1
+                self._active += 1
+                self._wait_ms.append((started - enqueued) * 1000)
+            try:
+                fn(*args)
+            finally:
+                with self._lock:
+                    self._active -= 1
+                    self._completed += 1
+                    self._run_ms.append((time.perf_counter() - started) * 1000)
+                    self._release_tenant_locked(tenant)
+
+        self._executor.submit(run)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = list(self._wait_ms)
+            return {
+                "max_workers": self.max_workers,
+                "max_pending": self.max_pending,
+                "tenant_max_inflight": self.tenant_max_inflight,
+                "active_workers": self._active,
+                "queue_depth": self._pending,
+                "tenants_inflight": dict(self._tenant_inflight),
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "rejected": dict(self._rejected),
+                "wait_ms": {"avg": _avg(waits), "max": round(max(waits), 2) if waits else None},
+                "run_ms": {"avg": _avg(list(self._run_ms))},
+            }
+
+
+class AsyncRunLimiter:
+    # Admission for the asyncio path: runs are tasks, so only in-flight counts are capped.
+    def __init__(self, max_inflight: int, tenant_max_inflight: int):
+        self.max_inflight = _limit(max_inflight)
+        self.tenant_max_inflight = _limit(tenant_max_inflight)
+        self._inflight = 0
+        self._tenant_inflight: Dict[str, int] = {}
+        self._run_ms: "deque[float]" = deque(maxlen=500)
+        self._admitted = 0
+        self._rejected = {"inflight_limit": 0, "tenant_limit": 0}
+
+    def _retry_after(self) -> int:
+        avg_run_s = (sum(self._run_ms) / len(self._run_ms) / 1000.0) if self._run_ms else 5.0
+        return int(min(60, max(1, round(avg_run_s))))
+
+    def acquire(self, tenant: str) -> float:
+        if _over(self._inflight, self.max_inflight):
+            self._rejected["inflight_limit"] += 1
+            raise PoolRejected("Too many in-flight runs.", self._retry_after())
+        if _over(self._tenant_inflight.get(tenant, 0), self.tenant_max_inflight):
+            self._rejected["tenant_limit"] += 1
+            raise PoolRejected("Too many in-flight runs for this tenant.", self._retry_after())
+        self._inflight += 1
+        self._admitted += 1
+        self._tenant_inflight[tenant] = self._tenant_inflight.get(tenant, 0) + 1
+        return time.perf_counter()
+
+    def release(self, tenant: str, started: float) -> None:
+        self._run_ms.append((time.perf_counter() - started) * 1000)
+        self.cancel(tenant)
+
+    def cancel(self, tenant: str) -> None:
+        # Gives the slot back without a run-time sample, for requests that never started a run.
+        self._inflight -= 1
+        left = self._tenant_inflight.get(tenant, 1) - 1
+        if left > 0:
+            self._tenant_inflight[tenant] = left
+        else:
+            self._tenant_inflight.pop(tenant, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_inflight": self.max_inflight,
+            "tenant_max_inflight": self.tenant_max_inflight,
+            "inflight": self._inflight,
+            "tenants_inflight": dict(self._tenant_inflight),
+            "admitted": self._admitted,
+            "rejected": dict(self._rejected),
+            "run_ms": {"avg": _avg(list(self._run_ms))},
+        }